@@ -0,0 +1,3 @@
+"""
+Benchmarks of TransNet on synthetic data.  Run with python -m benchmarks.run
+"""
@@ -0,0 +1,278 @@
+"""
+Times the main paths through TransNet on synthetic data.
+
+Usage:
+
+    python -m benchmarks.run --scale yeast --output results.json
+    python -m benchmarks.run --scale yeast --baseline results.json
+
+Each benchmark is run several times and its fastest time is reported.  The
+results are written as JSON and can be compared against an earlier run:
+any benchmark slower than its baseline by more than the tolerance is
+reported, and makes the run exit with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+import numpy as np
+
+from benchmarks import synthetic
+from transnet import genome
+from transnet.chipseq import log_normal, poisson, sicer
+from transnet.chipseq.chip_peak import annotate
+from transnet.chipseq.summary import write_text_summary
+from transnet.genome_coverage import GenomeCoverage
+from transnet.transcriptomics import lox
+
+__author__ = "Matthew Peterson"
+
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.2
+
+def _read_genome(files):
+    with open(files["genome"]) as handle:
+        return genome.read(handle, "bed")
+
+def _read_sicer(files):
+    with open(files["sicer"]) as handle:
+        return sicer.read(handle)
+
+def bench_genome_read(files):
+    return (lambda: _read_genome(files),
+            len(_read_genome(files).gene_dict))
+
+def bench_sicer_read(files):
+    return lambda: _read_sicer(files), len(_read_sicer(files))
+
+def bench_sicer_read_table(files):
+    def run():
+        with open(files["sicer"]) as handle:
+            return sicer.read_table(handle)
+    return run, len(run())
+
+def bench_poisson_read(files):
+    def run():
+        with open(files["poisson"]) as handle:
+            return poisson.read(handle, "chr1")
+    return run, len(run())
+
+def bench_poisson_read_table(files):
+    def run():
+        with open(files["poisson"]) as handle:
+            return poisson.read_table(handle, "chr1")
+    return run, len(run())
+
+def bench_log_normal_read(files):
+    def run():
+        with open(files["log_normal"]) as handle:
+            return log_normal.read(handle, "chr1")
+    return run, len(run())
+
+def bench_log_normal_read_table(files):
+    def run():
+        with open(files["log_normal"]) as handle:
+            return log_normal.read_table(handle, "chr1")
+    return run, len(run())
+
+def bench_get_regulated_genes(files):
+    annotation = _read_genome(files)
+    peaks = _read_sicer(files)
+
+    def run():
+        for p in peaks:
+            p.get_regulated_genes(annotation)
+    return run, len(peaks)
+
+def bench_annotate(files):
+    annotation = _read_genome(files)
+    peaks = _read_sicer(files)
+    return lambda: annotate(peaks, annotation), len(peaks)
+
+def bench_write_text_summary(files):
+    annotation = _read_genome(files)
+    peaks = _read_sicer(files)
+
+    def run():
+        with open(os.devnull, "w") as handle:
+            write_text_summary(peaks, annotation, handle)
+    return run, len(peaks)
+
+def bench_coverage_load(files):
+    def run():
+        return GenomeCoverage(files["coverage"], "swig")
+    coverage = run()
+    return run, sum(coverage.get_length(s) for s in coverage.sequences())
+
+def bench_lox_read(files):
+    def run():
+        experiment = lox.read(files["lox"], read_pvals=True)
+        experiment.pvalues.load_all()
+        return experiment
+    return run, len(run().loci)
+
+def bench_lox_get_diff_expressed(files):
+    experiment = lox.read(files["lox"], read_pvals=True)
+    pairs = experiment.pvalue_pairs()
+
+    def run():
+        for first, second in pairs:
+            experiment.get_diff_expressed(first, second, 1.0, 0.05)
+    return run, len(pairs) * len(experiment.loci)
+
+def bench_lox_diff_expression(files):
+    experiment = lox.read(files["lox"], read_pvals=True)
+    pairs = experiment.pvalue_pairs()
+    return (lambda: experiment.diff_expression(pairs, 1.0, 0.05),
+            len(pairs) * len(experiment.loci))
+
+BENCHMARKS = [
+    ("genome_read", bench_genome_read),
+    ("sicer_read", bench_sicer_read),
+    ("sicer_read_table", bench_sicer_read_table),
+    ("poisson_read", bench_poisson_read),
+    ("poisson_read_table", bench_poisson_read_table),
+    ("log_normal_read", bench_log_normal_read),
+    ("log_normal_read_table", bench_log_normal_read_table),
+    ("get_regulated_genes", bench_get_regulated_genes),
+    ("annotate", bench_annotate),
+    ("write_text_summary", bench_write_text_summary),
+    ("coverage_load", bench_coverage_load),
+    ("lox_read", bench_lox_read),
+    ("lox_get_diff_expressed", bench_lox_get_diff_expressed),
+    ("lox_diff_expression", bench_lox_diff_expression),
+]
+
+def run(files, names=None, repeat=DEFAULT_REPEAT):
+    """
+    Runs the benchmarks.
+
+    :param files: the input files, as returned by synthetic.generate
+    :type files: dict
+    :param names: the benchmarks to run; defaults to all of them
+    :type names: list
+    :param repeat: the number of times to run each benchmark
+    :type repeat: int
+    :return a dictionary of results keyed by benchmark name, each holding
+            the fastest time in seconds and the number of records processed
+    :rtype dict
+    """
+    results = {}
+
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        function, records = setup(files)
+        times = []
+        for i in range(repeat):
+            start = timeit.default_timer()
+            function()
+            times.append(timeit.default_timer() - start)
+
+        results[name] = {"seconds": min(times), "records": records}
+
+    return results
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results against a baseline.
+
+    :return a list of tuples of the form (name, seconds, baseline seconds,
+            ratio, regressed), for the benchmarks in both
+    :rtype list
+    """
+    comparison = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        seconds = results[name]["seconds"]
+        previous = baseline[name]["seconds"]
+        ratio = seconds / previous if previous > 0 else float("inf")
+        comparison.append((name, seconds, previous, ratio,
+                           ratio > 1.0 + tolerance))
+
+    return comparison
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Times TransNet on synthetic data.")
+    parser.add_argument("--scale", default="yeast",
+                        choices=sorted(synthetic.SCALES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--data-dir",
+                        help="where to keep the synthetic files; they are "
+                             "generated if missing and reused otherwise")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="the fraction slower than the baseline that "
+                             "counts as a regression")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="the benchmarks to run; defaults to all")
+    options = parser.parse_args(args)
+
+    directory = options.data_dir
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="transnet-bench-")
+
+    try:
+        marker = os.path.join(directory, "scale.json")
+        settings = {"scale": options.scale, "seed": options.seed}
+        if os.path.exists(marker):
+            with open(marker) as handle:
+                if json.load(handle) != settings:
+                    raise ValueError("%s holds data for a different scale or "
+                                     "seed." % directory)
+            files = synthetic.file_names(directory)
+        else:
+            files = synthetic.generate(directory, options.scale, options.seed)
+            with open(marker, "w") as handle:
+                json.dump(settings, handle)
+
+        results = run(files, options.benchmarks, options.repeat)
+    finally:
+        if options.data_dir is None:
+            shutil.rmtree(directory)
+
+    report = {"scale": options.scale, "seed": options.seed,
+              "repeat": options.repeat, "python": platform.python_version(),
+              "numpy": np.__version__, "results": results}
+
+    for name, _ in BENCHMARKS:
+        if name in results:
+            sys.stdout.write("%-24s %10.4f s %12d records\n" %
+                             (name, results[name]["seconds"],
+                              results[name]["records"]))
+
+    if options.output:
+        with open(options.output, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+
+    regressed = False
+    if options.baseline:
+        with open(options.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline.get("scale") != options.scale:
+            sys.stdout.write("Warning: the baseline is for the %s scale.\n" %
+                             baseline.get("scale"))
+
+        sys.stdout.write("\n%-24s %10s %10s %8s\n" %
+                         ("benchmark", "seconds", "baseline", "ratio"))
+        for name, seconds, previous, ratio, slower in \
+                compare(results, baseline["results"], options.tolerance):
+            sys.stdout.write("%-24s %10.4f %10.4f %8.2f%s\n" %
+                             (name, seconds, previous, ratio,
+                              "  SLOWER" if slower else ""))
+            regressed = regressed or slower
+
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
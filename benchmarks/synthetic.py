@@ -0,0 +1,244 @@
+"""
+Deterministic generators of synthetic input files for the benchmarks.
+
+Every generator takes a scale (one of SCALES) and a seed, and writes the
+same file for the same scale and seed.
+"""
+import os
+from os import path
+import numpy as np
+
+__author__ = "Matthew Peterson"
+
+# The sizes of each scale.  coverage_positions is the number of positions
+# with coverage, i.e. the number of lines in the SWIG file, and they are
+# spread over the first coverage_length positions of the genome, divided
+# evenly between the chromosomes.  GenomeCoverage holds 8 bytes for every
+# position up to the last one covered, so coverage spread over a whole
+# mammalian genome would need 24 GB; at the mammal scale it is confined to
+# 50 Mb (400 MB of arrays).
+SCALES = {
+    "tiny": {"chromosomes": 3, "genome_length": 600000, "genes": 600,
+             "peaks": 500, "coverage_positions": 100000,
+             "coverage_length": 600000, "lox_genes": 600,
+             "lox_experiments": 4},
+    "yeast": {"chromosomes": 16, "genome_length": 12000000, "genes": 6000,
+              "peaks": 5000, "coverage_positions": 2000000,
+              "coverage_length": 12000000, "lox_genes": 6000,
+              "lox_experiments": 10},
+    "mammal": {"chromosomes": 23, "genome_length": 3000000000,
+               "genes": 20000, "peaks": 100000,
+               "coverage_positions": 20000000, "coverage_length": 50000000,
+               "lox_genes": 20000, "lox_experiments": 20},
+}
+
+# The lines written at once by the larger generators
+_BLOCK_SIZE = 100000
+
+def generate(directory, scale="yeast", seed=0):
+    """
+    Writes every synthetic input file into a directory.
+
+    :param directory: the directory to write to; created if necessary
+    :type directory: string
+    :param scale: the name of a scale in SCALES
+    :type scale: string
+    :param seed: the random seed
+    :type seed: int
+    :return a dictionary of the file names, keyed by input type
+    :rtype dict
+    """
+    if not path.isdir(directory):
+        os.makedirs(directory)
+
+    files = file_names(directory)
+
+    with open(files["genome"], "w") as handle:
+        write_genome(handle, scale, seed)
+    with open(files["sicer"], "w") as handle:
+        write_sicer_peaks(handle, scale, seed)
+    with open(files["poisson"], "w") as handle:
+        write_poisson_peaks(handle, scale, seed)
+    with open(files["log_normal"], "w") as handle:
+        write_log_normal_peaks(handle, scale, seed)
+    with open(files["coverage"], "w") as handle:
+        write_swig(handle, scale, seed)
+    write_lox(files["lox"], scale, seed)
+
+    return files
+
+def file_names(directory):
+    """
+    Returns the names of the files generate() writes into a directory.
+
+    :rtype: dict
+    """
+    return {
+        "genome": path.join(directory, "genome.bed"),
+        "sicer": path.join(directory, "peaks.sicer"),
+        "poisson": path.join(directory, "peaks.poisson"),
+        "log_normal": path.join(directory, "peaks.lognormal"),
+        "coverage": path.join(directory, "coverage.swig"),
+        "lox": path.join(directory, "expression.lox"),
+    }
+
+def chromosomes(scale):
+    """
+    Returns the chromosomes of a scale.
+
+    :return a list of tuples of the form (name, length)
+    :rtype list
+    """
+    sizes = SCALES[scale]
+    length = sizes["genome_length"] // sizes["chromosomes"]
+
+    return [("chr%d" % (i + 1), length) for i in range(sizes["chromosomes"])]
+
+def write_genome(handle, scale="yeast", seed=0):
+    """
+    Writes a BED6 annotation of evenly spread, non-overlapping genes.
+    """
+    random = np.random.RandomState(seed)
+    sizes = SCALES[scale]
+    per_chromosome = max(sizes["genes"] // sizes["chromosomes"], 1)
+    locus = 0
+
+    for name, length in chromosomes(scale):
+        spacing = length // per_chromosome
+        for i in range(per_chromosome):
+            start = i * spacing + random.randint(0, spacing // 4)
+            stop = start + random.randint(spacing // 4, spacing // 2)
+            strand = "+" if random.randint(2) else "-"
+            handle.write("%s\t%d\t%d\tG%06d\t0\t%s\n" %
+                         (name, start, stop, locus, strand))
+            locus += 1
+
+def write_sicer_peaks(handle, scale="yeast", seed=0):
+    """
+    Writes a SICER island file.
+    """
+    random = np.random.RandomState(seed + 1)
+    names, starts, stops = _random_peaks(random, scale)
+    count = len(starts)
+
+    island = random.randint(20, 500, count)
+    control = random.randint(0, 50, count)
+    pvalues = 10.0 ** -random.uniform(2, 50, count)
+    folds = (island + 1.0) / (control + 1.0)
+    fdrs = pvalues * random.uniform(1, 100, count)
+
+    for i in range(count):
+        handle.write("%s\t%d\t%d\t%d\t%d\t%g\t%g\t%g\n" %
+                     (names[i], starts[i], stops[i], island[i], control[i],
+                      pvalues[i], folds[i], fdrs[i]))
+
+def write_poisson_peaks(handle, scale="yeast", seed=0):
+    """
+    Writes a Poisson peak file.  These files hold a single chromosome, chr1.
+    """
+    random = np.random.RandomState(seed + 2)
+    starts, stops = _random_chromosome_peaks(random, scale)
+    count = len(starts)
+
+    heights = random.randint(10, 1000, count)
+    pvalues = 10.0 ** -random.uniform(5, 30, count)
+    shifts = random.randint(-200, 200, count)
+
+    for i in range(count):
+        handle.write("%d\t%d\t%d\t%g\t%d\n" % (starts[i] + 1, stops[i] + 1,
+                                               heights[i], pvalues[i],
+                                               shifts[i]))
+
+def write_log_normal_peaks(handle, scale="yeast", seed=0):
+    """
+    Writes a log-normal peak file.  These files hold a single chromosome,
+    chr1.
+    """
+    random = np.random.RandomState(seed + 3)
+    starts, stops = _random_chromosome_peaks(random, scale)
+    count = len(starts)
+
+    heights = random.randint(10, 1000, count)
+    shifts = random.randint(-200, 200, count)
+
+    for i in range(count):
+        handle.write("%d\t%d\t%d\t.\t%d\n" % (starts[i], stops[i], heights[i],
+                                              shifts[i]))
+
+def write_swig(handle, scale="yeast", seed=0):
+    """
+    Writes a SWIG coverage file, with coverage at randomly chosen positions
+    spread over the start of every chromosome (see SCALES).
+    """
+    random = np.random.RandomState(seed + 4)
+    sizes = SCALES[scale]
+    per_chromosome = sizes["coverage_positions"] // sizes["chromosomes"]
+    covered = sizes["coverage_length"] // sizes["chromosomes"]
+
+    for name, length in chromosomes(scale):
+        positions = np.unique(random.randint(0, min(length, covered),
+                                             per_chromosome))
+        for first in range(0, len(positions), _BLOCK_SIZE):
+            block = positions[first:first + _BLOCK_SIZE]
+            reverse = random.poisson(3, len(block))
+            forward = random.poisson(3, len(block))
+            handle.write("".join("%s\t%d\t%d\t%d\n" % (name, p, r, f)
+                                 for p, r, f in zip(block, reverse, forward)))
+
+def write_lox(filename, scale="yeast", seed=0):
+    """
+    Writes a LOX output file, and a .pvalue file for each experiment beside
+    it, as read by transnet.transcriptomics.lox.read.
+    """
+    random = np.random.RandomState(seed + 5)
+    sizes = SCALES[scale]
+    experiments = ["E%d" % i for i in range(sizes["lox_experiments"])]
+    genes = sizes["lox_genes"]
+
+    levels = random.lognormal(3, 1.5, (genes, len(experiments)))
+    lower = levels * random.uniform(0.5, 0.9, levels.shape)
+    upper = levels * random.uniform(1.1, 1.5, levels.shape)
+
+    with open(filename, "w") as handle:
+        handle.write("Gene\tLength\t" +
+                     "\t".join(experiments + ["%s_lower" % e for e in
+                                              experiments] +
+                               ["%s_upper" % e for e in experiments]) + "\n")
+        for i in range(genes):
+            values = np.concatenate((levels[i], lower[i], upper[i]))
+            handle.write("G%06d\t1000\t%s\n" %
+                         (i, "\t".join("%g" % v for v in values)))
+
+    base = path.splitext(filename)[0]
+    for e in experiments:
+        others = [o for o in experiments if o != e]
+        pvalues = random.uniform(0, 1, (genes, len(others)))
+        with open("%s.%s.pvalue" % (base, e), "w") as handle:
+            handle.write("Gene\tLength\t" +
+                         "\t".join("P(%s>%s)" % (e, o) for o in others) +
+                         "\n")
+            for i in range(genes):
+                handle.write("G%06d\t1000\t%s\n" %
+                             (i, "\t".join("%g" % p for p in pvalues[i])))
+
+def _random_peaks(random, scale):
+    """Returns random peaks spread over every chromosome"""
+    sizes = SCALES[scale]
+    names = [name for name, _ in chromosomes(scale)]
+    length = sizes["genome_length"] // sizes["chromosomes"]
+
+    codes = random.randint(0, len(names), sizes["peaks"])
+    widths = random.randint(200, 2000, sizes["peaks"])
+    starts = random.randint(0, length - 2000, sizes["peaks"])
+
+    return [names[c] for c in codes], starts, starts + widths
+
+def _random_chromosome_peaks(random, scale):
+    """Returns random peaks on chr1, sorted by position"""
+    length = chromosomes(scale)[0][1]
+    count = SCALES[scale]["peaks"]
+
+    starts = np.sort(random.randint(0, length - 2000, count))
+    widths = random.randint(100, 1000, count)
+
+    return starts, starts + widths
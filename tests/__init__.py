@@ -0,0 +1,4 @@
+"""
+Tests for TransNet.  Run with python -m pytest, or python -m unittest
+discover tests.
+"""
@@ -0,0 +1,72 @@
+"""
+Tests that the sweep-line annotate() agrees with per-peak annotation
+"""
+import random
+import unittest
+from transnet import genome
+from transnet.chipseq.chip_peak import ChipPeak, annotate
+
+class _Peak(ChipPeak):
+    __slots__ = ()
+
+    def score(self):
+        return 0.0
+
+def _random_genome(rng, chromosomes=3, genes=60, length=100000):
+    lines = []
+    for c in range(chromosomes):
+        for i in range(genes):
+            start = rng.randint(0, length - 3000)
+            stop = start + rng.randint(100, 3000)
+            lines.append("chr%d\t%d\t%d\tG%d_%d\t0\t%s\n" %
+                         (c, start, stop, c, i, rng.choice("+-")))
+
+    return genome.read(lines, "bed", circular=["chr2"])
+
+def _random_peaks(rng, count, chromosomes=4, length=100000):
+    peaks = []
+    for i in range(count):
+        start = rng.randint(0, length - 2000)
+        # chr3 has no genes
+        peaks.append(_Peak("chr%d" % rng.randint(0, chromosomes - 1), start,
+                           start + rng.randint(0, 2000)))
+
+    return peaks
+
+def _loci(result):
+    """Makes annotate()'s sets of features comparable"""
+    return tuple(tuple(sorted(str(f) for f in part)) for part in result)
+
+class AnnotateTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.genome = _random_genome(self.rng)
+        self.peaks = _random_peaks(self.rng, 500)
+
+    def _check(self, peaks, filter_hits=True):
+        expected = [_loci(p.get_regulated_genes(self.genome, filter_hits))
+                    for p in peaks]
+        actual = [_loci(r) for r in annotate(peaks, self.genome,
+                                             filter_hits)]
+        self.assertEqual(expected, actual)
+
+    def test_matches_get_regulated_genes(self):
+        self._check(self.peaks)
+
+    def test_matches_without_filtering(self):
+        self._check(self.peaks, filter_hits=False)
+
+    def test_batches_match_one_call(self):
+        whole = [_loci(r) for r in annotate(self.peaks, self.genome)]
+        batches = []
+        for i in range(0, len(self.peaks), 7):
+            batches.extend(_loci(r) for r in
+                           annotate(self.peaks[i:i + 7], self.genome))
+
+        self.assertEqual(whole, batches)
+
+    def test_empty(self):
+        self.assertEqual(annotate([], self.genome), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for blind deconvolution of ChIP-seq coverage
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from transnet.chipseq import blind_deconvolution as bd
+from transnet.genome_coverage import DiskBasedGenomeCoverage, GenomeCoverage
+
+SHIFT = 150
+SITES = {"chrA": [3000, 20000, 45000, 70000], "chrB": [5000]}
+
+def _coverage(rng):
+    """Coverage with fragments centred on each of SITES"""
+    coverage = GenomeCoverage()
+    for sequence, length in (("chrA", 80000), ("chrB", 9000)):
+        strands = rng.poisson(0.02, size=(2, length)).astype(np.int32)
+        for site in SITES[sequence]:
+            reads = rng.normal(0, 15, size=(2, 150)).astype(int)
+            np.add.at(strands[1], site - SHIFT // 2 + reads[0], 1)
+            np.add.at(strands[0], site + SHIFT // 2 + reads[1], 1)
+        coverage._coverage[sequence] = strands
+
+    return coverage
+
+class DeconvolutionTest(unittest.TestCase):
+    def setUp(self):
+        self.coverage = _coverage(np.random.RandomState(0))
+
+    def test_combine_strands(self):
+        for shift in (SHIFT, 0, 20000):
+            whole = bd.combine_strands(self.coverage, "chrB", shift)
+            for start, stop in ((0, 10), (0, 9000), (37, 4000), (8990, 9100),
+                                (-5, 20), (5000, 5000)):
+                np.testing.assert_array_equal(
+                    bd.combine_strands(self.coverage, "chrB", shift, start,
+                                       stop),
+                    whole[max(start, 0):stop])
+
+    def test_strand_shift(self):
+        self.assertTrue(abs(bd.strand_shift(self.coverage) - SHIFT) <= 5)
+
+    def test_deconvolve(self):
+        impulses = bd.deconvolve(self.coverage, chunk_size=2 ** 14)
+        found = dict((s, []) for s in SITES)
+        for impulse in impulses:
+            found[impulse.chromosome].append(impulse.position)
+
+        for sequence, sites in SITES.items():
+            self.assertEqual(len(found[sequence]), len(sites))
+            for position, site in zip(found[sequence], sites):
+                self.assertTrue(abs(position - site) <= 10)
+
+    def test_chunk_sizes(self):
+        kernel = bd.estimate_kernel([bd.combine_strands(self.coverage, s,
+                                                        SHIFT)
+                                     for s in sorted(SITES)])
+        expected = [(i.chromosome, i.position, i.width)
+                    for i in bd.deconvolve(self.coverage, shift=SHIFT,
+                                           kernel=kernel,
+                                           chunk_size=2 ** 17)]
+        for chunk_size in (2 ** 13, 2 ** 15):
+            actual = bd.deconvolve(self.coverage, shift=SHIFT, kernel=kernel,
+                                   chunk_size=chunk_size)
+            self.assertEqual([(i.chromosome, i.position, i.width)
+                              for i in actual], expected)
+
+    def test_disk_coverage(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "coverage.cov")
+            self.coverage.save(filename)
+            disk = DiskBasedGenomeCoverage(filename)
+            expected = bd.deconvolve(self.coverage, chunk_size=2 ** 14)
+            actual = bd.deconvolve(disk, chunk_size=2 ** 14)
+            self.assertEqual([i.to_line() for i in actual],
+                             [i.to_line() for i in expected])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_call_impulses_across_chunks(self):
+        rng = np.random.RandomState(1)
+        estimate = rng.exponential(1.0, 5000) ** 3
+        expected = bd.call_impulses("chrA", estimate, 2.0, 5.0)
+        level = 2.0 * estimate.mean()
+        for size in (1, 7, 100):
+            chunks = [(start, estimate[start:start + size])
+                      for start in range(0, len(estimate), size)]
+            actual = bd._call_runs("chrA", chunks, level, 5.0)
+            self.assertEqual([(i.position, i.width) for i in actual],
+                             [(i.position, i.width) for i in expected])
+            np.testing.assert_allclose([i.strength for i in actual],
+                                       [i.strength for i in expected])
+
+if __name__ == "__main__":
+    unittest.main()
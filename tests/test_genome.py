@@ -0,0 +1,314 @@
+"""
+Tests for reading genomes and measuring expression over their exons
+"""
+import gc
+import os
+import random
+import tempfile
+import unittest
+import numpy as np
+from transnet import genome
+from transnet.chipseq.chip_peak import ChipPeak, annotate
+from transnet.genome_coverage import GenomeCoverage
+
+# Two BED12 genes, one BED6 gene and one gene with no strand
+BED = [
+    "chr1\t100\t200\tG1\t0\t+\t100\t200\t0\t2\t10,20,\t0,80,\n",
+    "chr1\t300\t400\tG2\t0\t-\t300\t400\t0\t1\t100,\t0,\n",
+    "chr1\t500\t550\tG3\t0\t-\n",
+    "chr2\t0\t9\tG4\n",
+]
+
+def _coverage():
+    coverage = GenomeCoverage()
+    chr1 = np.zeros((2, 600), dtype=np.int32)
+    chr1[1, :] = 1
+    # Just outside the exons of G1 and G2
+    chr1[0, (99, 110, 179, 200, 400)] = 1000
+    coverage._coverage["chr1"] = chr1
+    coverage._coverage["chr2"] = np.ones((2, 20), dtype=np.int32)
+    return coverage
+
+def _features_alive():
+    """Returns the number of genes and intergenic regions in memory"""
+    gc.collect()
+    return sum(1 for o in gc.get_objects()
+               if isinstance(o, (genome.Gene, genome.IntergenicRegion)))
+
+class _Peak(ChipPeak):
+    __slots__ = ()
+
+    def score(self):
+        return 0.0
+
+class ExonTest(unittest.TestCase):
+    def setUp(self):
+        self.genome = genome.read(BED, "bed")
+
+    def test_exons(self):
+        genes = dict((g.locus, g) for g in self.genome.genes)
+        # BED blocks are half-open, and exons include both ends
+        self.assertEqual(genes["G1"].get_exons(), [(100, 109), (180, 199)])
+        self.assertEqual(genes["G2"].get_exons(), [(300, 399)])
+        self.assertEqual(genes["G3"].get_exons(), [(500, 550)])
+        self.assertEqual(genes["G4"].strand, "+")
+
+    def test_exon_lengths(self):
+        lengths = dict(zip([g.locus for g in self.genome.genes],
+                           self.genome.exon_lengths().tolist()))
+        self.assertEqual(lengths, {"G1": 30, "G2": 100, "G3": 51, "G4": 10})
+
+    def test_gene_counts(self):
+        coverage = _coverage()
+        counts = dict(zip([g.locus for g in self.genome.genes],
+                          self.genome.gene_counts(coverage).tolist()))
+        self.assertEqual(counts, {"G1": 30, "G2": 100, "G3": 51, "G4": 20})
+
+        tpm = self.genome.tpm(coverage)
+        self.assertAlmostEqual(sum(tpm.values()), 1e6)
+        self.assertAlmostEqual(tpm["G1"], tpm["G2"])
+
+# Three genes on a linear and on a circular chromosome, and a circular
+# chromosome with a single gene
+TOPOLOGY_BED = [
+    "lin\t100\t200\tL1\t0\t+\n",
+    "lin\t300\t400\tL2\t0\t-\n",
+    "lin\t500\t600\tL3\t0\t+\n",
+    "circ\t100\t200\tC1\t0\t+\n",
+    "circ\t300\t400\tC2\t0\t+\n",
+    "circ\t500\t600\tC3\t0\t-\n",
+    "single\t100\t200\tS1\t0\t+\n",
+]
+
+class TopologyTest(unittest.TestCase):
+    def setUp(self):
+        self.genome = genome.read(TOPOLOGY_BED, "bed",
+                                  circular=["circ", "single"])
+
+    def _flanking(self, locus):
+        previous_gene, next_gene = self.genome.flanking_genes(
+            self.genome.gene_dict[locus])
+        return (getattr(previous_gene, "locus", None),
+                getattr(next_gene, "locus", None))
+
+    def test_read_circular(self):
+        self.assertFalse(self.genome.is_circular("lin"))
+        self.assertTrue(self.genome.is_circular("circ"))
+        self.assertTrue(self.genome.is_circular("single"))
+        # Chromosomes without genes are linear
+        self.assertFalse(self.genome.is_circular("other"))
+
+    def test_set_topology(self):
+        self.genome.set_topology("lin", genome.CIRCULAR)
+        self.assertEqual(self._flanking("L1"), ("L3", "L2"))
+        self.genome.set_topology("lin", genome.LINEAR)
+        self.assertEqual(self._flanking("L1"), (None, "L2"))
+        self.assertRaises(ValueError, self.genome.set_topology, "lin",
+                          "round")
+
+    def test_linear(self):
+        self.assertEqual(self._flanking("L1"), (None, "L2"))
+        self.assertEqual(self._flanking("L2"), ("L1", "L3"))
+        self.assertEqual(self._flanking("L3"), ("L2", None))
+
+    def test_circular(self):
+        self.assertEqual(self._flanking("C1"), ("C3", "C2"))
+        self.assertEqual(self._flanking("C2"), ("C1", "C3"))
+        self.assertEqual(self._flanking("C3"), ("C2", "C1"))
+        self.assertEqual(self._flanking("S1"), ("S1", "S1"))
+
+    def test_same_chromosome(self):
+        for g in self.genome.genes:
+            for flanking in self.genome.flanking_genes(g):
+                if flanking is not None:
+                    self.assertEqual(flanking.chromosome, g.chromosome)
+
+    def test_annotate_ends(self):
+        peaks = [_Peak("lin", 150, 160), _Peak("lin", 550, 560),
+                 _Peak("circ", 150, 160), _Peak("circ", 550, 560)]
+        results = [tuple(sorted(g.locus for g in part) for part in result)
+                   for result in annotate(peaks, self.genome)]
+
+        # (upstream, downstream, genic).  The outer side of the ends of the
+        # linear chromosome is empty; the circular chromosome wraps.
+        self.assertEqual(results, [([], ["L2"], ["L1"]),
+                                   (["L2"], [], ["L3"]),
+                                   (["C2", "C3"], [], ["C1"]),
+                                   (["C1"], ["C2"], ["C3"])])
+
+class GeneSetTest(unittest.TestCase):
+    def setUp(self):
+        # 21 genes, so the last byte of each bitset has padding bits
+        self.genome = genome.read(
+            ["chr%d\t%d\t%d\tG%02d\n" % (i % 2, i * 100, i * 100 + 50, i)
+             for i in range(21)], "bed")
+        self.loci = [g.locus for g in self.genome.genes]
+
+        rng = random.Random(0)
+        self.terms = dict(("T%d" % t, set(rng.sample(self.loci,
+                                                     rng.randint(1, 21))))
+                          for t in range(6))
+        mapping = {}
+        for t, loci in self.terms.items():
+            for locus in loci:
+                mapping.setdefault(locus, []).append(t)
+        self.genome.add_annotation("GO", mapping)
+
+    def test_annotated_genes(self):
+        self.assertEqual(self.genome.annotation_terms("GO"),
+                         sorted(self.terms))
+        for t, loci in self.terms.items():
+            genes = self.genome.annotated_genes("GO", t)
+            self.assertEqual(set(genes.loci()), loci)
+            self.assertEqual(len(genes), len(loci))
+            for locus in self.loci:
+                self.assertEqual(locus in genes, locus in loci)
+        self.assertEqual(len(self.genome.annotated_genes("GO", "none")), 0)
+
+    def test_get_annotations(self):
+        for locus in self.loci:
+            self.assertEqual(self.genome.get_annotations(locus, "GO"),
+                             sorted(t for t, loci in self.terms.items()
+                                    if locus in loci))
+
+    def test_single_terms(self):
+        self.genome.add_annotation("PFAM", {"G00": "P1", "G20": ("P1", "P2"),
+                                            "G08": ["P2"]})
+        self.assertEqual(self.genome.annotated_genes("PFAM", "P1").loci(),
+                         ["G00", "G20"])
+        self.assertEqual(self.genome.annotated_genes("PFAM", "P2").loci(),
+                         ["G08", "G20"])
+        self.assertRaises(ValueError, self.genome.add_annotation, "PFAM",
+                          {"missing": "P1"})
+
+    def test_operators(self):
+        everything = self.genome.gene_set(self.loci)
+        self.assertEqual(len(everything), 21)
+        sets = [(self.genome.annotated_genes("GO", t), loci)
+                for t, loci in sorted(self.terms.items())]
+        sets.append((everything, set(self.loci)))
+        sets.append((self.genome.gene_set([]), set()))
+        sets.append((self.genome.gene_set(self.genome.genes[-3:]),
+                     set(self.loci[-3:])))
+
+        for a, a_loci in sets:
+            for b, b_loci in sets:
+                for result, expected in ((a & b, a_loci & b_loci),
+                                         (a | b, a_loci | b_loci),
+                                         (a - b, a_loci - b_loci),
+                                         (a ^ b, a_loci ^ b_loci)):
+                    self.assertEqual(result.loci(),
+                                     [l for l in self.loci if l in expected])
+                    self.assertEqual(len(result), len(expected))
+                    self.assertEqual(sorted(result.ranks().tolist()),
+                                     [self.loci.index(l) for l in
+                                      sorted(expected,
+                                             key=self.loci.index)])
+
+        # Nothing past the last gene is ever set
+        self.assertEqual(len(everything - self.genome.gene_set(["G20"])), 20)
+
+    def test_other_genome(self):
+        other = genome.read(BED, "bed")
+        self.assertRaises(ValueError, lambda: self.genome.gene_set([]) &
+                          other.gene_set([]))
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.genome = genome.read(BED, "bed", circular=["chr2"])
+        self.genome.add_annotation("GO", {"G1": ["a", "b"], "G3": "b",
+                                          "G4": "c"})
+
+        handle, self.filename = tempfile.mkstemp(suffix=".genome")
+        os.close(handle)
+        self.genome.save(self.filename)
+        self.loaded = genome.load(self.filename)
+
+    def tearDown(self):
+        del self.loaded
+        os.remove(self.filename)
+
+    def test_genes(self):
+        def state(g):
+            return (g.chromosome, g.chrom_start, g.chrom_end, g.locus,
+                    g.strand, g.get_exons())
+
+        self.assertEqual([state(g) for g in self.loaded.genes],
+                         [state(g) for g in self.genome.genes])
+        self.assertEqual([str(r) for r in self.loaded.intergenic_regions],
+                         [str(r) for r in self.genome.intergenic_regions])
+        self.assertTrue(self.loaded.is_circular("chr2"))
+        self.assertFalse(self.loaded.is_circular("chr1"))
+        self.assertEqual(self.loaded.snapshot_file, self.filename)
+
+    def test_annotations(self):
+        self.assertEqual(self.loaded.annotation_terms("GO"), ["a", "b", "c"])
+        self.assertEqual(self.loaded.annotated_genes("GO", "b").loci(),
+                         ["G1", "G3"])
+        self.assertEqual(self.loaded.get_annotations("G4", "GO"), ["c"])
+
+    def test_annotate(self):
+        peaks = [_Peak("chr1", 150, 160), _Peak("chr1", 250, 260),
+                 _Peak("chr1", 560, 600), _Peak("chr2", 0, 5)]
+
+        def loci(results):
+            return [tuple(sorted(str(f) for f in part)) for result in results
+                    for part in result]
+
+        self.assertEqual(loci(annotate(peaks, self.loaded)),
+                         loci(annotate(peaks, self.genome)))
+
+    def test_lazy(self):
+        before = _features_alive()
+        loaded = genome.load(self.filename)
+        self.assertEqual(_features_alive(), before)
+
+        # Only the hits of a query are created
+        hits = loaded.overlapping_features(_Peak("chr1", 150, 160))
+        self.assertEqual([str(h) for h in hits], ["G1"])
+        self.assertEqual(_features_alive(), before + 1)
+        self.assertTrue(loaded.genes[0] is hits[0])
+
+        annotate([_Peak("chr1", 150, 160)], loaded)
+        self.assertLess(_features_alive(), before + len(loaded.genes))
+
+    def test_views(self):
+        # The indexes are read-only views of the snapshot
+        index = self.loaded.chromosome_features("chr1")
+        self.assertEqual(len(index), 5)
+        self.assertFalse(index.starts.flags.writeable)
+        self.assertEqual([str(f) for f in index],
+                         [str(f) for f in
+                          self.genome.chromosome_features("chr1")])
+
+    def test_loci(self):
+        self.assertEqual(sorted(self.loaded.gene_dict), ["G1", "G2", "G3",
+                                                         "G4"])
+        self.assertEqual(self.loaded.gene_rank["G3"], 2)
+        self.assertEqual(self.loaded.gene_dict["G3"].get_exons(),
+                         [(500, 550)])
+        self.assertTrue("G5" not in self.loaded.gene_dict)
+
+    def test_save_loaded(self):
+        handle, filename = tempfile.mkstemp(suffix=".genome")
+        os.close(handle)
+        try:
+            self.loaded.save(filename)
+            again = genome.load(filename)
+            self.assertEqual([str(g) for g in again.genes],
+                             [str(g) for g in self.genome.genes])
+            self.assertEqual(again.annotated_genes("GO", "b").loci(),
+                             ["G1", "G3"])
+            del again
+        finally:
+            os.remove(filename)
+
+    def test_expression(self):
+        coverage = _coverage()
+        self.assertEqual(self.loaded.exon_lengths().tolist(),
+                         self.genome.exon_lengths().tolist())
+        self.assertEqual(self.loaded.gene_counts(coverage).tolist(),
+                         self.genome.gene_counts(coverage).tolist())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+Tests for reading, saving and querying genome coverage
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from transnet.chipseq import sicer
+from transnet.genome_coverage import CoverageCache, \
+                                     DiskBasedGenomeCoverage, \
+                                     GenomeCoverage, FORWARD, REVERSE
+from transnet.parsing import MAX_NAME_LENGTH
+
+class GenomeCoverageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = random.Random(0)
+
+        self.expected = {}
+        lines = []
+        for sequence, length in (("chrI", 3000), ("chrII", 1000),
+                                 ("plasmid", 17)):
+            coverage = np.zeros((2, length), dtype=np.int32)
+            positions = sorted(rng.sample(range(length), length // 3) +
+                               [length - 1])
+            for position in positions:
+                reverse, forward = rng.randint(0, 50), rng.randint(0, 50)
+                coverage[:, position] = (reverse, forward)
+                lines.append("%s\t%d\t%d\t%d\n" % (sequence, position,
+                                                   reverse, forward))
+            self.expected[sequence] = coverage
+
+        # Interleave the sequences, so that blocks hold several
+        rng.shuffle(lines)
+        self.swig = self._write("coverage.swig", lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, lines):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as handle:
+            handle.writelines(lines)
+        return filename
+
+    def _check(self, coverage):
+        self.assertEqual(coverage.sequences(), sorted(self.expected))
+        for sequence, expected in self.expected.items():
+            self.assertEqual(coverage.get_length(sequence), expected.shape[1])
+            np.testing.assert_array_equal(
+                coverage.get_coverage_as_array(sequence), expected)
+            np.testing.assert_array_equal(
+                coverage.get_coverage_as_array(sequence, "+"),
+                expected[FORWARD])
+            np.testing.assert_array_equal(
+                coverage.get_range(sequence, 5, 12, "-"),
+                expected[REVERSE, 5:12])
+
+            length = expected.shape[1]
+            starts = np.array([-5, 0, 3, length // 2, length - 1, length + 3])
+            stops = np.array([10, length, 3, length + 10, length, length + 9])
+            sums = [int(expected[:, max(a, 0):max(b, 0)].sum())
+                    for a, b in zip(starts, stops)]
+            self.assertEqual(coverage.get_sums(sequence, starts,
+                                               stops).tolist(), sums)
+            self.assertEqual(coverage.get_sum(sequence, 0, length, "+"),
+                             int(expected[FORWARD].sum()))
+
+    def test_read(self):
+        self._check(GenomeCoverage(self.swig))
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.directory, "coverage.cov")
+        GenomeCoverage(self.swig).save(filename)
+        self._check(DiskBasedGenomeCoverage(filename))
+
+    def test_disk_sums(self):
+        # Long enough for several batches of blocks
+        rng = np.random.RandomState(0)
+        length = 2200000 + 123
+        coverage = GenomeCoverage()
+        coverage._coverage["chrI"] = rng.randint(
+            0, 100, size=(2, length)).astype(np.int32)
+        filename = os.path.join(self.directory, "long.cov")
+        coverage.save(filename)
+        disk = DiskBasedGenomeCoverage(filename)
+
+        starts = rng.randint(-10, length + 10, size=5000)
+        stops = starts + rng.randint(0, 100000, size=5000)
+        starts[:3] = (0, length - 1, length)
+        stops[:3] = (length, length, length + 1)
+        for strand in (None, "+", "-"):
+            np.testing.assert_array_equal(
+                disk.get_sums("chrI", starts, stops, strand),
+                coverage.get_sums("chrI", starts, stops, strand))
+
+    def test_get_coverage(self):
+        coverage = GenomeCoverage(self.swig)
+        expected = self.expected["chrII"]
+        self.assertEqual(coverage.get_coverage("chrII", 999),
+                         (int(expected[REVERSE, 999]),
+                          int(expected[FORWARD, 999])))
+        self.assertEqual(coverage.get_coverage("chrII", 1000), (0, 0))
+        self.assertEqual(coverage.get_coverage("chrII", -1), (0, 0))
+
+    def test_long_names(self):
+        name = "chr" + "x" * MAX_NAME_LENGTH
+        swig = self._write("long.swig", ["%s\t1\t2\t3\n" % name])
+        self.assertRaises(ValueError, GenomeCoverage, swig)
+        self.assertRaises(ValueError, sicer.read_table,
+                          ["%s\t1\t2\t3\t4\t0.5\t2.0\t0.1\n" % name])
+
+        # Names just short of the limit are read in full
+        name = "x" * (MAX_NAME_LENGTH - 1)
+        swig = self._write("long.swig", ["%s\t1\t2\t3\n" % name])
+        self.assertEqual(GenomeCoverage(swig).sequences(), [name])
+
+class CoverageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = CoverageCache(os.path.join(self.directory, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, depth):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as handle:
+            handle.write("chrI\t%d\t%d\t%d\n" % (999, depth, depth + 1))
+        return filename
+
+    def _age(self):
+        # Make every entry older than anything used from now on
+        for data_file in self.cache._entries():
+            os.utime(data_file, (1, 1))
+
+    def test_hit(self):
+        swig = self._write("a.swig", 5)
+        coverage = self.cache.load(swig)
+        self.assertFalse(isinstance(coverage, DiskBasedGenomeCoverage))
+        self.assertEqual(len(self.cache._entries()), 1)
+
+        cached = self.cache.load(swig)
+        self.assertTrue(isinstance(cached, DiskBasedGenomeCoverage))
+        self.assertEqual(cached.get_coverage("chrI", 999), (5, 6))
+        self.assertEqual(cached.get_length("chrI"), 1000)
+
+    def test_changed_content(self):
+        swig = self._write("a.swig", 5)
+        self.cache.load(swig)
+        stat = os.stat(swig)
+
+        # Same size and modification time, so only the hash differs
+        self._write("a.swig", 7)
+        os.utime(swig, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(os.path.getsize(swig), stat.st_size)
+
+        coverage = self.cache.load(swig)
+        self.assertFalse(isinstance(coverage, DiskBasedGenomeCoverage))
+        self.assertEqual(coverage.get_coverage("chrI", 999), (7, 8))
+        cached = self.cache.load(swig)
+        self.assertTrue(isinstance(cached, DiskBasedGenomeCoverage))
+        self.assertEqual(cached.get_coverage("chrI", 999), (7, 8))
+
+    def test_eviction(self):
+        first, second, third = [self._write(name, 5)
+                                for name in ("a.swig", "b.swig", "c.swig")]
+        self.cache.load(first)
+        entry_size = self.cache.size()
+        self.cache.max_size = 2 * entry_size + entry_size // 2
+
+        self.cache.load(second)
+        self.assertEqual(self.cache.size(), 2 * entry_size)
+
+        # Using the first entry leaves the second least recently used
+        self._age()
+        self.assertTrue(isinstance(self.cache.load(first),
+                                   DiskBasedGenomeCoverage))
+        self.cache.load(third)
+        self.assertEqual(self.cache.size(), 2 * entry_size)
+
+        self.assertTrue(isinstance(self.cache.load(first),
+                                   DiskBasedGenomeCoverage))
+        self.assertTrue(isinstance(self.cache.load(third),
+                                   DiskBasedGenomeCoverage))
+        self.assertFalse(isinstance(self.cache.load(second),
+                                    DiskBasedGenomeCoverage))
+
+        self.cache.clear()
+        self.assertEqual(self.cache.size(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
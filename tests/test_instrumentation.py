@@ -0,0 +1,61 @@
+"""
+Tests for the memory figures of stages
+"""
+import threading
+import unittest
+from transnet import instrumentation
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZE = 10 * 2**20
+
+@unittest.skipIf(tracemalloc is None or
+                 not hasattr(tracemalloc, "reset_peak"),
+                 "needs tracemalloc.reset_peak (Python 3.9+)")
+class StageMemoryTest(unittest.TestCase):
+    def setUp(self):
+        instrumentation.reset()
+        instrumentation.enable()
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def test_nested(self):
+        with instrumentation.stage("outer") as outer:
+            with instrumentation.stage("inner") as inner:
+                data = bytearray(SIZE)
+                del data
+
+        self.assertGreaterEqual(inner.peak_memory, SIZE // 2)
+        self.assertGreaterEqual(outer.peak_memory, SIZE // 2)
+
+    def test_other_thread(self):
+        # A stage starting in this thread must not reset the peak of one
+        # still running in another
+        allocated = threading.Event()
+        started = threading.Event()
+        stages = []
+
+        def run():
+            with instrumentation.stage("thread") as s:
+                data = bytearray(SIZE)
+                del data
+                allocated.set()
+                started.wait()
+            stages.append(s)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        allocated.wait()
+        with instrumentation.stage("main"):
+            started.set()
+            thread.join()
+
+        self.assertGreaterEqual(stages[0].peak_memory, SIZE // 2)
+
+if __name__ == "__main__":
+    unittest.main()
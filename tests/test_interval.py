@@ -0,0 +1,55 @@
+"""
+Tests that intervals keep their chromosomes when pickled between processes
+"""
+import os
+import pickle
+import subprocess
+import sys
+import unittest
+from transnet.chipseq.sicer import SicerRBPeak
+from transnet.genome import Gene
+from transnet.interval import Interval, chromosome_code
+
+# Interns the chromosome names in the opposite order to this process, then
+# unpickles intervals from standard input and describes them
+_CHILD = """
+import pickle, sys
+from transnet.interval import chromosome_code, chromosome_name
+for name in ("pickle.other", "pickle.3", "pickle.2", "pickle.1"):
+    chromosome_code(name)
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+for i in pickle.load(stdin):
+    print(repr((type(i).__name__, i.chromosome,
+                chromosome_name(i.chrom_code) == i.chromosome,
+                i.chrom_start, i.chrom_end, str(i))))
+"""
+
+def _describe(interval):
+    return repr((type(interval).__name__, interval.chromosome, True,
+                 interval.chrom_start, interval.chrom_end, str(interval)))
+
+class PickleTest(unittest.TestCase):
+    def test_other_chromosome_table(self):
+        for name in ("pickle.1", "pickle.2", "pickle.3"):
+            chromosome_code(name)
+
+        intervals = [Interval("pickle.1", 5, 10),
+                     Gene("pickle.2", 100, 200, "G1", "-",
+                          [(100, 120), (150, 200)]),
+                     SicerRBPeak("pickle.3 10 20 2.5\n")]
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [p for p in [env.get("PYTHONPATH")] if p])
+        child = subprocess.Popen([sys.executable, "-c", _CHILD],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, env=env)
+        output = child.communicate(pickle.dumps(intervals, 2))[0]
+        self.assertEqual(child.returncode, 0)
+
+        self.assertEqual(output.decode("utf-8").splitlines(),
+                         [_describe(i) for i in intervals])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,308 @@
+"""
+Tests for reading LOX output and its p-values
+"""
+import math
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from transnet.transcriptomics import lox
+
+HEADER = "Gene\tLength\tA\tB\tA.lower\tB.lower\tA.upper\tB.upper\n"
+
+# The p-value file lists its genes in its own order, with one gene that is
+# not in the LOX output
+PVALUES = {"g1": (0.01, 0.99), "g2": (0.5, 0.5), "g3": (0.2, 0.8),
+           "extra": (0.3, 0.7)}
+PVALUE_ORDER = ["g3", "extra", "g1", "g2"]
+
+EXPERIMENTS = ["A", "B", "C"]
+
+def _write_lox(filename, loci, rng):
+    """Writes a LOX output with random levels, returning its rows"""
+    rows = {}
+    with open(filename, "w") as handle:
+        handle.write("Gene\tLength\t%s\t%s\t%s\n" % (
+            "\t".join(EXPERIMENTS),
+            "\t".join(e + ".lower" for e in EXPERIMENTS),
+            "\t".join(e + ".upper" for e in EXPERIMENTS)))
+        for locus in loci:
+            levels = rng.uniform(0, 100, size=len(EXPERIMENTS)).round(3)
+            # Some levels are zero, and are taken to be 0.01 in ratios
+            levels[rng.uniform(size=len(EXPERIMENTS)) < 0.1] = 0
+            values = np.concatenate((levels, levels * 0.8, levels * 1.2))
+            rows[locus] = values
+            handle.write("%s\t100\t%s\n" % (
+                locus, "\t".join(repr(float(v)) for v in values)))
+
+    return rows
+
+class MeasurementTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.loci = ["g%d" % i for i in range(50)]
+        self.lox_file = os.path.join(self.directory, "run.lox")
+        self.rows = _write_lox(self.lox_file, self.loci,
+                               np.random.RandomState(0))
+        self.experiment = lox.read(self.lox_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_measurements(self):
+        experiment = self.experiment
+        self.assertEqual(experiment.experiments, EXPERIMENTS)
+        self.assertEqual(experiment.loci, self.loci)
+        self.assertEqual(experiment.values.shape, (50, 3, 3))
+
+        # Each measurement holds the level and bounds of its own column
+        count = len(EXPERIMENTS)
+        for i, measurements in enumerate(experiment.measurements):
+            self.assertEqual(sorted(measurements), sorted(self.loci))
+            for locus, row in self.rows.items():
+                measurement = measurements[locus]
+                self.assertEqual(measurement.expression_level, row[i])
+                self.assertEqual(measurement.lower_confidence,
+                                 row[i + count])
+                self.assertEqual(measurement.upper_confidence,
+                                 row[i + 2 * count])
+            np.testing.assert_array_equal(
+                measurements.levels, [self.rows[l][i] for l in self.loci])
+
+        self.assertEqual(experiment["B"]["g3"].expression_level,
+                         self.rows["g3"][1])
+        self.assertFalse("missing" in experiment["B"])
+        self.assertRaises(KeyError, lambda: experiment["B"]["missing"])
+
+    def test_views(self):
+        # Measurements are views, so changes reach the experiment
+        measurement = self.experiment["C"]["g7"]
+        measurement.expression_level = 42.0
+        self.assertEqual(self.experiment.values[7, 2, lox.LEVEL], 42.0)
+        self.assertEqual(self.experiment["C"]["g7"].expression_level, 42.0)
+
+        measurement.scale(2.0)
+        self.assertEqual(self.experiment["C"]["g7"].upper_confidence,
+                         self.rows["g7"][8] * 2.0)
+        self.assertEqual(self.experiment["B"]["g7"].expression_level,
+                         self.rows["g7"][1])
+
+    def test_scale(self):
+        rpkms = {"missing": 5.0}
+        ratios = []
+        for i, locus in enumerate(self.loci[:21]):
+            rpkms[locus] = float(i)
+            level = self.rows[locus][1]
+            if i > 0 and level > 0:
+                ratios.append(i / level)
+        before = self.experiment.values.copy()
+
+        multiplier = self.experiment.scale(rpkms, "B")
+        self.assertAlmostEqual(multiplier, float(np.median(ratios)))
+        np.testing.assert_allclose(self.experiment.values,
+                                   before * multiplier)
+
+        self.assertRaises(ValueError, self.experiment.scale,
+                          {"missing": 5.0})
+
+def _baseline_diff_expressed(rows, pvalues, first, second, min_change,
+                             threshold):
+    """Differential expression as it was found one locus at a time"""
+    idx_1 = EXPERIMENTS.index(first)
+    idx_2 = EXPERIMENTS.index(second)
+    diff_expressed = set()
+    for locus, row in rows.items():
+        level_1 = row[idx_1] or 0.01
+        level_2 = row[idx_2] or 0.01
+        ratio = math.fabs(math.log(level_1 / level_2, 2))
+        pval = pvalues[(first, second, locus)]
+        if (pval <= threshold or 1.0 - pval <= threshold) and \
+           ratio > min_change:
+            diff_expressed.add((locus, pval, ratio))
+
+    return diff_expressed
+
+class DiffExpressionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        self.loci = ["g%d" % i for i in range(200)]
+        self.lox_file = os.path.join(self.directory, "run.lox")
+        self.rows = _write_lox(self.lox_file, self.loci, rng)
+
+        # Each experiment has a file of p-values against the others
+        self.pvalues = {}
+        for first in EXPERIMENTS:
+            others = [e for e in EXPERIMENTS if e != first]
+            filename = os.path.join(self.directory, "run.%s.pvalue" % first)
+            with open(filename, "w") as handle:
+                handle.write("Gene\tLength\t%s\n" % "\t".join(
+                    "P(%s>%s)" % (first, e) for e in others))
+                for locus in self.loci:
+                    pvals = rng.beta(0.3, 0.3, size=len(others)).round(6)
+                    for second, pval in zip(others, pvals):
+                        self.pvalues[(first, second, locus)] = float(pval)
+                    handle.write("%s\t100\t%s\n" % (
+                        locus, "\t".join(repr(float(p)) for p in pvals)))
+
+        self.experiment = lox.read(self.lox_file, read_pvals=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_diff_expressed(self):
+        for first, second, _ in self.pvalues:
+            actual = self.experiment.get_diff_expressed(first, second,
+                                                        1.0, 0.05)
+            expected = _baseline_diff_expressed(self.rows, self.pvalues,
+                                                first, second, 1.0, 0.05)
+            self.assertTrue(len(expected) > 0)
+            self.assertEqual(set((l, p) for l, p, _ in actual),
+                             set((l, p) for l, p, _ in expected))
+            ratios = dict((l, r) for l, _, r in expected)
+            for locus, _, ratio in actual:
+                self.assertAlmostEqual(ratio, ratios[locus])
+
+        self.assertRaises(KeyError, self.experiment.get_diff_expressed,
+                          "A", "D", 1.0, 0.05)
+
+    def test_diff_expression(self):
+        results = self.experiment.diff_expression(min_change=1.0,
+                                                  threshold=0.05)
+        found = set((self.experiment.experiments[r["experiment_1"]],
+                     self.experiment.experiments[r["experiment_2"]],
+                     self.loci[r["gene"]]) for r in results)
+        expected = set()
+        for first, second in self.experiment.pvalue_pairs():
+            expected.update((first, second, locus) for locus, _, _ in
+                            _baseline_diff_expressed(
+                                self.rows, self.pvalues, first, second,
+                                1.0, 0.05))
+        self.assertEqual(found, expected)
+
+    def test_processes(self):
+        serial = self.experiment.diff_expression(min_change=0.5,
+                                                 threshold=0.1)
+        parallel = self.experiment.diff_expression(min_change=0.5,
+                                                   threshold=0.1,
+                                                   processes=2)
+        self.assertTrue(len(serial) > 0)
+        self.assertEqual(parallel.dtype, serial.dtype)
+        self.assertEqual(parallel.tolist(), serial.tolist())
+
+    def test_missing_pvalues(self):
+        # A p-value file lacking a gene
+        filename = os.path.join(self.directory, "run.A.pvalue")
+        with open(filename) as handle:
+            lines = handle.readlines()
+        with open(filename, "w") as handle:
+            handle.writelines(line for line in lines
+                              if not line.startswith("g5\t"))
+        experiment = lox.read(self.lox_file, read_pvals=True)
+
+        self.assertRaises(KeyError, experiment.get_pval, "A", "B", "g5")
+        self.assertRaises(KeyError, experiment.get_diff_expressed,
+                          "A", "B", 0.0, 1.0)
+
+        # Finding many pairs at once skips the gene for those pairs
+        results = experiment.diff_expression(min_change=0.0, threshold=1.0)
+        pairs = set((experiment.experiments[r["experiment_1"]],
+                     experiment.experiments[r["experiment_2"]])
+                    for r in results
+                    if experiment.loci[r["gene"]] == "g5")
+        self.assertEqual(pairs, set([("B", "A"), ("B", "C"), ("C", "A"),
+                                     ("C", "B")]))
+
+class PValueCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Each experiment has a file of p-values against the others
+        for column, (first, second) in enumerate((("A", "B"), ("B", "A"))):
+            filename = os.path.join(self.directory, "run.%s.pvalue" % first)
+            with open(filename, "w") as handle:
+                handle.write("Gene\tLength\tP(%s>%s)\n" % (first, second))
+                for locus in PVALUE_ORDER:
+                    handle.write("%s\t100\t%r\n" %
+                                 (locus, PVALUES[locus][column]))
+        self.pvalue_file = os.path.join(self.directory, "run.A.pvalue")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, loci, cache=True):
+        lox_file = os.path.join(self.directory, "run.lox")
+        with open(lox_file, "w") as handle:
+            handle.write(HEADER)
+            for i, locus in enumerate(loci):
+                handle.write("%s\t100\t%d\t%d\t0\t0\t10\t10\n" %
+                             (locus, i + 1, 2 * i + 1))
+
+        return lox.read(lox_file, read_pvals=True, cache=cache)
+
+    def _check(self, experiment):
+        self.assertEqual(experiment.pvalue_pairs(), [("A", "B"), ("B", "A")])
+        for locus in experiment.loci:
+            self.assertEqual(experiment.get_pval("A", "B", locus),
+                             PVALUES[locus][0])
+            self.assertEqual(experiment.get_pval("B", "A", locus),
+                             PVALUES[locus][1])
+        self.assertEqual(len(experiment.pvalues),
+                         2 * len(experiment.loci))
+
+    def test_without_cache(self):
+        self._check(self._read(["g1", "g2", "g3"], cache=False))
+        self.assertFalse(os.path.exists(self.pvalue_file + ".npy"))
+
+    def test_cache(self):
+        self._check(self._read(["g1", "g2", "g3"]))
+        self.assertTrue(os.path.exists(self.pvalue_file + ".npy"))
+        self._check(self._read(["g1", "g2", "g3"]))
+
+    def test_cache_with_other_loci(self):
+        # The cache is written for one LOX output and read for another
+        # with the same number of genes in a different order
+        self._check(self._read(["g1", "g2", "g3"]))
+        self._check(self._read(["g3", "g1", "g2"]))
+        self._check(self._read(["g2", "g1"]))
+
+    def test_stale_cache(self):
+        self._check(self._read(["g1", "g2", "g3"]))
+        stat = os.stat(self.pvalue_file)
+
+        # A file restored with an older time, but different p-values, is
+        # read again rather than served from the newer cache
+        PVALUES["g1"] = (0.125, 0.99)
+        try:
+            with open(self.pvalue_file, "w") as handle:
+                handle.write("Gene\tLength\tP(A>B)\n")
+                for locus in PVALUE_ORDER:
+                    handle.write("%s\t100\t%r\n" %
+                                 (locus, PVALUES[locus][0]))
+            os.utime(self.pvalue_file, (stat.st_atime, stat.st_mtime - 60))
+            self.assertNotEqual(os.path.getsize(self.pvalue_file),
+                                stat.st_size)
+            self._check(self._read(["g1", "g2", "g3"]))
+
+            # And with the same size but another time
+            PVALUES["g1"] = (0.5, 0.99)
+            with open(self.pvalue_file, "w") as handle:
+                handle.write("Gene\tLength\tP(A>B)\n")
+                for locus in PVALUE_ORDER:
+                    handle.write("%s\t100\t%r\n" %
+                                 (locus, PVALUES[locus][0]))
+            os.utime(self.pvalue_file, (stat.st_atime, stat.st_mtime - 120))
+            self._check(self._read(["g1", "g2", "g3"]))
+        finally:
+            PVALUES["g1"] = (0.01, 0.99)
+
+    def test_cache_in_file_order(self):
+        self._check(self._read(PVALUE_ORDER[:1] + PVALUE_ORDER[2:]))
+        experiment = self._read(PVALUE_ORDER)
+        self._check(experiment)
+        # Loci in the file's own order use the mapped cache as it is
+        self.assertTrue(isinstance(experiment.pvalues._load(
+            self.pvalue_file), np.memmap))
+
+if __name__ == "__main__":
+    unittest.main()
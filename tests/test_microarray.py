@@ -0,0 +1,129 @@
+"""
+Tests for storing microarray compendia in memory-mapped files
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from transnet.transcriptomics import microarray
+
+GENES = ["g%d" % i for i in range(7)]
+
+class CompendiumTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), "compendium")
+        rng = np.random.RandomState(0)
+        self.columns = rng.normal(size=(5, len(GENES))).astype(np.float32)
+
+        self.compendium = microarray.create(self.directory, GENES)
+        for i, column in enumerate(self.columns):
+            self.compendium.add_condition("c%d" % i, column)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def _expression_file(self):
+        return os.path.join(self.directory, "expression.f32")
+
+    def test_create(self):
+        empty = microarray.create(os.path.join(self.directory, "empty"),
+                                  GENES)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.matrix.shape, (len(GENES), 0))
+        self.assertEqual(microarray.read(empty.directory).genes, GENES)
+
+        self.assertRaises(ValueError, microarray.create, self.directory,
+                          GENES)
+        self.assertRaises(ValueError, microarray.create,
+                          os.path.join(self.directory, "other"),
+                          ["a\nb"])
+
+    def test_read(self):
+        compendium = microarray.read(self.directory)
+        self.assertEqual(compendium.genes, GENES)
+        self.assertEqual(compendium.conditions,
+                         ["c%d" % i for i in range(5)])
+        np.testing.assert_array_equal(compendium.matrix, self.columns.T)
+
+        self.assertEqual(compendium["c3"]["g2"], float(self.columns[3, 2]))
+        self.assertEqual(sorted(compendium["c3"]), sorted(GENES))
+        self.assertFalse("missing" in compendium["c3"])
+        np.testing.assert_array_equal(compendium.gene("g4"),
+                                      self.columns[:, 4])
+        np.testing.assert_array_equal(compendium.rows(["g5", "g1"]),
+                                      self.columns[:, [5, 1]].T)
+        np.testing.assert_array_equal(compendium.columns(["c4", "c0"]),
+                                      self.columns[[4, 0]].T)
+
+    def test_mismatched_files(self):
+        with open(self._expression_file(), "ab") as handle:
+            handle.write(b"\0\0\0\0")
+        self.assertRaises(ValueError, microarray.read, self.directory)
+
+    def test_append(self):
+        stat = os.stat(self._expression_file())
+        with open(self._expression_file(), "rb") as handle:
+            before = handle.read()
+        matrix = self.compendium.matrix
+
+        values = np.arange(len(GENES), dtype=np.float32)
+        self.compendium.add_condition("added", values)
+
+        # The new column is appended to the same file, after the old ones
+        after_stat = os.stat(self._expression_file())
+        self.assertEqual(after_stat.st_ino, stat.st_ino)
+        self.assertEqual(after_stat.st_size, stat.st_size + 4 * len(GENES))
+        with open(self._expression_file(), "rb") as handle:
+            self.assertEqual(handle.read(len(before)), before)
+
+        self.assertEqual(matrix.shape, (len(GENES), 5))
+        self.assertEqual(self.compendium.matrix.shape, (len(GENES), 6))
+        np.testing.assert_array_equal(self.compendium["added"].values, values)
+        self.assertEqual(microarray.read(self.directory).conditions[-1],
+                         "added")
+
+        self.assertRaises(ValueError, self.compendium.add_condition,
+                          "added", values)
+        self.assertRaises(ValueError, self.compendium.add_condition,
+                          "short", values[:-1])
+
+    def test_missing_genes(self):
+        self.compendium.add_condition("partial", {"g1": 1.5, "g6": -2.0})
+        values = microarray.read(self.directory)["partial"].values
+        self.assertEqual(values[1], 1.5)
+        self.assertEqual(values[6], -2.0)
+        self.assertTrue(np.isnan(values[[0, 2, 3, 4, 5]]).all())
+
+        self.assertRaises(KeyError, self.compendium.add_condition,
+                          "unknown", {"missing": 1.0})
+
+    def test_iter_chunks(self):
+        chunks = list(self.compendium.iter_chunks(size=3))
+        self.assertEqual([names for names, _ in chunks],
+                         [GENES[0:3], GENES[3:6], GENES[6:]])
+        np.testing.assert_array_equal(
+            np.concatenate([block for _, block in chunks]), self.columns.T)
+
+        chunks = list(self.compendium.iter_chunks(size=2, axis=1))
+        self.assertEqual([names for names, _ in chunks],
+                         [["c0", "c1"], ["c2", "c3"], ["c4"]])
+        np.testing.assert_array_equal(
+            np.concatenate([block for _, block in chunks], axis=1),
+            self.columns.T)
+
+        self.assertRaises(ValueError, list,
+                          self.compendium.iter_chunks(axis=2))
+
+    def test_expression_matrix(self):
+        genes, conditions, matrix = self.compendium.expression_matrix()
+        self.assertEqual(genes, GENES)
+        self.assertEqual(conditions, ["c%d" % i for i in range(5)])
+        np.testing.assert_array_equal(matrix, self.columns.T)
+
+        # The names are copies
+        genes.append("extra")
+        self.assertEqual(self.compendium.genes, GENES)
+
+if __name__ == "__main__":
+    unittest.main()
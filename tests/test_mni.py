@@ -0,0 +1,102 @@
+"""
+Tests for inferring networks with the MNI algorithm
+"""
+import unittest
+import numpy as np
+from transnet.inference import mni
+
+class _Compendium(object):
+    """An expression compendium held as a matrix"""
+    def __init__(self, genes, conditions, expression):
+        self.genes = genes
+        self.conditions = conditions
+        self.expression = expression
+
+    def expression_matrix(self):
+        return self.genes, self.conditions, self.expression
+
+# Each target gene is driven by one regulator with the given weight
+PLANTED = {"t0": ("r0", 2.0), "t1": ("r1", -1.5), "t2": ("r2", 0.5),
+           "t3": ("r3", 3.0), "t4": ("r5", -0.75), "t5": ("r4", 1.0)}
+
+class MNITest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.genes = ["r%d" % i for i in range(6)] + sorted(PLANTED)
+        self.conditions = ["c%d" % i for i in range(40)]
+
+        expression = np.zeros((len(self.genes), len(self.conditions)))
+        expression[:6] = rng.normal(size=(6, len(self.conditions)))
+        for target, (regulator, weight) in PLANTED.items():
+            expression[self.genes.index(target)] = \
+                weight * expression[self.genes.index(regulator)] + \
+                rng.normal(scale=0.01, size=len(self.conditions))
+
+        # Condition c7 perturbs t2 directly
+        expression[self.genes.index("t2"), 7] += 5.0
+        self.expression = expression
+
+    def _fit(self, expression=None, **kwargs):
+        if expression is None:
+            expression = self.expression
+        return mni.infer(_Compendium(self.genes, self.conditions,
+                                     expression), regulators=1, **kwargs)
+
+    def _check_network(self, network):
+        for target, (regulator, weight) in PLANTED.items():
+            i = self.genes.index(target)
+            self.assertEqual(network.genes[network.regulators[i, 0]],
+                             regulator)
+            self.assertAlmostEqual(network.weights[i, 0], weight, places=1)
+
+    def test_recovery(self):
+        network = self._fit()
+        self._check_network(network)
+        self.assertEqual(network.predicted_targets("c7", 1)[0][0], "t2")
+        weight = network.weights[self.genes.index("t3"), 0]
+        self.assertTrue(("r3", "t3", weight) in network.interactions(1.0))
+
+        matrix = network.network()
+        self.assertEqual(matrix.shape, (12, 12))
+        self.assertEqual(matrix[self.genes.index("t1"),
+                                self.genes.index("r1")],
+                         network.weights[self.genes.index("t1"), 0])
+
+    def test_processes(self):
+        serial = self._fit(block_size=3)
+        parallel = self._fit(block_size=3, processes=2)
+        np.testing.assert_array_equal(parallel.regulators, serial.regulators)
+        np.testing.assert_array_equal(parallel.weights, serial.weights)
+        np.testing.assert_array_equal(parallel.perturbations,
+                                      serial.perturbations)
+
+    def test_missing(self):
+        expression = self.expression.copy()
+        # r2 and t0 were not measured in some conditions
+        expression[self.genes.index("r2"), [3, 11]] = np.nan
+        expression[self.genes.index("t0"), 20] = np.nan
+        network = self._fit(expression)
+
+        self.assertTrue(np.isfinite(network.weights).all())
+        self._check_network(network)
+        self.assertEqual(network.predicted_targets("c7", 1)[0][0], "t2")
+
+        # Only the genes fit on a missing measurement lack its z-score
+        missing = np.isnan(network.perturbations)
+        self.assertTrue(missing[self.genes.index("t2"), 3])
+        self.assertTrue(missing[self.genes.index("t0"), 20])
+        self.assertFalse(missing[self.genes.index("t1"), 3])
+        self.assertFalse(missing[:, 7].any())
+
+        # Missing values are ignored rather than taken as measurements
+        complete = self._fit()
+        self.assertAlmostEqual(network.weights[self.genes.index("t2"), 0],
+                               complete.weights[self.genes.index("t2"), 0],
+                               places=2)
+
+    def test_too_few_genes(self):
+        self.assertRaises(ValueError, mni.infer,
+                          _Compendium(["g"], ["c"], np.zeros((1, 1))))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests for the pools of worker processes shared by the parallel stages
+"""
+import os
+import unittest
+from transnet import parallel
+
+def _init_worker(offset):
+    parallel.state["offset"] = offset
+
+def _worker(value):
+    return value + parallel.state["offset"], os.getpid()
+
+def _failing_worker(value):
+    raise ValueError(value)
+
+class PoolTest(unittest.TestCase):
+    def test_processes(self):
+        parallel.state["offset"] = -1
+        with parallel.pool(2, _init_worker, (10,)) as workers:
+            results = workers.map(_worker, range(8), chunksize=1)
+            result = workers.apply_async(_worker, (5,)).get()
+
+        self.assertEqual([r[0] for r in results], list(range(10, 18)))
+        self.assertEqual(result[0], 15)
+        self.assertFalse(os.getpid() in [r[1] for r in results])
+        # Only the workers were set up
+        self.assertEqual(parallel.state, {"offset": -1})
+        parallel.state.clear()
+
+    def test_serial(self):
+        parallel.state["outer"] = True
+        for processes in (None, 0, 1):
+            with parallel.pool(processes, _init_worker, (10,)) as workers:
+                self.assertEqual(parallel.state, {"offset": 10})
+                results = workers.map(_worker, range(3))
+                result = workers.apply_async(_worker, (5,)).get()
+
+            self.assertEqual(results, [(i + 10, os.getpid())
+                                       for i in range(3)])
+            self.assertEqual(result, (15, os.getpid()))
+            # The state from before the pool is restored
+            self.assertEqual(parallel.state, {"outer": True})
+        parallel.state.clear()
+
+    def test_errors(self):
+        for processes in (1, 2):
+            with self.assertRaises(ValueError):
+                with parallel.pool(processes, _init_worker,
+                                   (10,)) as workers:
+                    workers.map(_failing_worker, range(3))
+            self.assertEqual(parallel.state, {})
+
+if __name__ == "__main__":
+    unittest.main()
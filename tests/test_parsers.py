@@ -0,0 +1,118 @@
+"""
+Tests that the block readers (read_table) agree with the line readers
+(read) for each peak format
+"""
+import random
+import unittest
+import numpy as np
+from transnet import parsing
+from transnet.chipseq import log_normal, poisson, sicer
+from transnet.interval import _slots
+
+def _state(peak):
+    """Returns the type and every attribute of a peak"""
+    return (type(peak).__name__,) + tuple(
+        (name, getattr(peak, name, None)) for name in _slots(type(peak))
+        if name != "chrom_code") + (("chromosome", peak.chromosome),)
+
+class ReadTableTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def _positions(self):
+        start = self.rng.randint(1, 10 ** 9)
+        return start, start + self.rng.randint(0, 5000)
+
+    def _sicer_lines(self, count):
+        lines = []
+        for i in range(count):
+            start, stop = self._positions()
+            lines.append("chr%d\t%d\t%d\t%d\t%d\t%r\t%r\t%r\n" % (
+                self.rng.randint(1, 3), start, stop, self.rng.randint(0, 500),
+                self.rng.randint(0, 500), self.rng.random(),
+                self.rng.uniform(0, 50), self.rng.random()))
+        return lines
+
+    def _sicer_rb_lines(self, count):
+        lines = []
+        for i in range(count):
+            start, stop = self._positions()
+            lines.append("chr%d %d %d %r\n" % (self.rng.randint(1, 3), start,
+                                               stop, self.rng.uniform(0, 50)))
+        return lines
+
+    def _poisson_lines(self, count):
+        lines = []
+        for i in range(count):
+            start, stop = self._positions()
+            lines.append("%d\t%d\t%d\t%r\t%d\n" % (
+                start, stop, self.rng.randint(0, 500), self.rng.random(),
+                self.rng.randint(-100, 100)))
+        return lines
+
+    def _log_normal_lines(self, count):
+        lines = []
+        for i in range(count):
+            start, stop = self._positions()
+            lines.append("%d\t%d\t%d\tx\t%d\n" % (
+                start, stop, self.rng.randint(0, 500),
+                self.rng.randint(-100, 100)))
+        return lines
+
+    def _check(self, read, read_table, lines, *args):
+        expected = [_state(p) for p in read(lines, *args)]
+        for batch_size in (len(lines) + 1, 7):
+            table = read_table(lines, *args, batch_size=batch_size)
+            self.assertEqual(len(table), len(lines))
+            self.assertEqual([_state(p) for p in table], expected)
+
+    def test_sicer(self):
+        self._check(sicer.read, sicer.read_table, self._sicer_lines(50),
+                    "sicer")
+
+    def test_sicer_rb(self):
+        self._check(sicer.read, sicer.read_table, self._sicer_rb_lines(50),
+                    "sicer_rb")
+
+    def test_poisson(self):
+        self._check(poisson.read, poisson.read_table,
+                    self._poisson_lines(50), "chrX")
+
+    def test_log_normal(self):
+        self._check(log_normal.read, log_normal.read_table,
+                    self._log_normal_lines(50), "chrX")
+
+    def test_scores(self):
+        lines = self._sicer_lines(20)
+        table = sicer.read_table(lines)
+        self.assertEqual(table.scores.tolist(),
+                         [p.score() for p in sicer.read(lines)])
+
+    def test_empty(self):
+        self.assertEqual(len(sicer.read_table([])), 0)
+        self.assertEqual(len(sicer.read_table([], "sicer_rb")), 0)
+        self.assertEqual(len(poisson.read_table([])), 0)
+        self.assertEqual(len(log_normal.read_table([])), 0)
+
+class ParseBlocksTest(unittest.TestCase):
+    FIELDS = np.dtype([("start", np.int64), ("score", np.float64)])
+
+    def _read(self, lines, batch_size):
+        blocks = list(parsing.parse_blocks(lines, self.FIELDS, batch_size))
+        self.assertTrue(all(len(b) for b in blocks))
+        return [tuple(r) for b in blocks for r in b.tolist()]
+
+    def test_blank_lines(self):
+        # Empty strings can come from iterables other than files, and the
+        # last lines of a file are often blank
+        lines = ["1\t0.5\n", "\n", "", "2\t1.5\n", "  \t\n", "", "\n",
+                 "\r\n", "3\t2.5\n", "\n", "", "\n"]
+        for batch_size in (1, 2, 3, len(lines)):
+            self.assertEqual(self._read(lines, batch_size),
+                             [(1, 0.5), (2, 1.5), (3, 2.5)])
+
+    def test_only_blank_lines(self):
+        self.assertEqual(self._read(["", "\n", " \n"], 2), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Tests that the streaming pipeline writes the same summaries as
+write_text_summary
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from transnet import genome
+from transnet.chipseq import pipeline, sicer
+from transnet.chipseq.summary import write_text_summary
+
+def _genome_lines(rng, chromosomes=2, genes=200, length=200000):
+    # Genes are long and dense, so most peaks hit several of them
+    lines = []
+    for c in range(chromosomes):
+        for i in range(genes):
+            start = rng.randint(0, length - 5000)
+            stop = start + rng.randint(500, 5000)
+            lines.append("chr%d\t%d\t%d\tG%d_%d\t0\t%s\n" %
+                         (c, start, stop, c, i, rng.choice("+-")))
+    return lines
+
+def _sicer_lines(rng, count, chromosomes=2, length=200000):
+    lines = []
+    for i in range(count):
+        start = rng.randint(1, length - 2000)
+        lines.append("chr%d\t%d\t%d\t%d\t%d\t%r\t%r\t%r\n" % (
+            rng.randint(0, chromosomes - 1), start,
+            start + rng.randint(0, 2000), rng.randint(0, 500),
+            rng.randint(0, 500), rng.random(), rng.uniform(0, 50),
+            rng.random()))
+    return lines
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.directory = tempfile.mkdtemp()
+        self.annotation = genome.read(_genome_lines(rng), "bed")
+        self.peak_file = os.path.join(self.directory, "peaks")
+        with open(self.peak_file, "w") as handle:
+            handle.writelines(_sicer_lines(rng, 500))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _expected(self):
+        filename = os.path.join(self.directory, "expected")
+        with open(self.peak_file) as handle:
+            peaks = sicer.read(handle)
+        with open(filename, "w") as out_handle:
+            write_text_summary(peaks, self.annotation, out_handle)
+        with open(filename) as handle:
+            return handle.read()
+
+    def _run(self, processes):
+        filename = os.path.join(self.directory, "summary")
+        with open(filename, "w") as out_handle:
+            counts = pipeline.run(self.annotation, [self.peak_file],
+                                  [out_handle], processes=processes,
+                                  batch_size=64)
+        with open(filename) as handle:
+            return counts, handle.read()
+
+    def test_one_process(self):
+        self.assertEqual(self._run(1), ([500], self._expected()))
+
+    def test_processes(self):
+        self.assertEqual(self._run(2), ([500], self._expected()))
+
+    def test_sorted_loci(self):
+        lines = self._expected().splitlines()[1:]
+        self.assertTrue(any("," in line for line in lines))
+        for line in lines:
+            for field in line.split("\t")[4:]:
+                loci = field.split(",")
+                self.assertEqual(loci, sorted(loci))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Tests for scoring ChIP-seq coverage against a Poisson background
+"""
+import unittest
+import numpy as np
+from transnet.chipseq import poisson
+from transnet.genome_coverage import GenomeCoverage
+from transnet.stats import poisson_sf
+
+class ScoreSequenceTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.ip = rng.poisson(0.5, size=(2, 20000)).astype(np.int32)
+        for start in (150, 3000, 3400, 12000, 19900):
+            self.ip[:, start:start + 300] += 3
+        self.bg = rng.poisson(0.5, size=(2, 19000)).astype(np.int32)
+        self.bg[:, 12000:12300] += 5
+
+    def _check_chunks(self, bg):
+        settings = (1.0, 200.0, 200, 1e-5, 100)
+        whole = poisson._score_sequence(self.ip, bg, *settings,
+                                        chunk_size=len(self.ip[0]))
+        self.assertTrue(len(whole[0]) > 0)
+        for chunk_size in (499, 4096):
+            chunked = poisson._score_sequence(self.ip, bg, *settings,
+                                              chunk_size=chunk_size)
+            for expected, actual in zip(whole, chunked):
+                np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+    def test_chunks_without_background(self):
+        self._check_chunks(None)
+
+    def test_chunks_with_background(self):
+        self._check_chunks(self.bg)
+
+    def test_peaks(self):
+        window = 50
+        ip = np.zeros((2, 1000), dtype=np.int32)
+        ip[1, 100:160] = 4
+        ip[0, 120:180] = 5
+        ip[1, 900] = 1
+
+        starts, ends, heights, mean_pvals, shifts = \
+            poisson._score_sequence(ip, None, 1.0, 5.0, window, 1e-5, 10)
+
+        # Every window overlapping the binding is significant
+        counts = np.array([ip[:, i:i + window].sum()
+                           for i in range(1000 - window + 1)])
+        significant = np.flatnonzero(poisson_sf(counts, 5.0) <= 1e-5)
+        self.assertEqual(starts.tolist(), [significant[0]])
+        self.assertEqual(ends.tolist(), [significant[-1] + window - 1])
+        self.assertEqual(heights.tolist(), [9])
+        self.assertEqual(shifts.tolist(), [20])
+        self.assertAlmostEqual(
+            mean_pvals[0], poisson_sf(counts[significant], 5.0).mean())
+
+    def test_short_sequence(self):
+        columns = poisson._score_sequence(self.ip[:, :100], None, 1.0, 200.0,
+                                          200, 1e-5, 100)
+        self.assertEqual([len(c) for c in columns], [0] * 5)
+
+class ScoreTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.ip = GenomeCoverage()
+        self.bg = GenomeCoverage()
+        for sequence, length in (("chrI", 30000), ("chrII", 12000),
+                                 ("chrIII", 8000), ("plasmid", 150)):
+            ip = rng.poisson(0.5, size=(2, length)).astype(np.int32)
+            for start in rng.randint(0, max(length - 300, 1), size=4):
+                ip[:, start:start + 300] += rng.randint(2, 6)
+            self.ip._coverage[sequence] = ip
+
+            # The background lacks one sequence altogether
+            if sequence != "chrIII":
+                bg = rng.poisson(0.5, size=(2, length)).astype(np.int32)
+                bg[:, length // 2:length // 2 + 300] += 4
+                self.bg._coverage[sequence] = bg
+
+    def _check_processes(self, bg):
+        serial = poisson.score(self.ip, bg)
+        parallel = poisson.score(self.ip, bg, processes=2)
+        self.assertTrue(len(set(p.chromosome for p in serial)) > 1)
+        self.assertEqual(
+            [(p.chromosome, p.chrom_start, p.chrom_end, p.height, p.mean_pval, p.shift)
+             for p in parallel],
+            [(p.chromosome, p.chrom_start, p.chrom_end, p.height, p.mean_pval, p.shift)
+             for p in serial])
+
+    def test_processes_without_background(self):
+        self._check_processes(None)
+
+    def test_processes_with_background(self):
+        self._check_processes(self.bg)
+
+if __name__ == "__main__":
+    unittest.main()
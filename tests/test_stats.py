@@ -0,0 +1,96 @@
+"""
+Tests for the vectorized statistical functions, against sums of their
+probability mass functions
+"""
+from fractions import Fraction
+import math
+import unittest
+import numpy as np
+from transnet import stats
+
+def _poisson_sf(k, mean):
+    """P(X >= k), summing the upper tail term by term"""
+    if k <= 0:
+        return 1.0
+    if mean == 0:
+        return 0.0
+
+    total = 0.0
+    i = k
+    while True:
+        term = math.exp(-mean + i * math.log(mean) - math.lgamma(i + 1))
+        total += term
+        if i > mean and term <= total * 1e-17:
+            return total
+        i += 1
+
+def _choose(n, k):
+    if k < 0 or k > n:
+        return 0
+    return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
+
+def _hypergeometric_sf(k, total, successes, draws):
+    """P(X >= k), summed exactly over the upper tail"""
+    tail = sum(_choose(successes, x) * _choose(total - successes, draws - x)
+               for x in range(max(k, 0), min(successes, draws) + 1))
+    return float(Fraction(tail, _choose(total, draws)))
+
+class PoissonTest(unittest.TestCase):
+    def test_sf(self):
+        ks = []
+        means = []
+        for mean in (0.0, 1e-3, 0.5, 1.0, 3.7, 20.0, 99.5, 400.0, 2500.0):
+            for k in (0, 1, 2, 5, 10, 21, 50, 100, 180, 450, 2600, 3000):
+                ks.append(k)
+                means.append(mean)
+
+        expected = [_poisson_sf(k, m) for k, m in zip(ks, means)]
+        actual = stats.poisson_sf(ks, means)
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-300)
+
+    def test_sf_shape(self):
+        self.assertEqual(stats.poisson_sf(np.zeros((3, 4)), 2.0).shape,
+                         (3, 4))
+        self.assertEqual(float(stats.poisson_sf(3, 2.0)),
+                         float(stats.poisson_sf([3], [2.0])[0]))
+
+    def test_critical_count(self):
+        means = np.array([0.01, 0.5, 1.0, 7.5, 40.0, 160.0, 1000.0])
+        for alpha in (0.05, 1e-5, 1e-12):
+            critical = stats.poisson_critical_count(means, alpha)
+            for k, mean in zip(critical.tolist(), means.tolist()):
+                self.assertTrue(_poisson_sf(k, mean) <= alpha)
+                self.assertTrue(k == 0 or _poisson_sf(k - 1, mean) > alpha)
+
+class HypergeometricTest(unittest.TestCase):
+    def _cases(self):
+        for total, successes, draws in ((10, 3, 4), (50, 10, 20),
+                                        (200, 150, 120), (1000, 30, 400),
+                                        (3000, 2, 2999), (7, 7, 3),
+                                        (7, 0, 3), (5, 2, 0)):
+            for k in sorted(set([-1, 0, 1, 2, draws // 3, draws // 2,
+                                 min(successes, draws),
+                                 min(successes, draws) + 1])):
+                yield k, total, successes, draws
+
+    def test_sf(self):
+        cases = list(self._cases())
+        expected = [_hypergeometric_sf(*c) for c in cases]
+        actual = stats.hypergeometric_sf(*zip(*cases))
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-300)
+
+    def test_log_factorials(self):
+        cases = list(self._cases())
+        table = stats.log_factorial(5000)
+        np.testing.assert_array_equal(
+            stats.hypergeometric_sf(*zip(*cases), log_factorials=table),
+            stats.hypergeometric_sf(*zip(*cases)))
+
+    def test_log_factorial(self):
+        table = stats.log_factorial(30)
+        np.testing.assert_allclose(
+            table, [math.log(math.factorial(i)) for i in range(31)],
+            rtol=1e-12)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,525 @@
 #!/usr/bin/env python
-"""Classes providing support for reading Blind Deconvolution output
+"""Classes providing support for Blind Deconvolution of ChIP-seq coverage
+
+Each binding site produces forward strand reads upstream of it and reverse
+strand reads downstream, each spread by the distribution of fragment
+lengths.  Deconvolution works in three steps:
+
+* the distance between the strands is found by cross-correlating them, and
+  the strands are shifted together and summed
+* the shape that a single binding site takes in the summed coverage (the
+  kernel) is estimated by blind Richardson-Lucy deconvolution of the
+  strongest regions, starting from a Gaussian
+* the summed coverage of each sequence is deconvolved with that kernel by
+  Richardson-Lucy iteration, and each run of positions well above the mean
+  of the result is reported as an Impulse, if it accounts for much more
+  coverage than the mean over the width of the kernel
+
+Convolutions are done by FFT over overlapping chunks of each sequence, so
+memory use is bounded by the chunk size rather than the sequence length.
+Each chunk's margins absorb the spread of its edges, and only its centre is
+kept.  deconvolve() reads the summed coverage from the GenomeCoverage a
+chunk at a time, and keeps each deconvolved sequence in a temporary file
+until its mean, which impulses are called against, is known.
 """
+import functools
+import tempfile
+import numpy as np
+from transnet.chipseq.chip_peak import ChipPeak
+from transnet.genome_coverage import FORWARD, REVERSE
+from transnet.instrumentation import instrumented
+
+__author__ = "Matthew Peterson"
+
+DEFAULT_MAX_SHIFT = 400
+DEFAULT_KERNEL_WIDTH = 201
+DEFAULT_ITERATIONS = 30
+DEFAULT_THRESHOLD = 5.0
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+# The number of regions used to estimate the kernel, and the number of
+# blind iterations
+_KERNEL_REGIONS = 50
+_KERNEL_ITERATIONS = 10
+_TINY = 1e-12
+
+@instrumented("blind_deconvolution.parse")
+def parse(handle):
+    """
+    Parse a set of impulses, one per line, in the tab-separated form
+    chromosome, position, strength, width (as written by Impulse.to_line).
+    Returns an iterator.
+
+    :param handle: The handle to be read
+    :type handle: file
+    """
+    for line in handle:
+        tokens = line.rstrip("\r\n").split("\t")
+        if not tokens[0]:
+            continue
+
+        yield Impulse(tokens[0], int(tokens[1]), float(tokens[2]),
+                      int(tokens[3]))
+
+@instrumented("blind_deconvolution.read", count=len)
+def read(handle):
+    """
+    Returns a list of impulses.
+    """
+    return list(parse(handle))
+
+def deconvolve(coverage, sequences=None, shift=None, kernel=None,
+               iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Estimates the binding impulses behind a ChIP-seq experiment's coverage.
+    Each sequence is read from the coverage a chunk at a time, so memory use
+    depends on the chunk size rather than the length of the sequences.
+
+    :param coverage: the coverage of the IP lane
+    :type coverage: GenomeCoverage
+    :param sequences: the sequences to deconvolve; defaults to all of them
+    :type sequences: list
+    :param shift: the distance between the forward and reverse strand reads
+                  of a fragment.  Estimated by strand_shift() if None.
+    :type shift: int
+    :param kernel: the shape of a single impulse in the summed coverage, as
+                   an array of odd length.  Estimated from the strongest
+                   regions of the coverage, as by estimate_kernel(), if None.
+    :type kernel: numpy.ndarray
+    :param iterations: the number of Richardson-Lucy iterations
+    :type iterations: int
+    :param threshold: positions more than this many times the mean of the
+                      deconvolved coverage are part of an impulse, and an
+                      impulse must account for this many times the mean
+                      coverage of the kernel's width
+    :type threshold: float
+    :param chunk_size: the FFT length each chunk is deconvolved with
+    :type chunk_size: int
+    :return a list of Impulses, ordered by sequence and position
+    :rtype list
+    """
+    if sequences is None:
+        sequences = coverage.sequences()
+
+    if shift is None:
+        shift = strand_shift(coverage, sequences, chunk_size=chunk_size)
+
+    if kernel is None:
+        width = DEFAULT_KERNEL_WIDTH + 1 - DEFAULT_KERNEL_WIDTH % 2
+        sources = [(coverage.get_length(s),
+                    functools.partial(combine_strands, coverage, s, shift))
+                   for s in sequences]
+        windows = _strongest_windows(sources, 4 * width, _KERNEL_REGIONS,
+                                     chunk_size)
+        kernel = _blind_kernel(windows, width, _KERNEL_ITERATIONS)
+
+    impulses = []
+    for sequence in sequences:
+        length = coverage.get_length(sequence)
+        if length == 0:
+            continue
+
+        read = functools.partial(combine_strands, coverage, sequence, shift)
+
+        # Impulses are called against the mean of the whole deconvolved
+        # sequence, so it is kept in a temporary file until it is known.
+        with tempfile.TemporaryFile() as handle:
+            estimate = np.memmap(handle, dtype=np.float64, mode="w+",
+                                 shape=(length,))
+            total = 0.0
+            for start, stop, values in _deconvolve_chunks(
+                    read, length, kernel, iterations, chunk_size):
+                estimate[start:stop] = values
+                total += values.sum()
+
+            mean = total / length
+            chunks = [(start, estimate[start:start + chunk_size])
+                      for start in range(0, length, chunk_size)]
+            impulses.extend(_call_runs(sequence, chunks, threshold * mean,
+                                       threshold * len(kernel) * mean))
+            del chunks, estimate
+
+    return impulses
+
+def strand_shift(coverage, sequences=None, max_shift=DEFAULT_MAX_SHIFT,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Estimates the distance between the forward and reverse strand reads of a
+    fragment, as the lag that maximises the cross-correlation of the
+    strands over every sequence.  The strands are read a chunk at a time.
+
+    :param coverage: the coverage
+    :type coverage: GenomeCoverage
+    :param sequences: the sequences to use; defaults to all of them
+    :type sequences: list
+    :param max_shift: the largest shift considered
+    :type max_shift: int
+    :param chunk_size: the FFT length used for each chunk
+    :type chunk_size: int
+    :rtype: int
+    """
+    if sequences is None:
+        sequences = coverage.sequences()
+
+    step = max(chunk_size - max_shift, 1)
+    correlation = np.zeros(max_shift + 1)
+
+    for sequence in sequences:
+        length = coverage.get_length(sequence)
+        if length == 0:
+            continue
+
+        totals = np.zeros(2)
+        for start in range(0, length, chunk_size):
+            totals += coverage.get_range(sequence, start,
+                                         start + chunk_size).sum(
+                                             axis=1, dtype=np.int64)
+        means = totals / length
+
+        # correlation[k] sums forward[x] * reverse[x + k]
+        for start in range(0, length, step):
+            f = coverage.get_range(sequence, start, start + step, "+") - \
+                means[FORWARD]
+            r = coverage.get_range(sequence, start,
+                                   start + step + max_shift, "-") - \
+                means[REVERSE]
+            # Short final chunks are padded to cover every shift
+            size = _fft_length(max(len(f) + len(r), max_shift + 1))
+            product = np.conj(np.fft.rfft(f, size)) * np.fft.rfft(r, size)
+            correlation += np.fft.irfft(product, size)[:max_shift + 1]
+
+    return int(np.argmax(correlation))
+
+def combine_strands(coverage, sequence, shift, start=0, stop=None):
+    """
+    Moves the forward strand coverage of a sequence downstream and the
+    reverse strand coverage upstream, each by half of the shift, and
+    returns their sum over positions start to stop - 1.
+
+    :param start: the first position
+    :type start: int
+    :param stop: one past the last position; defaults to the end of the
+                 sequence
+    :type stop: int
+    :rtype: numpy.ndarray
+    """
+    length = coverage.get_length(sequence)
+    half = min(shift // 2, length)
+    start = max(start, 0)
+    if stop is None or stop > length:
+        stop = length
+
+    signal = np.zeros(max(stop - start, 0))
+
+    # signal[x] holds forward[x - half] + reverse[x + half]
+    low = max(start, half)
+    if low < stop:
+        signal[low - start:] += coverage.get_range(sequence, low - half,
+                                                   stop - half, "+")
+    high = min(stop, length - half)
+    if start < high:
+        signal[:high - start] += coverage.get_range(sequence, start + half,
+                                                    high + half, "-")
+
+    return signal
+
+def estimate_kernel(signals, width=DEFAULT_KERNEL_WIDTH,
+                    regions=_KERNEL_REGIONS, iterations=_KERNEL_ITERATIONS):
+    """
+    Estimates the shape of a single impulse by blind Richardson-Lucy
+    deconvolution, alternately refining the impulses and the kernel over
+    the strongest regions of the signals.
+
+    :param signals: combined strand coverage, from combine_strands()
+    :type signals: list
+    :param width: the length of the kernel; made odd if it is even
+    :type width: int
+    :param regions: the number of regions to use
+    :type regions: int
+    :param iterations: the number of blind iterations
+    :type iterations: int
+    :rtype: numpy.ndarray
+    """
+    width += 1 - width % 2
+    sources = [(len(signal), _slicer(signal)) for signal in signals]
+    windows = _strongest_windows(sources, 4 * width, regions)
+
+    return _blind_kernel(windows, width, iterations)
+
+def richardson_lucy(signal, kernel, iterations=DEFAULT_ITERATIONS,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Deconvolves a signal with a kernel by Richardson-Lucy iteration.  The
+    signal is split into overlapping chunks that are deconvolved by FFT
+    independently, and the centre of each chunk is kept.
+
+    :param signal: the signal, e.g. from combine_strands()
+    :type signal: numpy.ndarray
+    :param kernel: the kernel, of odd length
+    :type kernel: numpy.ndarray
+    :param iterations: the number of iterations
+    :type iterations: int
+    :param chunk_size: the FFT length for each chunk
+    :type chunk_size: int
+    :rtype: numpy.ndarray
+    """
+    result = np.zeros(len(signal))
+    for start, stop, values in _deconvolve_chunks(
+            _slicer(signal), len(signal), kernel, iterations, chunk_size):
+        result[start:stop] = values
+
+    return result
+
+def call_impulses(sequence, estimate, threshold=DEFAULT_THRESHOLD,
+                  min_strength=0.0):
+    """
+    Finds the runs of a deconvolved signal above threshold times its mean,
+    and returns each as an Impulse positioned at its centre of mass.
+
+    :param sequence: the sequence the signal is from
+    :type sequence: string
+    :param estimate: the deconvolved signal
+    :type estimate: numpy.ndarray
+    :param threshold: the multiple of the mean an impulse must exceed
+    :type threshold: float
+    :param min_strength: the smallest strength of an impulse
+    :type min_strength: float
+    :rtype: list
+    """
+    if not len(estimate):
+        return []
+
+    return _call_runs(sequence, [(0, estimate)],
+                      threshold * estimate.mean(), min_strength)
+
+def _blind_kernel(windows, width, iterations):
+    """
+    Estimates the kernel from windows of the signal, as for
+    estimate_kernel(), starting from a Gaussian of the given odd width.
+    """
+    half = width // 2
+
+    # A Gaussian covering most of the width to start
+    offsets = np.arange(-half, half + 1)
+    kernel = np.exp(-0.5 * (offsets / (width / 6.0)) ** 2)
+    kernel /= kernel.sum()
+
+    if not windows:
+        return kernel
+
+    estimates = [np.full(len(w), max(w.mean(), _TINY)) for w in windows]
+
+    for i in range(iterations):
+        # Refine the impulses with the current kernel
+        for w, estimate in zip(windows, estimates):
+            for j in range(5):
+                blurred = np.convolve(estimate, kernel, "same")
+                estimate *= np.convolve(w / np.maximum(blurred, _TINY),
+                                        kernel[::-1], "same")
+
+        # Then refine the kernel with the current impulses
+        update = np.zeros(width)
+        for w, estimate in zip(windows, estimates):
+            blurred = np.convolve(estimate, kernel, "same")
+            ratio = w / np.maximum(blurred, _TINY)
+            # update[k] sums ratio[x + k - half] * estimate[x]
+            full = np.correlate(ratio, estimate, "full")
+            centre = len(estimate) - 1
+            update += full[centre - half:centre + half + 1]
+
+        kernel *= update / max(sum(e.sum() for e in estimates), _TINY)
+        kernel = (kernel + kernel[::-1]) / 2.0
+        kernel /= max(kernel.sum(), _TINY)
+
+    return kernel
+
+def _deconvolve_chunks(read, length, kernel, iterations, chunk_size):
+    """
+    Deconvolves a signal chunk by chunk, as for richardson_lucy().
+
+    :param read: a function returning the signal over positions start to
+                 stop - 1, given start and stop
+    :param length: the length of the signal
+    :type length: int
+    :return an iterator of tuples of the form (start, stop, deconvolved
+            values from start to stop - 1), in order of position
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    kernel = kernel / kernel.sum()
+    margin = 4 * len(kernel)
+    step = chunk_size - 2 * margin - len(kernel)
+    if step <= 0:
+        raise ValueError("The chunk size is too small for the kernel.")
+
+    kernel_fft = np.fft.rfft(kernel, chunk_size)
+    mirror_fft = np.fft.rfft(kernel[::-1], chunk_size)
+    half = len(kernel) // 2
+
+    def convolve(values, transform):
+        result = np.fft.irfft(np.fft.rfft(values, chunk_size) * transform,
+                              chunk_size)
+        return result[half:half + len(values)]
+
+    def chunks():
+        for start in range(0, length, step):
+            stop = min(start + step, length)
+            low = max(start - margin, 0)
+            high = min(stop + margin, length)
+            observed = read(low, high)
+
+            if not observed.any():
+                yield start, stop, np.zeros(stop - start)
+                continue
+
+            estimate = np.full(len(observed), observed.mean())
+            for i in range(iterations):
+                blurred = convolve(estimate, kernel_fft)
+                estimate *= convolve(observed / np.maximum(blurred, _TINY),
+                                     mirror_fft)
+
+            yield start, stop, estimate[start - low:stop - low]
+
+    return chunks()
+
+def _call_runs(sequence, chunks, level, min_strength):
+    """
+    Finds the runs of a deconvolved signal above a level, given in
+    consecutive chunks, and returns each run that is strong enough as an
+    Impulse positioned at its centre of mass.  A run still open at the end
+    of a chunk is carried into the next.
+
+    :param chunks: an iterable of tuples of the form (start, values)
+    :rtype: list
+    """
+    impulses = []
+    # (start, stop, strength, first moment)
+    open_run = None
+    min_strength = max(min_strength, _TINY)
+
+    for offset, values in chunks:
+        values = np.asarray(values)
+        above = np.concatenate(([0], (values > level).astype(np.int8), [0]))
+        edges = np.diff(above)
+        starts = np.flatnonzero(edges == 1)
+        stops = np.flatnonzero(edges == -1)
+
+        positions = np.arange(offset, offset + len(values), dtype=np.float64)
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        moments = np.concatenate(([0], np.cumsum(values * positions)))
+
+        runs = list(zip((starts + offset).tolist(), (stops + offset).tolist(),
+                        (cumulative[stops] - cumulative[starts]).tolist(),
+                        (moments[stops] - moments[starts]).tolist()))
+
+        if open_run is not None:
+            if runs and runs[0][0] == offset:
+                runs[0] = (open_run[0], runs[0][1], open_run[2] + runs[0][2],
+                           open_run[3] + runs[0][3])
+            else:
+                runs.insert(0, open_run)
+            open_run = None
+
+        if runs and runs[-1][1] == offset + len(values):
+            open_run = runs.pop()
+
+        impulses.extend(_impulse(sequence, run) for run in runs
+                        if run[2] >= min_strength)
+
+    if open_run is not None and open_run[2] >= min_strength:
+        impulses.append(_impulse(sequence, open_run))
+
+    return impulses
+
+def _impulse(sequence, run):
+    """Creates an Impulse from a run found by _call_runs"""
+    start, stop, strength, moment = run
+    return Impulse(sequence, int(round(moment / strength)), float(strength),
+                   int(stop - start))
+
+def _strongest_windows(sources, length, count, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns up to count non-overlapping windows of the given length, centred
+    on the largest values of the signals.  Each signal is read once, a
+    chunk of whole windows at a time, and only the best candidates so far
+    are kept.
+
+    :param sources: a list of tuples of the form (length, read), where
+                    read(start, stop) returns a signal over positions start
+                    to stop - 1
+    :type sources: list
+    """
+    # Candidates are (-value, source, position), so that sorting puts the
+    # largest values first, and ties in the order they were found
+    candidates = []
+    step = max(chunk_size // length, 1) * length
+
+    for index, (size, read) in enumerate(sources):
+        # The largest value in each block of length positions
+        end = size // length * length
+        for start in range(0, end, step):
+            values = read(start, min(start + step, end))
+            blocks = len(values) // length
+            peaks = values.reshape(blocks, length).argmax(axis=1) + \
+                    np.arange(blocks) * length
+            candidates.extend(zip((-values[peaks]).tolist(),
+                                  [index] * blocks,
+                                  (peaks + start).tolist()))
+            candidates = sorted(candidates)[:count]
+
+    windows = []
+    for value, index, position in candidates:
+        if value >= 0:
+            break
+        size, read = sources[index]
+        start = min(max(position - length // 2, 0), size - length)
+        windows.append(np.array(read(start, start + length)))
+
+    return windows
+
+def _slicer(signal):
+    """Returns a function reading a range of an array, for _strongest_windows
+    and _deconvolve_chunks"""
+    return lambda start, stop: signal[start:stop]
+
+def _fft_length(n):
+    """Returns the smallest power of two of at least n"""
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+class Impulse(ChipPeak):
+    """
+    A binding site estimated by blind deconvolution, with its position, its
+    strength (the coverage it accounts for) and its width.
+    """
+    __slots__ = ("position", "strength", "width")
+
+    def __init__(self, chromosome, position, strength, width):
+        """
+        Create a new Impulse
 
-def parse():
-    pass
+        :param chromosome: the chromosome the impulse is on
+        :type chromosome: string
+        :param position: the centre of the impulse
+        :type position: int
+        :param strength: the coverage explained by the impulse
+        :type strength: float
+        :param width: the width of the impulse
+        :type width: int
+        """
+        half = width // 2
+        super(Impulse, self).__init__(chromosome, max(position - half, 0),
+                                      position + half)
+        self.position = position
+        self.strength = strength
+        self.width = width
 
-class Impulse(object):
-    pass
+    def score(self):
+        return self.strength
 
+    def to_line(self):
+        """Returns the impulse as a line in the format read by parse()"""
+        return "%s\t%d\t%f\t%d" % (self.chromosome, self.position,
+                                   self.strength, self.width)
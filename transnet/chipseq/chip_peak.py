@@ -1,10 +1,119 @@
 """Base class describing a ChIP-seq Peak"""
-from transnet.interval import Interval
+from transnet.interval import Interval, chromosome_name
 from transnet.genome import IntergenicRegion
-from operator import attrgetter
+from transnet.instrumentation import instrumented
+from itertools import groupby
+
+@instrumented("chip_peak.annotate", count=len)
+def annotate(peaks, annotation, filter_hits = True):
+    """Gets the regulated genes for a whole collection of peaks at once.
+    Equivalent to calling ChipPeak.get_regulated_genes on each peak, but the
+    peaks are grouped by chromosome, and the overlap index of each
+    chromosome is searched for the bounds of every peak in its group at
+    once.  Only the features a peak overlaps are looked at, so small or
+    sparse batches of peaks cost little more than their hits, and a genome
+    loaded from a snapshot only creates the genes the peaks implicate.
+
+    :param peaks: the peaks to be annotated
+    :type peaks: iterable
+    :param annotation: the annotation used to call genes
+    :type annotation: Genome
+    :param filter_hits: remove genic hits also implicated by intergenic hits
+    :type filter_hits: bool
+    :return a list of (upstream, downstream, genic) tuples, in the same order
+            as the peaks
+    :rtype list
+    """
+    peaks = list(peaks)
+    results = [None] * len(peaks)
+
+    order = sorted(range(len(peaks)),
+                   key=lambda i: (peaks[i].chrom_code, peaks[i].chrom_start))
+
+    for code, group in groupby(order, lambda i: peaks[i].chrom_code):
+        group = list(group)
+        features = annotation.chromosome_features(chromosome_name(code))
+        positions = features.overlapping_positions(
+            [peaks[i].chrom_start for i in group],
+            [peaks[i].chrom_end for i in group])
+
+        for i, hits in zip(group, positions):
+            hits = set(features[p] for p in hits)
+            results[i] = _classify_hits(hits, annotation, filter_hits)
+
+    return results
+
+def _classify_hits(hits, annotation, filter_hits = True):
+    """Splits a set of overlapping features into upstream, downstream and
+    genic sets of genes.
+
+    :param hits: the features overlapped by a peak
+    :type hits: set
+    :param annotation: the annotation the features belong to
+    :type annotation: Genome
+    """
+    upstream = set()
+    downstream = set()
+    genic = set()
+
+    if filter_hits:
+        _filter_hits(hits)
+
+    for h in hits:
+        if h.__class__.__name__ == "Gene":
+            genic.add(h)
+        elif h.__class__.__name__ == "IntergenicRegion":
+            # Now check to see which genes are up and downstream
+            if h.left_gene.strand == "-":
+                upstream.add(h.left_gene)
+            else:
+                downstream.add(h.left_gene)
+
+            if h.right_gene.strand == "+":
+                upstream.add(h.right_gene)
+            else:
+                downstream.add(h.right_gene)
+
+    # Add upstream and downstream genes for genic peaks
+    for g in genic:
+        previous_gene, next_gene = annotation.flanking_genes(g)
+
+        if previous_gene is not None:
+            if previous_gene.strand == "-":
+                upstream.add(previous_gene)
+            else:
+                downstream.add(previous_gene)
+
+        if next_gene is not None:
+            if next_gene.strand == "+":
+                upstream.add(next_gene)
+            else:
+                downstream.add(next_gene)
+
+    return upstream, downstream, genic
+
+def _filter_hits(hits):
+    """Remove genic regions also implicated by intergenic overlaps.
+
+    :param hits: set of hits returned by get_regulated_regions
+    :type hits: set
+    """
+    to_remove = set()
+
+    for h in hits:
+        if h.__class__ == IntergenicRegion:
+            if h.left_gene in hits:
+                to_remove.add(h.left_gene)
+            if h.right_gene in hits:
+                to_remove.add(h.right_gene)
+
+    for h in to_remove:
+        hits.remove(h)
 
 class ChipPeak(Interval):
     """An enriched region, or "peak" identified by ChIP-seq analysis."""
+    __slots__ = ()
+
     def __init__(self, chromosome, start, stop):
         """
         Create a new ChIP-seq peak
@@ -24,6 +133,7 @@ class ChipPeak(Interval):
         raise NotImplementedError("score() is not implemented for the base" +
                                   "Class")
 
+    @instrumented("chip_peak.get_regulated_genes", count=lambda hits: 1)
     def get_regulated_genes(self, annotation, filter_hits = True):
         """Gets a set of regulated genes, as well as their classification.
         Perhaps 'regulated' is not the correct word - 'implicated' may be
@@ -34,64 +144,17 @@ class ChipPeak(Interval):
         * DS - Downstreams
         * G - Genic
 
+        To annotate many peaks, use annotate(), which looks up all of the
+        peaks on each chromosome at once.
+
         :param annotation: the annotation used to call genes
         :type annotation: Genome
         :return a list of tuples of the form (Gene, classification)
         :rtype tuple
         """
-        hits = set()
-        upstream = set()
-        downstream = set()
-        genic = set()
-
-        for f in annotation.features(True):
-            if self.overlaps(f):
-                hits.add(f)
-
-        if filter_hits:
-            self._filter_hits(hits)
-
-        for h in hits:
-            if h.__class__.__name__ == "Gene":
-                genic.add(h)
-            elif h.__class__.__name__ == "IntergenicRegion":
-                # Now check to see which genes are up and downstream
-                if h.left_gene.strand == "-":
-                    upstream.add(h.left_gene)
-                else:
-                    downstream.add(h.left_gene)
-
-                if h.right_gene.strand == "+":
-                    upstream.add(h.right_gene)
-                else:
-                    downstream.add(h.right_gene)
-        
-        # Add upstream and downstream genes for genic peaks
-        genes = list(annotation.features(False))
-        genes = sorted(genes, key=attrgetter('chromosome', 'chrom_start'))
-        for g in genic:
-            gene_idx = genes.index(g)
-            
-            previous_idx = gene_idx - 1
-            next_idx = gene_idx + 1
-            
-            # Bad news for linear chromosomes. Fix this.
-            if next_idx == len(genes):
-                next_idx = 0
-            if previous_idx == -1:
-                previous_idx = len(genes) - 1
-            
-            if genes[previous_idx].strand == "-":
-                upstream.add(genes[previous_idx])
-            else:
-                downstream.add(genes[previous_idx])
-            
-            if genes[next_idx].strand == "+":
-                upstream.add(genes[next_idx])
-            else:
-                downstream.add(genes[next_idx])
+        hits = set(annotation.overlapping_features(self))
 
-        return upstream, downstream, genic
+        return _classify_hits(hits, annotation, filter_hits)
 
     def _filter_hits(self, hits):
         """Remove genic regions also implicated by intergenic overlaps.
@@ -99,21 +162,11 @@ class ChipPeak(Interval):
         :param hits: set of hits returned by get_regulated_regions
         :type hits: set
         """
-        to_remove = set()
-
-        for h in hits:
-            if h.__class__ == IntergenicRegion:
-                if h.left_gene in hits:
-                    to_remove.add(h.left_gene)
-                if h.right_gene in hits:
-                    to_remove.add(h.right_gene)
-
-        for h in to_remove:
-            hits.remove(h)
-    
+        _filter_hits(hits)
+
     def to_bed(self, name="peak"):
         """
         Writes the interval as a BED field
         """
-        return "%s\t%d\t%d\t%s\t%f" % (self.chromosome, self.chrom_start, 
-                                       self.chrom_end, self.name, self.score())
+        return "%s\t%d\t%d\t%s\t%f" % (self.chromosome, self.chrom_start,
+                                       self.chrom_end, name, self.score())
@@ -1,7 +1,16 @@
 #!/usr/bin/env python
 
+import numpy as np
 from transnet.chipseq.chip_peak import ChipPeak
+from transnet.chipseq.peak_table import PeakTable, concatenate
+from transnet.instrumentation import instrumented
+from transnet.parsing import DEFAULT_BATCH_SIZE, parse_blocks
 
+_FIELDS = np.dtype([("start", np.int64), ("stop", np.int64),
+                    ("height", np.int64), ("unused", str, 1),
+                    ("shift", np.int64)])
+
+@instrumented("log_normal.parse")
 def parse(peaks_handle, chromosome = "Genome"):
     """
     Reads in a set of peaks
@@ -12,6 +21,7 @@ def parse(peaks_handle, chromosome = "Genome"):
                              int(tokens[2]), int(tokens[4]))
         yield peak
 
+@instrumented("log_normal.read", count=len)
 def read(peaks_handle, chromosome = "Genome"):
     """
     Returns a list of peaks.
@@ -19,10 +29,47 @@ def read(peaks_handle, chromosome = "Genome"):
     peaks = parse(peaks_handle, chromosome)
     return list(peaks)
 
+@instrumented("log_normal.parse_table", count=len)
+def parse_table(peaks_handle, chromosome = "Genome",
+                batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Reads in a set of peaks in blocks.  Returns an iterator of PeakTables of
+    at most batch_size peaks each.
+    """
+    for block in parse_blocks(peaks_handle, _FIELDS, batch_size):
+        yield _table_from_block(block, chromosome)
+
+@instrumented("log_normal.read_table", count=len)
+def read_table(peaks_handle, chromosome = "Genome",
+               batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Returns the peaks as a PeakTable, with a shift column.  The score column
+    holds the peak heights.
+    """
+    tables = list(parse_table(peaks_handle, chromosome, batch_size))
+    if not tables:
+        return _table_from_block(np.zeros(0, dtype=_FIELDS), chromosome)
+
+    return concatenate(tables)
+
+def _table_from_block(block, chromosome):
+    """Converts a block of records from parse_blocks into a PeakTable"""
+    return PeakTable([chromosome], np.zeros(len(block), dtype=np.int32),
+                     block["start"], block["stop"], block["height"],
+                     {"shift": block["shift"]}, _peak_from_table)
+
+def _peak_from_table(table, i):
+    """Creates a LogNormalPeak from a row of a PeakTable"""
+    return LogNormalPeak(table.chromosome(i), int(table.starts[i]),
+                         int(table.ends[i]), int(table.scores[i]),
+                         int(table.columns["shift"][i]))
+
 class LogNormalPeak(ChipPeak):
     """
     A peak called from a log-normal distribution. (Describe procedure here)
     """
+    __slots__ = ("height", "shift")
+
     def __init__(self, chromosome, start, stop, height, shift):
         self.chromosome = chromosome
         self.chrom_start = start
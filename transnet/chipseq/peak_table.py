@@ -0,0 +1,242 @@
+"""
+A column-oriented table of ChIP-seq peaks, backed by numpy arrays.
+"""
+import numpy as np
+
+__author__ = "Matthew Peterson"
+
+class PeakTable(object):
+    """
+    A set of peaks stored as a structure of arrays, rather than as one
+    ChipPeak object per peak.  Every table has chromosome codes, start and
+    end positions and a score, plus any format-specific columns (for example
+    mean_pval and shift for Poisson peaks, or fold_change and fdr for SICER
+    peaks).
+
+    Indexing a table with an integer returns a ChipPeak for that row, created
+    on demand.  Indexing with a slice, a boolean mask or an array of indices
+    returns a new PeakTable.
+    """
+    def __init__(self, chromosomes, chromosome_codes, starts, ends, scores,
+                 columns=None, peak_factory=None):
+        """
+        Create a new PeakTable
+
+        :param chromosomes: the chromosome names, indexed by code
+        :type chromosomes: list
+        :param chromosome_codes: the chromosome code of each peak
+        :type chromosome_codes: numpy.ndarray
+        :param starts: the start position of each peak
+        :type starts: numpy.ndarray
+        :param ends: the stop position of each peak
+        :type ends: numpy.ndarray
+        :param scores: the score of each peak
+        :type scores: numpy.ndarray
+        :param columns: any format-specific columns, keyed by name
+        :type columns: dict
+        :param peak_factory: a function taking a table and row number, and
+                             returning a ChipPeak for that row
+        :type peak_factory: function
+        """
+        self.chromosomes = list(chromosomes)
+        self.chromosome_codes = np.ascontiguousarray(chromosome_codes,
+                                                     dtype=np.int32)
+        self.starts = np.ascontiguousarray(starts, dtype=np.int64)
+        self.ends = np.ascontiguousarray(ends, dtype=np.int64)
+        self.scores = np.ascontiguousarray(scores)
+        self.columns = {}
+        self._peak_factory = peak_factory
+
+        if columns:
+            for name, values in columns.items():
+                self.columns[name] = np.ascontiguousarray(values)
+
+        for values in [self.starts, self.ends, self.scores] + \
+                      list(self.columns.values()):
+            if len(values) != len(self.chromosome_codes):
+                raise ValueError("All columns must be the same length.")
+
+    def __len__(self):
+        return len(self.chromosome_codes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.peak(i)
+
+    def __getitem__(self, key):
+        """
+        Gets a single peak, or a subset of the table.
+
+        :param key: a row number, slice, boolean mask or array of row numbers
+        """
+        if isinstance(key, (int, np.integer)):
+            return self.peak(key)
+
+        return self.take(key)
+
+    def peak(self, i):
+        """
+        Returns the peak in a given row as a ChipPeak object.
+
+        :param i: the row number
+        :type i: int
+        """
+        if self._peak_factory is None:
+            raise TypeError("No peak type is associated with this table.")
+
+        if i < 0:
+            i += len(self)
+
+        return self._peak_factory(self, i)
+
+    def chromosome(self, i):
+        """
+        Returns the name of the chromosome a given row is on.
+
+        :param i: the row number
+        :type i: int
+        """
+        return self.chromosomes[self.chromosome_codes[i]]
+
+    def column(self, name):
+        """
+        Returns a column of the table by name.  Accepts the names of any
+        format-specific columns, as well as 'starts', 'ends' and 'scores'.
+
+        :param name: the column name
+        :type name: string
+        """
+        if name in self.columns:
+            return self.columns[name]
+
+        if name in ("starts", "ends", "scores", "chromosome_codes"):
+            return getattr(self, name)
+
+        raise KeyError("No column named '%s'." % name)
+
+    def take(self, key):
+        """
+        Returns a new table containing the selected rows.
+
+        :param key: a slice, boolean mask or array of row numbers
+        """
+        columns = dict((name, values[key])
+                       for name, values in self.columns.items()
+                       if values is not self.scores)
+
+        table = PeakTable(self.chromosomes, self.chromosome_codes[key],
+                          self.starts[key], self.ends[key], self.scores[key],
+                          columns, self._peak_factory)
+        _alias_scores(self, table)
+
+        return table
+
+    def filter(self, mask):
+        """
+        Returns a new table containing only the rows where mask is True.
+        For example, table.filter(table.columns['fdr'] < 0.01)
+
+        :param mask: a boolean array with one entry per row
+        :type mask: numpy.ndarray
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if len(mask) != len(self):
+            raise ValueError("Mask must have one entry per peak.")
+
+        return self.take(mask)
+
+    def select_chromosome(self, chromosome):
+        """
+        Returns a new table containing only the peaks on a chromosome.
+
+        :param chromosome: the chromosome name
+        :type chromosome: string
+        """
+        if chromosome not in self.chromosomes:
+            return self.take(np.zeros(len(self), dtype=bool))
+
+        code = self.chromosomes.index(chromosome)
+        return self.take(self.chromosome_codes == code)
+
+    def argsort(self, column=None, reverse=False):
+        """
+        Returns the row order that sorts the table.  By default, rows are
+        ordered by chromosome name and then start position.
+
+        :param column: a column name to sort by instead of position
+        :type column: string
+        :param reverse: sort in descending order
+        :type reverse: bool
+        """
+        if column is None:
+            # Rank the codes by name, so that tables sort the same way as
+            # Genome orders its genes.
+            name_order = np.argsort(np.array(self.chromosomes, dtype=object))
+            code_rank = np.empty(len(self.chromosomes), dtype=np.int32)
+            code_rank[name_order] = np.arange(len(self.chromosomes))
+
+            order = np.lexsort((self.ends, self.starts,
+                                code_rank[self.chromosome_codes]))
+        else:
+            order = np.argsort(self.column(column), kind="mergesort")
+
+        if reverse:
+            order = order[::-1]
+
+        return order
+
+    def sort(self, column=None, reverse=False):
+        """
+        Returns a new, sorted table.  See argsort() for the options.
+        """
+        return self.take(self.argsort(column, reverse))
+
+def concatenate(tables):
+    """
+    Joins a sequence of PeakTables into a single table.  The tables must all
+    have the same columns.
+
+    :param tables: the tables to be joined
+    :type tables: sequence
+    :rtype: PeakTable
+    """
+    tables = list(tables)
+    if not tables:
+        raise ValueError("At least one table is required.")
+
+    chromosomes = []
+    lookup = {}
+    codes = []
+
+    for t in tables:
+        remap = np.empty(len(t.chromosomes), dtype=np.int32)
+        for i, name in enumerate(t.chromosomes):
+            if name not in lookup:
+                lookup[name] = len(chromosomes)
+                chromosomes.append(name)
+            remap[i] = lookup[name]
+        codes.append(remap[t.chromosome_codes])
+
+    first = tables[0]
+    columns = {}
+    for name, values in first.columns.items():
+        if values is not first.scores:
+            columns[name] = np.concatenate([t.columns[name] for t in tables])
+
+    table = PeakTable(chromosomes, np.concatenate(codes),
+                      np.concatenate([t.starts for t in tables]),
+                      np.concatenate([t.ends for t in tables]),
+                      np.concatenate([t.scores for t in tables]),
+                      columns, first._peak_factory)
+    _alias_scores(first, table)
+
+    return table
+
+def _alias_scores(source, table):
+    """
+    Keeps any columns that are the score column under another name (e.g. the
+    fold_change of SICER peaks) pointing at the new table's scores.
+    """
+    for name, values in source.columns.items():
+        if values is source.scores:
+            table.columns[name] = table.scores
@@ -0,0 +1,247 @@
+"""
+A streaming pipeline that annotates peak files against a genome and writes
+a text summary of each (see summary.write_text_summary).
+
+Each peak file is read in batches of lines.  Every batch is parsed,
+annotated and formatted in a pool of worker processes, and the summaries
+are written in the order of the input.  At most a fixed number of batches
+are in flight at once, so memory use does not grow with the size of the
+input.  Each worker loads the genome from a snapshot (see genome.load),
+so the workers start at once, share one memory-mapped copy of the genome's
+arrays and only create the genes their peaks implicate.
+
+From the command line:
+
+    python -m transnet.chipseq.pipeline genome.bed peaks1 peaks2 \\
+        --format sicer --processes 8 --output-dir summaries
+"""
+from collections import deque
+from itertools import islice
+from os import path
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+from transnet import genome, parallel
+from transnet.chipseq import blind_deconvolution, log_normal, poisson, sicer
+from transnet.chipseq.chip_peak import annotate
+from transnet.chipseq.summary import TEXT_SUMMARY_HEADER, text_summary_lines
+
+__author__ = "Matthew Peterson"
+
+DEFAULT_BATCH_SIZE = 10000
+
+# The formats that can be read, as functions from (handle, chromosome) to
+# an iterable of peaks.  Formats with a block reader are read into a
+# PeakTable; impulses are still parsed line by line.  Only the Poisson and
+# log-normal formats use the chromosome.
+FORMATS = {
+    "sicer": lambda handle, chromosome: sicer.read_table(handle, "sicer"),
+    "sicer_rb": lambda handle, chromosome: sicer.read_table(handle,
+                                                            "sicer_rb"),
+    "poisson": poisson.read_table,
+    "log_normal": log_normal.read_table,
+    "impulse": lambda handle, chromosome: blind_deconvolution.parse(handle),
+}
+
+def run(annotation, peak_files, outputs, format="sicer", chromosome="Genome",
+        processes=None, batch_size=DEFAULT_BATCH_SIZE, max_pending=None):
+    """
+    Annotates peak files and writes a text summary of each.
+
+    :param annotation: the genome to annotate against.  Unless it was
+                       loaded from a snapshot, it is saved to a temporary
+                       one for the worker processes.
+    :type annotation: Genome
+    :param peak_files: the names of the peak files
+    :type peak_files: list
+    :param outputs: the handle to write each file's summary to, in the order
+                    of peak_files.  The same handle may be repeated.
+    :type outputs: list
+    :param format: the format of the peak files; one of FORMATS
+    :type format: string
+    :param chromosome: the chromosome of Poisson and log-normal peaks
+    :type chromosome: string
+    :param processes: the number of worker processes.  Defaults to the
+                      number of CPUs; if 1, every batch is handled in this
+                      process.
+    :type processes: int
+    :param batch_size: the number of lines in each batch
+    :type batch_size: int
+    :param max_pending: the largest number of batches in flight at once.
+                        Defaults to twice the number of processes.
+    :type max_pending: int
+    :return the number of peaks annotated in each file
+    :rtype list
+    """
+    if format not in FORMATS:
+        raise ValueError("Unsupported format %s.  Select one of %s." %
+                         (format, ", ".join(sorted(FORMATS))))
+    if len(outputs) != len(peak_files):
+        raise ValueError("There must be one output per peak file.")
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    settings = (format, chromosome)
+    counts = [0] * len(peak_files)
+
+    temporary = []
+    try:
+        if processes <= 1:
+            initializer, initargs = _init_worker, (annotation, settings)
+        else:
+            initializer = _init_snapshot_worker
+            initargs = (_snapshot_file(annotation, temporary), settings)
+
+        with parallel.pool(processes, initializer, initargs) as workers:
+            # Results are written strictly in the order batches were
+            # submitted
+            pending = deque()
+            for i, out_handle, batch in _batches(peak_files, outputs,
+                                                 batch_size):
+                if batch is None:
+                    pending.append((i, out_handle, (0, TEXT_SUMMARY_HEADER)))
+                    continue
+
+                if len(pending) >= max_pending:
+                    _write_result(pending.popleft(), counts)
+                pending.append((i, out_handle,
+                                workers.apply_async(_annotate_worker,
+                                                    (batch,))))
+
+            while pending:
+                _write_result(pending.popleft(), counts)
+    finally:
+        for filename in temporary:
+            os.remove(filename)
+
+    return counts
+
+def _batches(peak_files, outputs, batch_size):
+    """
+    Reads each peak file in batches of lines.  The lines of the first item
+    for each file are None, marking where its summary's header goes.
+
+    :return an iterator of tuples of the form (file index, output, lines)
+    """
+    for i, (peak_file, out_handle) in enumerate(zip(peak_files, outputs)):
+        yield i, out_handle, None
+
+        with open(peak_file) as handle:
+            while True:
+                batch = list(islice(handle, batch_size))
+                if not batch:
+                    break
+                yield i, out_handle, batch
+
+def _write_result(task, counts):
+    """
+    Writes a pending result, waiting for it if necessary.  Headers are
+    queued as ready (count, text) tuples.
+    """
+    i, out_handle, result = task
+    if not isinstance(result, tuple):
+        result = result.get()
+
+    count, text = result
+    counts[i] += count
+    out_handle.write(text)
+
+def _snapshot_file(annotation, temporary):
+    """
+    Returns the name of a snapshot of the genome.  A genome that was not
+    loaded from a snapshot is saved to a temporary file, whose name is added
+    to temporary.
+    """
+    if annotation.snapshot_file is not None:
+        return annotation.snapshot_file
+
+    handle, filename = tempfile.mkstemp(suffix=".genome")
+    os.close(handle)
+    temporary.append(filename)
+    annotation.save(filename)
+
+    return filename
+
+def _init_worker(annotation, settings):
+    """Keeps the genome and settings in this process"""
+    parallel.state["genome"] = annotation
+    parallel.state["settings"] = settings
+
+def _init_snapshot_worker(snapshot, settings):
+    """Loads the genome once in each worker process"""
+    _init_worker(genome.load(snapshot), settings)
+
+def _annotate_worker(lines):
+    """
+    Parses, annotates and formats a batch of lines, in a worker process.
+
+    :return a tuple of the form (number of peaks, summary text)
+    :rtype tuple
+    """
+    format, chromosome = parallel.state["settings"]
+    peaks = list(FORMATS[format](lines, chromosome))
+    regulated_genes = annotate(peaks, parallel.state["genome"])
+
+    return len(peaks), "".join(text_summary_lines(peaks, regulated_genes))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Annotates ChIP-seq peak files against a genome.")
+    parser.add_argument("genome", help="the genome annotation, or a "
+                                       "snapshot written by Genome.save()")
+    parser.add_argument("peaks", nargs="+", help="the peak files")
+    parser.add_argument("--genome-format", default="bed",
+                        choices=["bed", "broad", "snapshot"])
+    parser.add_argument("--circular", nargs="*", default=[],
+                        help="the circular chromosomes of the genome (not "
+                             "used with snapshots)")
+    parser.add_argument("--format", default="sicer", choices=sorted(FORMATS),
+                        help="the format of the peak files")
+    parser.add_argument("--chromosome", default="Genome",
+                        help="the chromosome of Poisson and log-normal peaks")
+    parser.add_argument("--processes", type=int,
+                        help="the number of worker processes; defaults to "
+                             "the number of CPUs")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="the number of peaks in each batch")
+    parser.add_argument("--output-dir",
+                        help="write each summary to <peak file>.summary.txt "
+                             "in this directory, rather than to standard "
+                             "output")
+    options = parser.parse_args(args)
+
+    if options.genome_format == "snapshot":
+        if options.circular:
+            parser.error("Snapshots keep the topology they were saved with.")
+        annotation = genome.load(options.genome)
+    else:
+        with open(options.genome) as handle:
+            annotation = genome.read(handle, options.genome_format,
+                                     circular=options.circular)
+
+    if options.output_dir is None:
+        outputs = [sys.stdout] * len(options.peaks)
+    else:
+        if not path.isdir(options.output_dir):
+            os.makedirs(options.output_dir)
+        outputs = [open(path.join(options.output_dir,
+                                  path.basename(p) + ".summary.txt"), "w")
+                   for p in options.peaks]
+
+    try:
+        run(annotation, options.peaks, outputs, options.format,
+            options.chromosome, options.processes, options.batch_size)
+    finally:
+        if options.output_dir is not None:
+            for out_handle in outputs:
+                out_handle.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
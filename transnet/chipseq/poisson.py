@@ -2,10 +2,30 @@
 Classes and methods for scoring a ChIP-seq experiment using a Poisson
 background model.
 """
+import os
+import tempfile
+import numpy as np
+from transnet import parallel
 from transnet.chipseq.chip_peak import ChipPeak
+from transnet.chipseq.peak_table import PeakTable, concatenate
+from transnet.instrumentation import instrumented
+from transnet.genome_coverage import DiskBasedGenomeCoverage
+from transnet.parsing import DEFAULT_BATCH_SIZE, parse_blocks
+from transnet.stats import poisson_critical_count, poisson_sf
 
 __author__ = "Matthew Peterson"
 
+DEFAULT_WINDOW = 200
+DEFAULT_THRESHOLD = 1e-5
+DEFAULT_MIN_LENGTH = 100
+# The number of windows scored at once
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+_FIELDS = np.dtype([("start", np.int64), ("stop", np.int64),
+                    ("height", np.int64), ("mean_pval", np.float64),
+                    ("shift", np.int64)])
+
+@instrumented("poisson.parse")
 def parse(handle, chromosome = "Genome"):
     """
     Parse a set of peaks.  Returns an iterator
@@ -21,6 +41,7 @@ def parse(handle, chromosome = "Genome"):
                            int(tokens[2]), float(tokens[3]), int(tokens[4]))
         yield peak
 
+@instrumented("poisson.read", count=len)
 def read(handle, chromosome = "Genome"):
     """
     Read in a set of peaks from an output file.
@@ -31,27 +52,401 @@ def read(handle, chromosome = "Genome"):
     """
     return list(parse(handle, chromosome))
 
-def score(ip_coverage, bg_coverage=None):
+@instrumented("poisson.parse_table", count=len)
+def parse_table(handle, chromosome = "Genome",
+                batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Parse a set of peaks in blocks.  Returns an iterator of PeakTables of at
+    most batch_size peaks each, so that large files can be processed without
+    holding every peak in memory.
+
+    :param handle: The handle to be read
+    :type handle: file
+    :param chromosome: the chromosome the peaks are found on
+    :type chromosome: string
+    :param batch_size: the maximum number of peaks in each table
+    :type batch_size: int
+    """
+    for block in parse_blocks(handle, _FIELDS, batch_size):
+        yield _table_from_block(block, chromosome)
+
+@instrumented("poisson.read_table", count=len)
+def read_table(handle, chromosome = "Genome",
+               batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Read in a set of peaks from an output file as a PeakTable, with
+    mean_pval and shift columns.  The score column holds the peak heights.
+
+    :param handle: The handle to be read
+    :type handle: file
+    :param chromosome: the chromosome the peaks are found on
+    :type chromosome: string
+    """
+    tables = list(parse_table(handle, chromosome, batch_size))
+    if not tables:
+        return _table_from_block(np.zeros(0, dtype=_FIELDS), chromosome)
+
+    return concatenate(tables)
+
+def _table_from_block(block, chromosome):
+    """Converts a block of records from parse_blocks into a PeakTable"""
+    # PeakTables hold zero-based positions, as PoissonPeak does internally
+    return PeakTable([chromosome], np.zeros(len(block), dtype=np.int32),
+                     block["start"] - 1, block["stop"] - 1, block["height"],
+                     {"mean_pval": block["mean_pval"],
+                      "shift": block["shift"]},
+                     _peak_from_table)
+
+def _peak_from_table(table, i):
+    """Creates a PoissonPeak from a row of a PeakTable"""
+    return PoissonPeak(table.chromosome(i), int(table.starts[i]) + 1,
+                       int(table.ends[i]) + 1, int(table.scores[i]),
+                       float(table.columns["mean_pval"][i]),
+                       int(table.columns["shift"][i]))
+
+def score(ip_coverage, bg_coverage=None, window=DEFAULT_WINDOW,
+          threshold=DEFAULT_THRESHOLD, min_length=DEFAULT_MIN_LENGTH,
+          as_table=False, processes=None):
     """Scores an experiment against a background lane.  Will scale the
     background coverage to match that of the IP lane
 
+    The coverage of both strands is summed over a window starting at every
+    position, and each window is given the Poisson probability of seeing at
+    least that much coverage.  Windows at or below the p-value threshold
+    are merged, and any merged region at least min_length long is a peak.
+    Each peak's height is its maximum coverage, its mean p-value is that of
+    its significant windows, and its shift is the distance from the highest
+    forward strand coverage to the highest reverse strand coverage.
+
     :param ip_coverage: coverage in IP lane
     :type ip_coverage: GenomeCoverage
+    :param bg_coverage: coverage in the background lane.  If None, the
+                        expected coverage of every window is the genome-wide
+                        mean.
+    :type bg_coverage: GenomeCoverage
+    :param window: the window size
+    :type window: int
+    :param threshold: the largest p-value of a significant window
+    :type threshold: float
+    :param min_length: the minimum length of a peak
+    :type min_length: int
+    :param as_table: return a PeakTable rather than a list of PoissonPeaks
+    :type as_table: bool
+    :param processes: the number of processes to score sequences in.  The
+                      coverage is shared with the processes through memory
+                      mapped files rather than copied to each one, and the
+                      peaks are the same as scoring in a single process.
+    :type processes: int
+    """
+    if bg_coverage is None:
+        peaks = _score_no_bg(ip_coverage, window, threshold, min_length,
+                             processes)
+    else:
+        peaks = _score_vs_bg(ip_coverage, bg_coverage, window, threshold,
+                             min_length, processes)
+
+    if as_table:
+        return peaks
+
+    return list(peaks)
+
+def _score_no_bg(ip_coverage, window, threshold, min_length, processes=None):
+    """Scores an experiment, expecting the genome-wide mean coverage in every
+    window"""
+    mean = _mean_window_coverage(ip_coverage, window)
+
+    return _score_sequences(ip_coverage, None, 1.0, mean, window, threshold,
+                            min_length, processes)
+
+def _score_vs_bg(ip_coverage, bg, window, threshold, min_length,
+                 processes=None):
+    """Scores an experiment, expecting the background coverage scaled to the
+    depth of the IP lane in every window.  The genome-wide mean of the IP
+    lane is used as a floor, so sparse background does not inflate
+    significance."""
+    bg_total = _total_coverage(bg)
+    if bg_total == 0:
+        raise ValueError("The background lane has no coverage.")
+
+    scale = float(_total_coverage(ip_coverage)) / bg_total
+    floor = _mean_window_coverage(ip_coverage, window)
+
+    return _score_sequences(ip_coverage, bg, scale, floor, window, threshold,
+                            min_length, processes)
+
+def _total_coverage(coverage):
+    """Returns the total coverage of both strands over every sequence"""
+    return sum(int(coverage.get_coverage_as_array(s).sum(dtype=np.int64))
+               for s in coverage.sequences())
+
+def _mean_window_coverage(coverage, window):
+    """Returns the mean coverage of a window over the whole genome"""
+    length = sum(coverage.get_length(s) for s in coverage.sequences())
+    if length == 0:
+        return 0.0
+
+    return float(_total_coverage(coverage)) * window / length
+
+def _score_sequences(ip_coverage, bg_coverage, scale, floor, window,
+                     threshold, min_length, processes=None):
+    """Scores each sequence in turn, and returns the peaks as a PeakTable"""
+    sequences = ip_coverage.sequences()
+    settings = (scale, floor, window, threshold, min_length)
+
+    if processes is not None and processes > 1 and len(sequences) > 1:
+        scores = _score_in_processes(ip_coverage, bg_coverage, settings,
+                                     processes)
+    else:
+        scores = [_score_sequence(
+                      ip_coverage.get_coverage_as_array(s),
+                      _background_array(bg_coverage, s), *settings)
+                  for s in sequences]
+
+    if not sequences:
+        return _table_from_scores("Genome", _no_peaks())
+
+    return concatenate(_table_from_scores(s, columns)
+                       for s, columns in zip(sequences, scores))
+
+def _background_array(bg_coverage, sequence):
+    """Returns the background coverage of a sequence, if there is any"""
+    if bg_coverage is None:
+        return None
+
+    if sequence in bg_coverage.sequences():
+        return bg_coverage.get_coverage_as_array(sequence)
+
+    return np.zeros((2, 0), dtype=np.int32)
+
+def _score_in_processes(ip_coverage, bg_coverage, settings, processes):
+    """
+    Scores each sequence in a pool of processes, returning the scores in the
+    same order as ip_coverage.sequences().  Each process memory-maps the
+    coverage files, so only sequence names and peaks are passed between
+    processes.
     """
-    raise NotImplementedError("Scoring has yet to be implemented.")
+    sequences = ip_coverage.sequences()
+    temporary = []
 
-def _score_no_bg(ip_coverage, num_std, min_length):
-    raise NotImplementedError("Scoring has yet to be implemented.")
+    try:
+        ip_file = _coverage_file(ip_coverage, temporary)
+        bg_file = None
+        if bg_coverage is not None:
+            bg_file = _coverage_file(bg_coverage, temporary)
 
+        # Start the longest sequences first, so one long chromosome is not
+        # left running on its own at the end.
+        order = sorted(range(len(sequences)),
+                       key=lambda i: -ip_coverage.get_length(sequences[i]))
 
-def _score_vs_bg(ip_coverage, bg, min_length):
-    pass
+        with parallel.pool(processes, _init_worker,
+                           (ip_file, bg_file, settings)) as workers:
+            results = workers.map(_score_worker,
+                                  [sequences[i] for i in order], chunksize=1)
+    finally:
+        for filename in temporary:
+            os.remove(filename)
+
+    scores = [None] * len(sequences)
+    for i, columns in zip(order, results):
+        scores[i] = columns
+
+    return scores
+
+def _coverage_file(coverage, temporary):
+    """
+    Returns the name of a file holding the coverage.  Coverage that is not
+    already on disk is saved to a temporary file, whose name is added to
+    temporary.
+    """
+    if isinstance(coverage, DiskBasedGenomeCoverage):
+        return coverage.filename
+
+    handle, filename = tempfile.mkstemp(suffix=".cov")
+    os.close(handle)
+    temporary.append(filename)
+    coverage.save(filename)
+
+    return filename
+
+def _init_worker(ip_file, bg_file, settings):
+    """Opens the coverage files once in each worker process"""
+    parallel.state["ip"] = DiskBasedGenomeCoverage(ip_file)
+    parallel.state["bg"] = None
+    if bg_file is not None:
+        parallel.state["bg"] = DiskBasedGenomeCoverage(bg_file)
+    parallel.state["settings"] = settings
+
+def _score_worker(sequence):
+    """Scores one sequence in a worker process"""
+    ip = parallel.state["ip"].get_coverage_as_array(sequence)
+    bg = _background_array(parallel.state["bg"], sequence)
+
+    return _score_sequence(ip, bg, *parallel.state["settings"])
+
+def _score_sequence(ip, bg, scale, floor, window, threshold, min_length,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Scores the coverage of one sequence.  The windows are scored chunk_size
+    at a time, so memory use depends on the chunk size rather than the
+    length of the sequence, and a run of significant windows still open at
+    the end of one chunk is carried into the next.
+
+    :param ip: the IP coverage, as a (2, length) strand array
+    :type ip: numpy.ndarray
+    :param bg: the background coverage, as a (2, length) strand array, or
+               None to expect the floor in every window
+    :type bg: numpy.ndarray
+    :param scale: the factor scaling background coverage to the IP depth
+    :type scale: float
+    :param floor: the smallest expected coverage of a window
+    :type floor: float
+    :param chunk_size: the number of windows scored at once
+    :type chunk_size: int
+    :return a tuple of arrays of the form
+            (starts, ends, heights, mean p-values, shifts)
+    :rtype tuple
+    """
+    length = ip.shape[1]
+    if length < window or floor <= 0:
+        return _no_peaks()
+
+    critical = None
+    if bg is None:
+        # Every window expects the floor, so one count decides them all
+        critical = int(poisson_critical_count(floor, threshold))
+
+    # Runs of positions covered by significant windows, as arrays of
+    # (starts, exclusive ends, p-value sums, window counts) per chunk
+    runs = []
+    open_run = None
+    num_windows = length - window + 1
+
+    for first in range(0, num_windows, chunk_size):
+        last = min(first + chunk_size, num_windows)
+        windows, pvals = _significant_windows(ip, bg, scale, floor, window,
+                                              threshold, critical, first,
+                                              last)
+        if len(windows) == 0:
+            continue
+
+        # A window joins the run before it if it starts inside or right
+        # after it, as the positions they cover are then contiguous.
+        carry = -1 if open_run is None else open_run[1]
+        max_ends = np.maximum.accumulate(
+            np.concatenate(([carry], windows + window)))
+        new = windows > max_ends[:-1]
+        continues = open_run is not None and not new[0]
+        new[0] = True
+
+        firsts = np.flatnonzero(new)
+        lasts = np.append(firsts[1:], len(windows)) - 1
+        starts = windows[firsts]
+        ends = max_ends[1:][lasts]
+        sums = np.add.reduceat(pvals, firsts)
+        counts = np.diff(np.append(firsts, len(windows)))
+
+        if continues:
+            starts[0] = open_run[0]
+            sums[0] += open_run[2]
+            counts[0] += open_run[3]
+        elif open_run is not None:
+            runs.append(tuple(np.array([v]) for v in open_run))
+
+        runs.append((starts[:-1], ends[:-1], sums[:-1], counts[:-1]))
+        open_run = (starts[-1], ends[-1], sums[-1], counts[-1])
+
+    if open_run is not None:
+        runs.append(tuple(np.array([v]) for v in open_run))
+    if not runs:
+        return _no_peaks()
+
+    starts, ends, sums, counts = [np.concatenate(c) for c in zip(*runs)]
+    keep = ends - starts >= min_length
+    starts = starts[keep].astype(np.int64)
+    ends = ends[keep].astype(np.int64)
+    mean_pvals = sums[keep] / counts[keep]
+
+    heights = np.zeros(len(starts), dtype=np.int64)
+    shifts = np.zeros(len(starts), dtype=np.int64)
+    for i in range(len(starts)):
+        reverse = ip[0, starts[i]:ends[i]]
+        forward = ip[1, starts[i]:ends[i]]
+        heights[i] = (reverse.astype(np.int64) + forward).max()
+        shifts[i] = reverse.argmax() - forward.argmax()
+
+    # Peaks cover positions start to end inclusive
+    return starts, ends - 1, heights, mean_pvals, shifts
+
+def _significant_windows(ip, bg, scale, floor, window, threshold, critical,
+                         first, last):
+    """
+    Finds the significant windows among those starting at positions first
+    to last - 1.
+
+    :param critical: the smallest significant count of every window, or None
+                     to find it from the background coverage
+    :type critical: int
+    :return a tuple of the form (window starts, p-values)
+    :rtype tuple
+    """
+    stop = last + window - 1
+    counts = _window_counts(ip, first, stop, window)
+
+    if critical is not None:
+        windows = np.flatnonzero(counts >= critical)
+        pvals = poisson_sf(counts[windows], floor)
+        return windows + first, pvals
+
+    expected = np.maximum(_window_counts(bg, first, stop, window) * scale,
+                          floor)
+
+    # Rather than computing a p-value for every window, find the smallest
+    # significant count for each distinct expected coverage.
+    means, inverse = np.unique(expected, return_inverse=True)
+    windows = np.flatnonzero(counts >= poisson_critical_count(
+        means, threshold)[inverse.ravel()])
+    pvals = poisson_sf(counts[windows], expected[windows])
+
+    return windows + first, pvals
+
+def _window_counts(coverage, start, stop, window):
+    """
+    Returns the coverage of both strands summed over each window lying in
+    positions start to stop - 1.  Positions past the end of the coverage
+    count as zero.
+    """
+    total = np.zeros(stop - start, dtype=np.int64)
+    held = coverage[:, start:stop]
+    total[:held.shape[1]] = held[0]
+    total[:held.shape[1]] += held[1]
+
+    # Window sums from a cumulative sum: counts[i] covers i to i + window - 1
+    cumulative = np.concatenate(([0], np.cumsum(total)))
+    return cumulative[window:] - cumulative[:-window]
+
+def _no_peaks():
+    """Returns the columns of an empty set of peaks"""
+    return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64),
+            np.zeros(0, dtype=np.int64))
+
+def _table_from_scores(sequence, columns):
+    """Converts the columns from _score_sequence into a PeakTable"""
+    starts, ends, heights, mean_pvals, shifts = columns
+
+    return PeakTable([sequence], np.zeros(len(starts), dtype=np.int32),
+                     starts, ends, heights,
+                     {"mean_pval": mean_pvals, "shift": shifts},
+                     _peak_from_table)
 
 class PoissonPeak(ChipPeak):
     """
     A peak generated by the MATLAB or Python scripts for scoring against
     a Poisson background
     """
+    __slots__ = ("height", "mean_pval", "shift")
+
     def __init__(self, chromosome, start, stop, height, mean_p, shift):
         """
         Create a new Poisson-identified Peak
@@ -2,10 +2,27 @@
 Parser for the SICER ChIP-seq program.  This is designed to parse
 the summary file generated as output
 """
+import numpy as np
 from transnet.chipseq.chip_peak import ChipPeak
+from transnet.chipseq.peak_table import PeakTable, concatenate
+from transnet.instrumentation import instrumented
+from transnet.parsing import DEFAULT_BATCH_SIZE, MAX_NAME_LENGTH, \
+                             check_names, encode_chromosomes, parse_blocks
 
 __author__ = 'Matthew Peterson'
 
+_SICER_FIELDS = np.dtype([("chromosome", str, MAX_NAME_LENGTH),
+                          ("start", np.int64), ("stop", np.int64),
+                          ("island_read_count", np.int64),
+                          ("control_read_count", np.int64),
+                          ("p_value", np.float64), ("fold_change", np.float64),
+                          ("fdr", np.float64)])
+
+_SICER_RB_FIELDS = np.dtype([("chromosome", str, MAX_NAME_LENGTH),
+                             ("start", np.int64), ("stop", np.int64),
+                             ("island_score", np.float64)])
+
+@instrumented("sicer.parse")
 def parse(handle, method = "sicer"):
     """
     Returns an iterator of SicerPeaks
@@ -27,6 +44,7 @@ def parse(handle, method = "sicer"):
         peak = peak_class_map[method](line)
         yield peak
 
+@instrumented("sicer.read", count=len)
 def read(handle, method = "sicer"):
     """
     Returns a list, if we need to keep this around
@@ -34,12 +52,94 @@ def read(handle, method = "sicer"):
     Parameters:
     - `handle`: A file handle to the SICER output file to be read
     """
-    return list(parse(handle))
+    return list(parse(handle, method))
+
+@instrumented("sicer.parse_table", count=len)
+def parse_table(handle, method = "sicer", batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Reads the SICER output in blocks.  Returns an iterator of PeakTables of
+    at most batch_size peaks each; see read_table() for their columns.
+
+    Parameters:
+    - `handle`: A file handle to the SICER output file to be parsed
+    - `method`: One of 'sicer' or 'sicer_rb'
+    - `batch_size`: The maximum number of peaks in each table
+    """
+    if method == "sicer":
+        for block in parse_blocks(handle, _SICER_FIELDS, batch_size):
+            yield _sicer_table_from_block(block)
+    elif method == "sicer_rb":
+        for block in parse_blocks(handle, _SICER_RB_FIELDS, batch_size, None):
+            yield _sicer_rb_table_from_block(block)
+    else:
+        raise KeyError("Unsupported method. Select one of 'sicer' or "
+                       "sicer_rb")
+
+@instrumented("sicer.read_table", count=len)
+def read_table(handle, method = "sicer", batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Returns the peaks as a PeakTable.  For 'sicer' output, the table has
+    island_read_count, control_read_count, p_value, fold_change and fdr
+    columns, and the score column holds the fold change.  For 'sicer_rb'
+    output, the score column holds the island score.
+
+    Parameters:
+    - `handle`: A file handle to the SICER output file to be read
+    - `method`: One of 'sicer' or 'sicer_rb'
+    """
+    tables = list(parse_table(handle, method, batch_size))
+    if tables:
+        return concatenate(tables)
+
+    if method == "sicer":
+        return _sicer_table_from_block(np.zeros(0, dtype=_SICER_FIELDS))
+
+    return _sicer_rb_table_from_block(np.zeros(0, dtype=_SICER_RB_FIELDS))
+
+def _sicer_table_from_block(block):
+    """Converts a block of records from parse_blocks into a PeakTable"""
+    chromosomes, codes = encode_chromosomes(block["chromosome"])
+    check_names(chromosomes)
+    table = PeakTable(chromosomes, codes, block["start"], block["stop"],
+                      block["fold_change"],
+                      {"island_read_count": block["island_read_count"],
+                       "control_read_count": block["control_read_count"],
+                       "p_value": block["p_value"],
+                       "fdr": block["fdr"]},
+                      _sicer_peak_from_table)
+    table.columns["fold_change"] = table.scores
+
+    return table
+
+def _sicer_rb_table_from_block(block):
+    """Converts a block of records from parse_blocks into a PeakTable"""
+    chromosomes, codes = encode_chromosomes(block["chromosome"])
+    check_names(chromosomes)
+    return PeakTable(chromosomes, codes, block["start"], block["stop"],
+                     block["island_score"], None, _sicer_rb_peak_from_table)
+
+def _sicer_peak_from_table(table, i):
+    """Creates a SicerPeak from a row of a PeakTable"""
+    return SicerPeak.from_fields(table.chromosome(i), int(table.starts[i]),
+                                 int(table.ends[i]),
+                                 int(table.columns["island_read_count"][i]),
+                                 int(table.columns["control_read_count"][i]),
+                                 float(table.columns["p_value"][i]),
+                                 float(table.scores[i]),
+                                 float(table.columns["fdr"][i]))
+
+def _sicer_rb_peak_from_table(table, i):
+    """Creates a SicerRBPeak from a row of a PeakTable"""
+    return SicerRBPeak.from_fields(table.chromosome(i), int(table.starts[i]),
+                                   int(table.ends[i]), float(table.scores[i]))
 
 class SicerPeak(ChipPeak):
     """
     A region of binding identified by SICER
-    """    
+    """
+    __slots__ = ("island_read_count", "control_read_count", "p_value",
+                 "fold_change", "fdr")
+
     def __init__(self, input_line):
         """
         Creates a new SicerPeak object
@@ -62,6 +162,23 @@ class SicerPeak(ChipPeak):
         self.p_value = float(tokens[5])
         self.fold_change = float(tokens[6])
         self.fdr = float(tokens[7])
+
+    @classmethod
+    def from_fields(cls, chromosome, start, stop, island_read_count,
+                    control_read_count, p_value, fold_change, fdr):
+        """
+        Creates a new SicerPeak from values that have already been parsed.
+        Takes the same values, in the same order, as a line of SICER output.
+        """
+        peak = cls.__new__(cls)
+        ChipPeak.__init__(peak, chromosome, start, stop)
+        peak.island_read_count = island_read_count
+        peak.control_read_count = control_read_count
+        peak.p_value = p_value
+        peak.fold_change = fold_change
+        peak.fdr = fdr
+
+        return peak
     
     def score(self):
         return self.fold_change
@@ -70,6 +187,8 @@ class SicerRBPeak(ChipPeak):
     """
     A region of binding identified by SICER (no background)
     """
+    __slots__ = ("island_score",)
+
     def __init__(self, input_line):
         """
         Creates a new SicerRBPeak
@@ -85,8 +204,19 @@ class SicerRBPeak(ChipPeak):
         tokens = input_line.rstrip("\r\n").split()
         super(SicerRBPeak, self).__init__(tokens[0], int(tokens[1]),
                                         int(tokens[2]))
-        self.score = float(tokens[3])
+        self.island_score = float(tokens[3])
+
+    @classmethod
+    def from_fields(cls, chromosome, start, stop, island_score):
+        """
+        Creates a new SicerRBPeak from values that have already been parsed.
+        """
+        peak = cls.__new__(cls)
+        ChipPeak.__init__(peak, chromosome, start, stop)
+        peak.island_score = island_score
+
+        return peak
     
     def score(self):
-        return self.score
+        return self.island_score
 
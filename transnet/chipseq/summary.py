@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+from transnet.chipseq.chip_peak import annotate
+from transnet.instrumentation import stage
+
+TEXT_SUMMARY_HEADER = "Chromosome\tStart\tStop\tHeight\tUpstream\t" + \
+                      "Downstream\tGenic\n"
 
 def write_summary_html(peaks, out_dir):
     """
@@ -28,21 +33,37 @@ def write_text_summary(peaks, annotation, out_handle=sys.stdout):
     :param peaks: a list of peaks
     :param annotation: A Genome object, used to call genes
     """
-    out_handle.write("Chromosome\tStart\tStop\tHeight\tUpstream\t" +
-                     "Downstream\tGenic\n")
+    with stage("summary.write_text_summary") as summary:
+        out_handle.write(TEXT_SUMMARY_HEADER)
+
+        peaks = list(peaks)
+        regulated_genes = annotate(peaks, annotation)
+
+        with stage("summary.format") as formatting:
+            for line in text_summary_lines(peaks, regulated_genes):
+                out_handle.write(line)
 
-    for peak in peaks:
-        (upstream, downstream, genic) = peak.get_regulated_genes(annotation)
+            formatting.add(len(peaks))
+        summary.add(len(peaks))
 
-        genic_string = ",".join([g.locus for g in genic])
-        us_string = ",".join([g.locus for g in upstream])
-        ds_string = ",".join([g.locus for g in downstream])
+def text_summary_lines(peaks, regulated_genes):
+    """
+    Returns an iterator of the lines of a text summary (see
+    write_text_summary), without the header.  The genes in each column are
+    sorted by locus, so the summary does not depend on the order of the
+    annotation's sets.
 
-        out_handle.write("%s\t%d\t%d\t%f\t%s\t%s\t%s\n" % (peak.chromosome,
-                                                           peak.chrom_start,
-                                                           peak.chrom_end,
-                                                           peak.score(),
-                                                           us_string,
-                                                           ds_string,
-                                                           genic_string))
+    :param peaks: a list of peaks
+    :param regulated_genes: the (upstream, downstream, genic) tuple of each
+                            peak, as returned by annotate()
+    """
+    for peak, (upstream, downstream, genic) in zip(peaks, regulated_genes):
+        genic_string = ",".join(sorted([g.locus for g in genic]))
+        us_string = ",".join(sorted([g.locus for g in upstream]))
+        ds_string = ",".join(sorted([g.locus for g in downstream]))
 
+        yield "%s\t%d\t%d\t%f\t%s\t%s\t%s\n" % (peak.chromosome,
+                                                peak.chrom_start,
+                                                peak.chrom_end, peak.score(),
+                                                us_string, ds_string,
+                                                genic_string)
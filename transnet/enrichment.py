@@ -1,15 +1,191 @@
-# Tests for enrichment
+"""
+Functional enrichment of gene sets, for example testing the genes
+implicated by a set of ChIP-seq peaks for over-represented GO terms.
+"""
+import numpy as np
+from transnet.stats import benjamini_hochberg, hypergeometric_sf, \
+                           log_factorial
+
 __author__ = "Matthew Peterson"
 
+_RESULT_FIELDS = np.dtype([("term", np.int32), ("overlap", np.int32),
+                           ("term_size", np.int32), ("set_size", np.int32),
+                           ("pvalue", np.float64), ("qvalue", np.float64)])
+
 def read_mapping(handle, key="function"):
     """
-    Reads a mapping from genes to 
+    Reads a mapping from genes to terms (GO terms, PFAM domains, etc.).  Each
+    line holds a gene followed by one or more tab-separated terms, and a gene
+    may appear on more than one line.
+
+    :param handle: the handle to be read from
+    :type handle: file
+    :return a dictionary mapping each gene to a list of its terms
+    :rtype dict
     """
     features = {}
-    
+
     handle = iter(handle)
     for line in handle:
         tokens = line.rstrip("\r\n").split("\t")
-        features[tokens[0]] = tokens[1]
-    
+        if not tokens[0]:
+            continue
+
+        terms = features.setdefault(tokens[0], [])
+        for t in tokens[1:]:
+            if t and t not in terms:
+                terms.append(t)
+
     return features
+
+class Enrichment(object):
+    """
+    Tests gene sets for enrichment of every term in a mapping at once, using
+    the hypergeometric distribution (equivalently, a one-sided Fisher's
+    exact test), with Benjamini-Hochberg correction over the terms tested.
+
+    The terms of every gene are held as one array of term indexes, sorted by
+    gene, so the overlaps of a gene set with every term are counted with a
+    single bincount over the terms of its genes.
+    """
+    def __init__(self, mapping, background=None):
+        """
+        Create a new Enrichment test.
+
+        :param mapping: a mapping from each gene to a list of its terms, as
+                        returned by read_mapping
+        :type mapping: dict
+        :param background: the genes that could have been selected, e.g.
+                           every gene in the genome.  Defaults to the genes
+                           in the mapping.  Genes outside the background are
+                           ignored.
+        :type background: iterable
+        """
+        if background is None:
+            background = mapping.keys()
+
+        self.genes = sorted(set(_locus(g) for g in background))
+        self.gene_index = dict((g, i) for i, g in enumerate(self.genes))
+
+        term_genes = {}
+        for gene, terms in mapping.items():
+            gene = _locus(gene)
+            if gene in self.gene_index:
+                for t in terms:
+                    term_genes.setdefault(t, []).append(self.gene_index[gene])
+
+        self.terms = sorted(term_genes)
+        self.term_index = dict((t, i) for i, t in enumerate(self.terms))
+
+        members = [np.unique(term_genes[t]) for t in self.terms]
+        self.term_sizes = np.array([len(m) for m in members], dtype=np.int32)
+
+        genes = np.concatenate([np.zeros(0, dtype=np.int64)] + members)
+        terms = np.repeat(np.arange(len(self.terms)), self.term_sizes)
+        order = np.argsort(genes, kind="mergesort")
+        self._gene_terms = terms[order].astype(np.int32)
+        self._gene_offsets = np.zeros(len(self.genes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(genes, minlength=len(self.genes)),
+                  out=self._gene_offsets[1:])
+
+        self._log_factorials = log_factorial(len(self.genes))
+
+    def test(self, genes, min_overlap=1):
+        """
+        Tests a gene set for enrichment of every term.
+
+        Returns a structured array with a row for each term sharing at least
+        min_overlap genes with the set, sorted by p-value, with the fields:
+
+        * term - an index into terms
+        * overlap - the number of genes in both the set and the term
+        * term_size - the number of background genes with the term
+        * set_size - the number of background genes in the set
+        * pvalue - the probability of an overlap at least this large
+        * qvalue - the Benjamini-Hochberg adjusted p-value
+
+        :param genes: the gene set, as loci or Genes
+        :type genes: iterable
+        :param min_overlap: the smallest overlap of a term to be tested
+        :type min_overlap: int
+        :rtype: numpy.ndarray
+        """
+        return self.test_many([genes], min_overlap)[0]
+
+    def test_many(self, gene_sets, min_overlap=1):
+        """
+        Tests many gene sets for enrichment of every term, computing the
+        p-values of every set and term together.
+
+        :param gene_sets: a list of gene sets, as for test()
+        :type gene_sets: list
+        :param min_overlap: the smallest overlap of a term to be tested
+        :type min_overlap: int
+        :return a list of result arrays, as from test(), one for each set
+        :rtype list
+        """
+        gene_sets = list(gene_sets)
+        overlaps = self._overlaps(gene_sets)
+        set_sizes = np.array([len(self._indexes(s)) for s in gene_sets],
+                             dtype=np.int32)
+
+        tested_set, tested_term = np.nonzero(overlaps >= max(min_overlap, 1))
+        pvalues = hypergeometric_sf(overlaps[tested_set, tested_term],
+                                    len(self.genes),
+                                    self.term_sizes[tested_term],
+                                    set_sizes[tested_set],
+                                    self._log_factorials)
+
+        results = []
+        # np.nonzero returns the rows of each set together, in order
+        bounds = np.searchsorted(tested_set, np.arange(len(gene_sets) + 1))
+        for i in range(len(gene_sets)):
+            rows = slice(bounds[i], bounds[i + 1])
+            terms = tested_term[rows]
+
+            result = np.empty(len(terms), dtype=_RESULT_FIELDS)
+            result["term"] = terms
+            result["overlap"] = overlaps[i, terms]
+            result["term_size"] = self.term_sizes[terms]
+            result["set_size"] = set_sizes[i]
+            result["pvalue"] = pvalues[rows]
+            result["qvalue"] = benjamini_hochberg(pvalues[rows])
+
+            results.append(result[np.argsort(result["pvalue"],
+                                             kind="mergesort")])
+
+        return results
+
+    def _overlaps(self, gene_sets):
+        """
+        Returns the number of genes each set shares with each term, as an
+        array of shape (sets, terms).
+        """
+        overlaps = np.zeros((len(gene_sets), len(self.terms)), dtype=np.int32)
+
+        for i, genes in enumerate(gene_sets):
+            indexes = self._indexes(genes)
+            starts = self._gene_offsets[indexes]
+            counts = self._gene_offsets[indexes + 1] - starts
+
+            # The positions of the terms of every gene in the set
+            positions = np.arange(counts.sum()) + \
+                        np.repeat(starts - np.cumsum(counts) + counts, counts)
+            overlaps[i] = np.bincount(self._gene_terms[positions],
+                                      minlength=len(self.terms))
+
+        return overlaps
+
+    def _indexes(self, genes):
+        """Returns the indexes of the background genes in a gene set"""
+        indexes = set()
+        for g in genes:
+            g = _locus(g)
+            if g in self.gene_index:
+                indexes.add(self.gene_index[g])
+
+        return np.array(sorted(indexes), dtype=np.int64)
+
+def _locus(gene):
+    """Returns the locus of a Gene, or the gene itself if it is a locus"""
+    return getattr(gene, "locus", gene)
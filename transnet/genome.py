@@ -1,13 +1,53 @@
 """
 Classes describing Genomes and genes
+
+A parsed Genome can be saved as a binary snapshot with Genome.save() and
+opened again with load().  Loading a snapshot memory-maps it and uses its
+arrays in place: nothing is parsed or sorted, and no Gene or
+IntergenicRegion objects are created until a query returns them, so a
+snapshot opens in milliseconds and processes that load the same snapshot
+share one copy of the genome.  All values are little-endian:
+
+* 8 bytes: the magic string 'TNETGEN2'
+* uint64: the length of the header in bytes
+* the header, a UTF-8 encoded JSON object holding the chromosome names,
+  the circular chromosomes, the annotation keys and terms, and the dtype,
+  shape and offset of each array
+* padding up to the next multiple of 8 bytes, where the arrays start
+* the arrays, each at its offset from the start of the arrays.  Offsets are
+  aligned to 8 bytes.
+
+Genes are stored in rank order, as arrays of chromosome codes, starts,
+stops and exons, with their loci, strands and names as UTF-8 text and the
+offset of each string.  Intergenic regions are stored as the ranks of their
+flanking genes.  The overlap index of each chromosome is stored as the
+starts, ends and running maximum of the ends of its genes and intergenic
+regions, sorted by start and end, with the rank of each gene and the bitwise
+complement of the position of each intergenic region.  Annotations are
+stored as their bitsets.
 """
-from operator import attrgetter
-from interval import Interval
+from operator import attrgetter, index as _as_index
+from transnet.interval import Interval, IntervalIndex, chromosome_code
+from transnet.instrumentation import instrumented
 from collections import defaultdict
+import json
+import struct
+import numpy as np
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 
 __author__ = 'Matthew Peterson'
 
-def read(handle, format, mapping=None):
+LINEAR = "linear"
+CIRCULAR = "circular"
+
+_MAGIC = b"TNETGEN2"
+
+@instrumented("genome.read", count=lambda genome: len(genome.gene_dict))
+def read(handle, format, mapping=None, circular=()):
     """
     Read a genome from an annotation.
 
@@ -20,6 +60,8 @@ def read(handle, format, mapping=None):
     - `mapping`: A dictionary mapping of chromosome names to another set. Can
                  be used if two files use different naming systems to avoid
                  having to rewrite files.
+    - `circular`: The names of any chromosomes that are circular.  All other
+                  chromosomes are treated as linear.
     """
     if format == "broad":
         genes = _read_broad_summary(handle, mapping)
@@ -37,11 +79,53 @@ def read(handle, format, mapping=None):
     for g in genes:
         genome.gene_dict[g.locus] = g
 
+    for chromosome in circular:
+        genome.set_topology(chromosome, CIRCULAR)
+
+    genome.build_index()
+
     return genome
 
+def load(filename):
+    """
+    Opens a genome snapshot written by Genome.save().  The snapshot is
+    memory-mapped and its arrays are used in place, so processes that load
+    the same snapshot share one copy of them.  Genes and intergenic regions
+    are created the first time a query returns them.
+
+    :param filename: the name of the snapshot
+    :type filename: string
+    :rtype: SnapshotGenome
+    """
+    # Plain views of the map are much quicker to index than memmaps
+    data = np.memmap(filename, dtype=np.uint8, mode="r").view(np.ndarray)
+    if data[:len(_MAGIC)].tobytes() != _MAGIC:
+        raise ValueError("%s is not a genome snapshot, or was saved by an "
+                         "older version of TransNet." % filename)
+
+    position = len(_MAGIC)
+    (header_size,) = struct.unpack("<Q", data[position:position + 8].tobytes())
+    position += 8
+    header = json.loads(
+        data[position:position + header_size].tobytes().decode("utf-8"))
+    position = _align(position + header_size)
+
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dtype = np.dtype(str(dtype))
+        size = int(np.prod(shape)) * dtype.itemsize
+        start = position + offset
+        arrays[str(name)] = data[start:start + size].view(dtype).reshape(shape)
+
+    return SnapshotGenome(filename, header, arrays)
+
 def _read_bed(handle):
     """
-    Reads a genome annotation from a BED-formatted file
+    Reads a genome annotation from a BED-formatted file.  The strand is
+    read from the sixth column if present, and the exons from the block
+    columns of BED12 files.  Genes without blocks are a single exon.
+    Blocks are half-open in BED, so each exon ends one position before
+    its block does.
 
     Parameters:
     - `handle`: Handle to the file to be read
@@ -55,7 +139,19 @@ def _read_bed(handle):
         start = int(tokens[1])
         stop = int(tokens[2])
         locus = tokens[3]
-        genes.append(Gene(chromosome, start, stop, locus))
+
+        strand = "+"
+        if len(tokens) > 5 and tokens[5] in ("+", "-"):
+            strand = tokens[5]
+
+        exons = None
+        if len(tokens) >= 12:
+            sizes = [int(t) for t in tokens[10].rstrip(",").split(",")]
+            offsets = [int(t) for t in tokens[11].rstrip(",").split(",")]
+            exons = [(start + o, start + o + n - 1)
+                     for o, n in zip(offsets, sizes)]
+
+        genes.append(Gene(chromosome, start, stop, locus, strand, exons))
 
     genes = _sort_genes(genes)
 
@@ -103,21 +199,44 @@ def _sort_genes(genes):
 def _create_intergenic_regions(genes):
     _intergenic_regions = []
     for i in range(1, len(genes)):
-        if genes[i].chromosome != genes[i-1].chromosome:
+        if genes[i].chrom_code != genes[i-1].chrom_code:
             continue
         _intergenic_regions.append(IntergenicRegion(genes[i-1], genes[i]))
     return _intergenic_regions
 
 class Gene(Interval):
     """
-    A gene.
+    A gene.  Genes read from Broad summaries also have a name.
     """
-    annotations = defaultdict(list)
+    __slots__ = ("locus", "strand", "exons", "name")
+
+    def __init__(self, chromosome, start, stop, locus, strand = "+",
+                 exons = None):
+        """
+        Create a new Gene.
 
-    def __init__(self, chromosome, start, stop, locus, strand = "+"):
+        Parameters:
+
+        - `exons`: A list of (start, stop) tuples giving the exons of the
+                   gene, in the same coordinates as the gene.  Like the
+                   gene's own chrom_start and chrom_end, both ends are
+                   included in the exon.  If None, the whole gene is a
+                   single exon.
+        """
         super(Gene, self).__init__(chromosome, start, stop)
         self.locus = locus
         self.strand = strand
+        self.exons = exons
+
+    def get_exons(self):
+        """
+        Returns a list of (start, stop) tuples giving the exons of the gene.
+        Both ends are included in each exon.
+        """
+        if self.exons is None:
+            return [(self.chrom_start, self.chrom_end)]
+
+        return self.exons
 
     def __str__(self):
         return self.locus
@@ -127,6 +246,8 @@ class IntergenicRegion(Interval):
     """
     A region between two genes
     """
+    __slots__ = ("left_gene", "right_gene", "identifier")
+
     def __init__(self, first_gene, second_gene):
         """
         Create a new IntergenicRegion.  Throws an error if the genes are
@@ -137,7 +258,7 @@ class IntergenicRegion(Interval):
         - `first_gene`: The gene to the "left"
         - `second_gene`: The gene to the "right"
         """
-        if first_gene.chromosome != second_gene.chromosome:
+        if first_gene.chrom_code != second_gene.chrom_code:
             raise ValueError("Genes must be on same chromosome.")
 
         self.left_gene = first_gene
@@ -153,24 +274,114 @@ class IntergenicRegion(Interval):
 class Genome(object):
     """
     A genome (comprised of genic regions and intergenic regions)
-
-    TODO: Incorporate exons for RPKM calculations
     """
     def __init__(self):
         self.gene_dict = {}
         self.intergenic_regions = []
+        self.topology = {}
+        self.genes = None
+        self.gene_rank = None
+        self._chromosome_bounds = None
+        # The overlap index of each chromosome, keyed by chromosome code
+        self._features = None
+        self._exons = None
+        self._annotations = {}
+        # The snapshot the genome was loaded from, if any
+        self.snapshot_file = None
 
     def add_annotation(self, key, mapping_dict):
         """
-        Adds an annotation (For example, GO, PFAM, etc) to a genome.
+        Adds an annotation (For example, GO, PFAM, etc) to a genome.  Each
+        term is stored as a bitset over the genes, indexed by gene rank, so
+        annotations should be added once the set of genes is final.  Adding
+        an existing key replaces it.
+
+        :param key: the name of the annotation, e.g. 'GO'
+        :type key: string
+        :param mapping_dict: a mapping from locus to a term, or to a list of
+                             terms (as returned by enrichment.read_mapping)
+        :type mapping_dict: dict
         """
+        self._check_index()
 
-        # TODO: implement check to see if key already exists.
-        for gene, annotation in mapping_dict:
-            if gene not in self.genes:
+        ranks = defaultdict(list)
+        for gene, terms in mapping_dict.items():
+            if gene not in self.gene_rank:
                 raise ValueError("Gene %s not in Genome" % gene)
 
-            self.gene_dict[gene].annotation[key].append(annotation)
+            if not isinstance(terms, (list, tuple, set)):
+                terms = [terms]
+            for t in terms:
+                ranks[t].append(self.gene_rank[gene])
+
+        self._annotations[key] = dict((t, self._pack(r))
+                                      for t, r in ranks.items())
+
+    def annotation_terms(self, key):
+        """
+        Returns a sorted list of the terms in an annotation.
+
+        :param key: the name of the annotation
+        :type key: string
+        """
+        return sorted(self._annotations[key])
+
+    def annotated_genes(self, key, term):
+        """
+        Returns the genes annotated with a term, as a GeneSet.  GeneSets can
+        be combined with &, | and -, e.g. to find the genes with a term that
+        are also implicated by a set of peaks:
+
+            genome.annotated_genes("GO", term) & genome.gene_set(targets)
+
+        :param key: the name of the annotation
+        :type key: string
+        :param term: the term
+        :type term: string
+        :rtype: GeneSet
+        """
+        bits = self._annotations[key].get(term)
+        if bits is None:
+            return self.gene_set(())
+
+        return GeneSet(self, bits)
+
+    def get_annotations(self, gene, key):
+        """
+        Returns a sorted list of the terms a gene is annotated with.
+
+        :param gene: the gene, or its locus
+        :param key: the name of the annotation
+        :type key: string
+        """
+        self._check_index()
+
+        rank = self.gene_rank[getattr(gene, "locus", gene)]
+        byte, bit = divmod(rank, 8)
+        mask = 0x80 >> bit
+
+        return sorted(t for t, bits in self._annotations[key].items()
+                      if bits[byte] & mask)
+
+    def gene_set(self, genes):
+        """
+        Returns a GeneSet holding a collection of genes.
+
+        :param genes: the genes, as Genes or loci
+        :type genes: iterable
+        :rtype: GeneSet
+        """
+        self._check_index()
+
+        return GeneSet(self, self._pack(
+            [self.gene_rank[getattr(g, "locus", g)] for g in genes]))
+
+    def _pack(self, ranks):
+        """Returns a packed bitset with the bits for some gene ranks set"""
+        selected = np.zeros(len(self.genes), dtype=bool)
+        selected[list(ranks)] = True
+
+        return np.packbits(selected)
 
     def features(self, intergenic=False):
         """
@@ -186,3 +397,772 @@ class Genome(object):
         if intergenic:
             for i in self.intergenic_regions:
                 yield i
+
+    def build_index(self):
+        """
+        Builds the ordered gene list, gene ranks and the per-chromosome
+        overlap indexes over genes and intergenic regions.  This is done by
+        read(), but must be called again if gene_dict or intergenic_regions
+        are modified afterwards.
+        """
+        self.genes = _sort_genes(self.features(False))
+        self.gene_rank = dict((g.locus, i) for i, g in enumerate(self.genes))
+
+        self._chromosome_bounds = {}
+        for i, g in enumerate(self.genes):
+            if g.chrom_code not in self._chromosome_bounds:
+                self._chromosome_bounds[g.chrom_code] = [i, i + 1]
+            else:
+                self._chromosome_bounds[g.chrom_code][1] = i + 1
+
+        self._features = _index_features(self)
+        self._exons = _exons_by_chromosome(self.genes)
+
+    def overlapping_features(self, interval, genic=True, intergenic=True):
+        """
+        Returns a list of the features overlapping an interval.
+
+        :param interval: the interval to be queried
+        :type interval: Interval
+        :param genic: include overlapping genes
+        :type genic: bool
+        :param intergenic: include overlapping intergenic regions
+        :type intergenic: bool
+        :rtype: list
+        """
+        self._check_index()
+
+        if interval.chrom_code not in self._features or \
+           not (genic or intergenic):
+            return []
+
+        index, ids = self._features[interval.chrom_code]
+        ids = ids[index.positions(interval.chrom_start, interval.chrom_end)]
+        if not intergenic:
+            ids = ids[ids >= 0]
+        elif not genic:
+            ids = ids[ids < 0]
+
+        return [self._feature(i) for i in ids.tolist()]
+
+    def chromosome_features(self, chromosome, genic=True, intergenic=True):
+        """
+        Returns the features on a chromosome, sorted by start position.  The
+        genes and intergenic regions together are returned as the
+        chromosome's IntervalIndex, a read-only sequence that can also be
+        queried for overlaps; it only creates the features it is indexed
+        for, so use it rather than copying it to a list.
+
+        :param chromosome: the chromosome
+        :type chromosome: string
+        :param genic: include genes
+        :type genic: bool
+        :param intergenic: include intergenic regions
+        :type intergenic: bool
+        :rtype: sequence
+        """
+        self._check_index()
+
+        code = chromosome_code(chromosome)
+        if code not in self._features or not (genic or intergenic):
+            return IntervalIndex([]) if genic and intergenic else []
+
+        index, ids = self._features[code]
+        if genic and intergenic:
+            return index
+        if genic:
+            return self.chromosome_genes(chromosome)
+
+        return [self._feature(i) for i in ids[ids < 0].tolist()]
+
+    def first_feature(self, chromosome, position):
+        """
+        Returns the index in chromosome_features(chromosome) of the first
+        feature that can overlap position, or any position after it.  Every
+        earlier feature ends before position.
+
+        :param chromosome: the chromosome
+        :type chromosome: string
+        :param position: the position
+        :type position: int
+        :rtype: int
+        """
+        self._check_index()
+
+        code = chromosome_code(chromosome)
+        if code not in self._features:
+            return 0
+
+        return self._features[code][0].first(position)
+
+    def chromosome_genes(self, chromosome):
+        """
+        Returns a list of the genes on a chromosome, in order of position.
+
+        :param chromosome: the chromosome
+        :type chromosome: string
+        :rtype: list
+        """
+        self._check_index()
+
+        code = chromosome_code(chromosome)
+        if code not in self._chromosome_bounds:
+            return []
+
+        first, stop = self._chromosome_bounds[code]
+        return self.genes[first:stop]
+
+    def set_topology(self, chromosome, topology):
+        """
+        Sets whether a chromosome is linear or circular.  Chromosomes are
+        linear unless set otherwise.
+
+        :param chromosome: the chromosome
+        :type chromosome: string
+        :param topology: either LINEAR or CIRCULAR
+        :type topology: string
+        """
+        if topology not in (LINEAR, CIRCULAR):
+            raise ValueError("Topology must be one of '%s' or '%s'." %
+                             (LINEAR, CIRCULAR))
+
+        self.topology[chromosome] = topology
+
+    def is_circular(self, chromosome):
+        """
+        Returns True if a chromosome is circular.
+        """
+        return self.topology.get(chromosome, LINEAR) == CIRCULAR
+
+    def flanking_genes(self, gene):
+        """
+        Returns the genes immediately before and after a gene on its
+        chromosome.  On a linear chromosome, the first gene has no previous
+        gene and the last gene has no next gene, and None is returned in
+        their place.  Circular chromosomes wrap around.
+
+        :param gene: the gene
+        :type gene: Gene
+        :return a tuple of the form (previous gene, next gene)
+        :rtype tuple
+        """
+        self._check_index()
+
+        rank = self._rank(gene)
+        first, stop = self._chromosome_bounds[gene.chrom_code]
+
+        previous_idx = rank - 1
+        next_idx = rank + 1
+
+        if self.is_circular(gene.chromosome):
+            if previous_idx < first:
+                previous_idx = stop - 1
+            if next_idx == stop:
+                next_idx = first
+
+        previous_gene = None
+        next_gene = None
+
+        if previous_idx >= first:
+            previous_gene = self.genes[previous_idx]
+        if next_idx < stop:
+            next_gene = self.genes[next_idx]
+
+        return previous_gene, next_gene
+
+    def exon_lengths(self):
+        """
+        Returns the total exon length of each gene, in the order of
+        self.genes, as a numpy array.
+        """
+        self._check_index()
+
+        lengths = np.zeros(len(self.genes), dtype=np.int64)
+        for ranks, starts, ends in self._exons.values():
+            lengths += np.bincount(ranks, weights=ends - starts + 1,
+                                   minlength=len(self.genes)).astype(np.int64)
+
+        return lengths
+
+    def gene_counts(self, coverage, read_length=1):
+        """
+        Returns the number of reads over the exons of each gene, in the order
+        of self.genes, as a numpy array.  Exon coverage is summed for every
+        gene at once.
+
+        :param coverage: the read coverage
+        :type coverage: GenomeCoverage
+        :param read_length: the length of each read.  Summed coverage is
+                            divided by this to give a number of reads, so
+                            use 1 if the coverage counts read positions
+                            rather than every base of each read.
+        :type read_length: float
+        :rtype: numpy.ndarray
+        """
+        self._check_index()
+
+        counts = np.zeros(len(self.genes))
+        for chromosome, (ranks, starts, ends) in self._exons.items():
+            # Exons include their ends, and get_sums ranges do not
+            sums = coverage.get_sums(chromosome, starts, ends + 1)
+            counts += np.bincount(ranks, weights=sums,
+                                  minlength=len(self.genes))
+
+        return counts / read_length
+
+    def rpkm(self, coverage, read_length=1):
+        """
+        Returns the RPKM (reads per kilobase of exon per million mapped
+        reads) of every gene, as a dictionary keyed by locus.  All reads in
+        the coverage count towards the number of mapped reads.
+
+        :param coverage: the read coverage
+        :type coverage: GenomeCoverage
+        :param read_length: the length of each read, as for gene_counts
+        :type read_length: float
+        :rtype: dict
+        """
+        counts = self.gene_counts(coverage, read_length)
+        total = sum(coverage.get_sum(s, 0, coverage.get_length(s))
+                    for s in coverage.sequences()) / float(read_length)
+
+        values = np.zeros(len(self.genes))
+        if total > 0:
+            values = counts * 1e9 / (self.exon_lengths() * total)
+
+        return dict((g.locus, float(v)) for g, v in zip(self.genes, values))
+
+    def tpm(self, coverage, read_length=1):
+        """
+        Returns the TPM (transcripts per million) of every gene, as a
+        dictionary keyed by locus.
+
+        :param coverage: the read coverage
+        :type coverage: GenomeCoverage
+        :param read_length: the length of each read, as for gene_counts
+        :type read_length: float
+        :rtype: dict
+        """
+        rates = self.gene_counts(coverage, read_length) / self.exon_lengths()
+        total = rates.sum()
+
+        values = np.zeros(len(self.genes))
+        if total > 0:
+            values = rates * 1e6 / total
+
+        return dict((g.locus, float(v)) for g, v in zip(self.genes, values))
+
+    def save(self, filename):
+        """
+        Writes the genome, with its indexes and annotations, to a snapshot in
+        the binary format described at the top of this module, so it can be
+        opened with load().
+
+        :param filename: the name of the file to be written
+        :type filename: string
+        """
+        self._check_index()
+
+        chromosomes = []
+        codes = {}
+        for g in self.genes:
+            if g.chromosome not in codes:
+                codes[g.chromosome] = len(chromosomes)
+                chromosomes.append(g.chromosome)
+
+        exons = [g.get_exons() for g in self.genes]
+        exon_offsets = np.zeros(len(self.genes) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in exons], out=exon_offsets[1:])
+
+        intergenic_left = [self.gene_rank[r.left_gene.locus]
+                           for r in self.intergenic_regions]
+        intergenic_right = [self.gene_rank[r.right_gene.locus]
+                            for r in self.intergenic_regions]
+
+        arrays = [
+            ("chromosome", np.array([codes[g.chromosome] for g in self.genes],
+                                    dtype=np.int32)),
+            ("start", np.array([g.chrom_start for g in self.genes],
+                               dtype=np.int64)),
+            ("stop", np.array([g.chrom_end for g in self.genes],
+                              dtype=np.int64)),
+            ("named", np.array([hasattr(g, "name") for g in self.genes],
+                               dtype=np.uint8)),
+            ("has_exons", np.array([g.exons is not None for g in self.genes],
+                                   dtype=np.uint8)),
+            ("exon_offsets", exon_offsets),
+            ("exon_starts", np.array([start for e in exons
+                                      for start, _ in e], dtype=np.int64)),
+            ("exon_ends", np.array([stop for e in exons for _, stop in e],
+                                   dtype=np.int64)),
+            ("intergenic_left", np.array(intergenic_left, dtype=np.int64)),
+            ("intergenic_right", np.array(intergenic_right, dtype=np.int64)),
+        ]
+
+        for name, strings in (
+                ("loci", [g.locus for g in self.genes]),
+                ("strands", [g.strand for g in self.genes]),
+                ("names", [getattr(g, "name", "") for g in self.genes])):
+            data, offsets = _encode_strings(strings)
+            arrays.append((name, data))
+            arrays.append((name + "_offsets", offsets))
+
+        # The overlap indexes, one chromosome after another
+        indexes = [self._features[chromosome_code(c)] for c in chromosomes]
+        arrays.extend([
+            ("feature_ids", _concatenate([ids for _, ids in indexes])),
+            ("feature_starts", _concatenate([i.starts for i, _ in indexes])),
+            ("feature_ends", _concatenate([i.ends for i, _ in indexes])),
+            ("feature_max_ends", _concatenate([i.max_ends
+                                               for i, _ in indexes])),
+            ("feature_counts", np.array([len(i) for i, _ in indexes],
+                                        dtype=np.int64)),
+        ])
+
+        annotations = []
+        for i, key in enumerate(sorted(self._annotations)):
+            terms = sorted(self._annotations[key])
+            bits = np.zeros((len(terms), (len(self.genes) + 7) // 8),
+                            dtype=np.uint8)
+            for j, t in enumerate(terms):
+                bits[j] = self._annotations[key][t]
+            annotations.append((key, terms))
+            arrays.append(("annotation%d" % i, bits))
+
+        offset = 0
+        layout = {}
+        for name, array in arrays:
+            dtype = array.dtype.newbyteorder("<")
+            layout[name] = (dtype.str, list(array.shape), offset)
+            offset = _align(offset + array.nbytes)
+
+        header = json.dumps({
+            "chromosomes": chromosomes,
+            "circular": sorted(c for c in self.topology
+                               if self.is_circular(c)),
+            "annotations": annotations,
+            "arrays": layout}, sort_keys=True).encode("utf-8")
+
+        with open(filename, "wb") as handle:
+            handle.write(_MAGIC)
+            handle.write(struct.pack("<Q", len(header)))
+            handle.write(header)
+
+            start = _align(handle.tell())
+            for name, array in arrays:
+                handle.write(b"\0" * (start + layout[name][2] -
+                                      handle.tell()))
+                array.astype(layout[name][0]).tofile(handle)
+
+    def _feature(self, feature_id):
+        """
+        Returns the feature with an id from the overlap indexes: the rank of
+        a gene, or the bitwise complement of the position of an intergenic
+        region.
+        """
+        if feature_id >= 0:
+            return self.genes[feature_id]
+
+        return self.intergenic_regions[~feature_id]
+
+    def _rank(self, gene):
+        """Returns the rank of a gene"""
+        return self.gene_rank[gene.locus]
+
+    def _check_index(self):
+        """
+        Builds the indexes if they have not been built yet.
+        """
+        if self._features is None:
+            self.build_index()
+
+class SnapshotGenome(Genome):
+    """
+    A genome opened from a snapshot by load().  Its arrays are views of the
+    memory-mapped snapshot.  genes, intergenic_regions, gene_rank and
+    gene_dict are read-only containers that create each Gene and
+    IntergenicRegion the first time it is needed, and the loci are only
+    decoded all at once when a gene is first looked up by locus.
+
+    Genes cannot be added to or removed from a snapshot genome, but its
+    annotations and topology can be changed.
+    """
+    def __init__(self, filename, header, arrays):
+        """
+        Create a new SnapshotGenome.  Use load() rather than calling this
+        directly.
+
+        :param filename: the name of the snapshot
+        :type filename: string
+        :param header: the snapshot's header
+        :type header: dict
+        :param arrays: the snapshot's arrays, keyed by name
+        :type arrays: dict
+        """
+        super(SnapshotGenome, self).__init__()
+        self.snapshot_file = filename
+        self._arrays = arrays
+        chromosomes = [str(c) for c in header["chromosomes"]]
+        self._chrom_codes = [chromosome_code(c) for c in chromosomes]
+        # The rank of each gene created so far, keyed by id
+        self._gene_ranks = {}
+
+        count = len(arrays["chromosome"])
+        self.genes = _LazySequence(count, self._create_gene)
+        self.intergenic_regions = _LazySequence(
+            len(arrays["intergenic_left"]), self._create_intergenic_region)
+        self.gene_rank = _LociRanks(arrays["loci"], arrays["loci_offsets"])
+        self.gene_dict = _GeneDict(self)
+
+        for chromosome in header["circular"]:
+            self.set_topology(str(chromosome), CIRCULAR)
+
+        # Genes are grouped by chromosome, in the order of chromosomes
+        snapshot_codes = np.arange(len(chromosomes))
+        firsts = np.searchsorted(arrays["chromosome"], snapshot_codes, "left")
+        stops = np.searchsorted(arrays["chromosome"], snapshot_codes, "right")
+        feature_offsets = _concatenate([[0], np.cumsum(
+            arrays["feature_counts"])]).tolist()
+        exon_offsets = arrays["exon_offsets"]
+        exon_ranks = np.repeat(np.arange(count, dtype=np.int64),
+                               np.diff(exon_offsets))
+
+        self._chromosome_bounds = {}
+        self._features = {}
+        self._exons = {}
+        for i, (chromosome, code) in enumerate(zip(chromosomes,
+                                                   self._chrom_codes)):
+            first, stop = int(firsts[i]), int(stops[i])
+            self._chromosome_bounds[code] = [first, stop]
+
+            rows = slice(feature_offsets[i], feature_offsets[i + 1])
+            ids = arrays["feature_ids"][rows]
+            self._features[code] = (IntervalIndex.from_sorted(
+                _FeatureSequence(self, ids), arrays["feature_starts"][rows],
+                arrays["feature_ends"][rows],
+                arrays["feature_max_ends"][rows]), ids)
+
+            rows = slice(int(exon_offsets[first]), int(exon_offsets[stop]))
+            self._exons[chromosome] = (exon_ranks[rows],
+                                       arrays["exon_starts"][rows],
+                                       arrays["exon_ends"][rows])
+
+        for i, (key, terms) in enumerate(header["annotations"]):
+            bits = arrays["annotation%d" % i]
+            self._annotations[key] = dict(zip(terms, bits))
+
+    def _create_gene(self, rank):
+        """Creates the Gene with a rank from the snapshot's arrays"""
+        arrays = self._arrays
+
+        exons = None
+        if arrays["has_exons"].item(rank):
+            offsets = arrays["exon_offsets"]
+            first, stop = offsets.item(rank), offsets.item(rank + 1)
+            exons = list(zip(arrays["exon_starts"][first:stop].tolist(),
+                             arrays["exon_ends"][first:stop].tolist()))
+
+        g = _new_gene(self._chrom_codes[arrays["chromosome"].item(rank)],
+                      arrays["start"].item(rank), arrays["stop"].item(rank),
+                      self._string("loci", rank), self._string("strands", rank),
+                      exons)
+        if arrays["named"].item(rank):
+            g.name = self._string("names", rank)
+        self._gene_ranks[id(g)] = rank
+
+        return g
+
+    def _create_intergenic_region(self, i):
+        """Creates the IntergenicRegion at a position from the arrays"""
+        return _new_intergenic_region(
+            self.genes[self._arrays["intergenic_left"].item(i)],
+            self.genes[self._arrays["intergenic_right"].item(i)])
+
+    def _string(self, name, i):
+        """Returns a string from one of the snapshot's string arrays"""
+        offsets = self._arrays[name + "_offsets"]
+        return _as_str(self._arrays[name][offsets.item(i):
+                                          offsets.item(i + 1)].tobytes())
+
+    def _rank(self, gene):
+        """
+        Returns the rank of a gene.  Genes created by this genome are looked
+        up by identity, so the loci do not have to be decoded.
+        """
+        rank = self._gene_ranks.get(id(gene))
+        if rank is None or self.genes[rank] is not gene:
+            return self.gene_rank[gene.locus]
+
+        return rank
+
+class _LazySequence(Sequence):
+    """
+    A read-only sequence that creates each item the first time it is
+    indexed, and returns the same item after that.
+    """
+    def __init__(self, length, create):
+        """
+        :param length: the number of items
+        :type length: int
+        :param create: a function from a position to the item there
+        """
+        self._length = length
+        self._create = create
+        self._items = {}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._length))]
+
+        item = self._items.get(i)
+        if item is not None:
+            return item
+
+        i = _as_index(i)
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("Index out of range.")
+
+        item = self._items.get(i)
+        if item is None:
+            item = self._items[i] = self._create(i)
+
+        return item
+
+class _FeatureSequence(Sequence):
+    """
+    The features of an overlap index, in index order, looked up from their
+    ids by Genome._feature() when they are indexed.
+    """
+    def __init__(self, genome, ids):
+        self._genome = genome
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        return self._genome._feature(self._ids.item(i))
+
+class _LociRanks(Mapping):
+    """
+    The rank of each gene of a snapshot, keyed by locus.  The loci are
+    decoded the first time a rank is looked up.
+    """
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+        self._ranks = None
+
+    def _dict(self):
+        if self._ranks is None:
+            loci = _decode_strings(self._data, self._offsets)
+            self._ranks = dict((locus, i) for i, locus in enumerate(loci))
+
+        return self._ranks
+
+    def __getitem__(self, locus):
+        return self._dict()[locus]
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+class _GeneDict(Mapping):
+    """The genes of a SnapshotGenome, keyed by locus"""
+    def __init__(self, genome):
+        self._genome = genome
+
+    def __getitem__(self, locus):
+        return self._genome.genes[self._genome.gene_rank[locus]]
+
+    def __iter__(self):
+        return iter(self._genome.gene_rank)
+
+    def __len__(self):
+        return len(self._genome.gene_rank)
+
+class GeneSet(object):
+    """
+    A set of the genes in a Genome, stored as a packed bitset indexed by
+    gene rank.  Set operations between GeneSets of the same genome are
+    bitwise operations over the whole genome at once.
+    """
+    def __init__(self, genome, bits):
+        """
+        Create a new GeneSet.  Use Genome.gene_set() or
+        Genome.annotated_genes() rather than calling this directly.
+
+        :param genome: the genome the genes are in
+        :type genome: Genome
+        :param bits: a bitset from numpy.packbits, with one bit per gene
+        :type bits: numpy.ndarray
+        """
+        self.genome = genome
+        self.bits = bits
+
+    def __and__(self, other):
+        return GeneSet(self.genome, self.bits & self._other_bits(other))
+
+    def __or__(self, other):
+        return GeneSet(self.genome, self.bits | self._other_bits(other))
+
+    def __sub__(self, other):
+        return GeneSet(self.genome, self.bits & ~self._other_bits(other))
+
+    def __xor__(self, other):
+        return GeneSet(self.genome, self.bits ^ self._other_bits(other))
+
+    def __len__(self):
+        return int(_BIT_COUNTS[self.bits].sum())
+
+    def __iter__(self):
+        """Iterates over the Genes in the set, in rank order"""
+        for rank in self.ranks():
+            yield self.genome.genes[rank]
+
+    def __contains__(self, gene):
+        rank = self.genome.gene_rank.get(getattr(gene, "locus", gene))
+        if rank is None:
+            return False
+
+        return bool(self.bits[rank // 8] & (0x80 >> (rank % 8)))
+
+    def ranks(self):
+        """Returns the ranks of the genes in the set as a numpy array"""
+        bits = np.unpackbits(self.bits)[:len(self.genome.genes)]
+        return np.flatnonzero(bits)
+
+    def loci(self):
+        """Returns the loci of the genes in the set, in rank order"""
+        return [g.locus for g in self]
+
+    def _other_bits(self, other):
+        if other.genome is not self.genome:
+            raise ValueError("GeneSets must be from the same Genome.")
+
+        return other.bits
+
+# The number of set bits in each byte value
+_BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)],
+                       dtype=np.int64)
+
+def _index_features(genome):
+    """
+    Builds the overlap index of each chromosome, over its genes and
+    intergenic regions together, keyed by chromosome code.  Each is a tuple
+    of the form (IntervalIndex, ids), where ids holds the id of each
+    interval in the index, as taken by Genome._feature().
+    """
+    features = [(g.chrom_code, g.chrom_start, g.chrom_end, rank)
+                for rank, g in enumerate(genome.genes)]
+    features.extend((r.chrom_code, r.chrom_start, r.chrom_end, ~i)
+                    for i, r in enumerate(genome.intergenic_regions))
+    if not features:
+        return {}
+
+    codes, starts, ends, ids = [np.array(c, dtype=np.int64)
+                                for c in zip(*features)]
+    order = np.lexsort((ends, starts, codes))
+    codes, starts, ends, ids = codes[order], starts[order], ends[order], \
+                               ids[order]
+
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    indexes = {}
+    for first, stop in zip(_concatenate([[0], bounds]).tolist(),
+                           _concatenate([bounds, [len(codes)]]).tolist()):
+        rows = slice(first, stop)
+        indexes[int(codes[first])] = (IntervalIndex.from_sorted(
+            _FeatureSequence(genome, ids[rows]), starts[rows], ends[rows],
+            np.maximum.accumulate(ends[rows])), ids[rows])
+
+    return indexes
+
+def _exons_by_chromosome(genes):
+    """
+    Collects the exons of a sorted list of genes into arrays for each
+    chromosome, of the form (gene rank, start, stop).  Stops are included
+    in the exons, as in Gene.exons.
+    """
+    exons = defaultdict(lambda: ([], [], []))
+    for rank, g in enumerate(genes):
+        ranks, starts, ends = exons[g.chromosome]
+        for start, stop in g.get_exons():
+            ranks.append(rank)
+            starts.append(start)
+            ends.append(stop)
+
+    return dict((c, (np.array(r, dtype=np.int64),
+                     np.array(s, dtype=np.int64),
+                     np.array(e, dtype=np.int64)))
+                for c, (r, s, e) in exons.items())
+
+def _new_gene(chrom_code, start, stop, locus, strand, exons):
+    """
+    Creates a Gene from a snapshot.  The snapshot was written from valid
+    genes, so the checks in the constructors are skipped.
+    """
+    g = Gene.__new__(Gene)
+    g.chrom_code = chrom_code
+    g.chrom_start = start
+    g.chrom_end = stop
+    g.locus = locus
+    g.strand = strand
+    g.exons = exons
+
+    return g
+
+def _new_intergenic_region(first_gene, second_gene):
+    """Creates an IntergenicRegion from a snapshot, as for _new_gene"""
+    r = IntergenicRegion.__new__(IntergenicRegion)
+    r.left_gene = first_gene
+    r.right_gene = second_gene
+    r.chrom_code = first_gene.chrom_code
+    r.chrom_start = first_gene.chrom_end
+    r.chrom_end = second_gene.chrom_start
+    r.identifier = first_gene.locus + "-" + second_gene.locus
+
+    return r
+
+def _encode_strings(strings):
+    """
+    Returns a list of strings as UTF-8 bytes, and the offset of each string
+    in them, followed by the end of the last
+    """
+    encoded = [s if isinstance(s, bytes) else s.encode("utf-8")
+               for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.array([len(s) for s in encoded], dtype=np.int64),
+              out=offsets[1:])
+
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _decode_strings(data, offsets):
+    """Returns the list of strings saved by _encode_strings"""
+    text = data.tobytes()
+    bounds = offsets.tolist()
+
+    return [_as_str(text[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def _as_str(data):
+    """Converts UTF-8 bytes to a native string"""
+    if str is bytes:
+        return data
+
+    return data.decode("utf-8")
+
+def _concatenate(arrays):
+    """Concatenates a list of integer arrays, which may be empty"""
+    return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                          [np.asarray(a, dtype=np.int64) for a in arrays])
+
+def _align(offset):
+    """Rounds an offset up to a multiple of 8 bytes"""
+    return (offset + 7) // 8 * 8
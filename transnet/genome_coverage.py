@@ -1,12 +1,109 @@
 #!/usr/bin/env python
-"""Classes describing coverage along the genome"""
+"""Classes describing coverage along the genome
+
+Coverage can be saved in a binary format, which DiskBasedGenomeCoverage reads
+through a memory map.  All values are little-endian:
+
+* 8 bytes: the magic string 'TNETCOV1'
+* uint32: the number of sequences
+* for each sequence:
+  * uint16: the length of the sequence name in bytes
+  * the sequence name, UTF-8 encoded
+  * uint64: the number of positions in the sequence
+  * uint64: the offset of the sequence's coverage from the start of the file
+* the coverage of each sequence, at its offset: an int32 array of shape
+  (2, positions) in C order, i.e. the reverse strand coverage followed by
+  the forward strand coverage.  Offsets are aligned to 8 bytes.
+
+The same format is used by CoverageCache, so that coverage files only need
+to be parsed once.
+"""
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+from transnet.parsing import MAX_NAME_LENGTH, check_names, \
+                             encode_chromosomes, parse_blocks
+
 __author__ = "Matthew Peterson"
 
+# Rows of the per-chromosome coverage arrays
+REVERSE = 0
+FORWARD = 1
+
+_SWIG_FIELDS = np.dtype([("sequence", str, MAX_NAME_LENGTH),
+                         ("position", np.int64), ("reverse", np.int32),
+                         ("forward", np.int32)])
+
+_BU_WIG_FIELDS = np.dtype([("position", np.int64), ("total", np.int64),
+                           ("reverse", np.int32), ("forward", np.int32)])
+
+_MAGIC = b"TNETCOV1"
+
+# DiskBasedGenomeCoverage keeps the cumulative coverage at the start of each
+# block of this many positions, and reads this many blocks at once
+_BLOCK_SIZE = 2 ** 10
+_BLOCKS_PER_BATCH = 2 ** 10
+
+# Default limit on the total size of the files in a CoverageCache (10 GiB)
+DEFAULT_CACHE_SIZE = 10 * 2 ** 30
+
+def load(infile, format="swig", sequence_name=None, cache=True):
+    """
+    Reads a coverage file, going through a CoverageCache so that each file
+    is only parsed once.  Later loads of an unchanged file memory-map the
+    cached copy instead.
+
+    :param infile: name of the file to be read
+    :type infile: string
+    :param format: the type of file, as for GenomeCoverage
+    :type format: string
+    :param sequence_name: chromosome name, for 'wig' files
+    :type sequence_name: string
+    :param cache: the cache to use; True for a CoverageCache in the default
+                  directory, or False to always parse the file
+    :type cache: CoverageCache
+    :rtype: GenomeCoverage
+    """
+    if cache is True:
+        cache = CoverageCache()
+    if not cache:
+        return GenomeCoverage(infile, format, sequence_name)
+
+    return cache.load(infile, format, sequence_name)
+
 class GenomeCoverage(object):
-    """The coverage along a genome"""
+    """The coverage along a genome.  The coverage of each chromosome is held
+    in a single int32 array of shape (2, length), with the reverse strand
+    coverage in row REVERSE and the forward strand coverage in row FORWARD.
+    Positions are used as given in the coverage files, and any position not
+    listed has zero coverage."""
+
+    def __init__(self, infile=None, format="swig", sequence_name=None):
+        """
+        Create a new GenomeCoverage, optionally reading in a coverage file.
 
-    def __init__(self, infile):
-        self._coverage = {} # Would this work better as a dict of dicts?
+        :param infile: name of the file to be read
+        :type infile: string
+        :param format: the type of file; either 'swig', or 'wig' for the
+                       single-sequence format read by _read_bu_wig
+        :type format: string
+        :param sequence_name: chromosome name, for 'wig' files
+        :type sequence_name: string
+        """
+        self._coverage = {}
+        self._prefix_sums = {}
+
+        if infile is not None:
+            with open(infile) as handle:
+                if format == "swig":
+                    self._read_swig(handle)
+                elif format == "wig":
+                    self._read_bu_wig(handle, sequence_name)
+                else:
+                    raise ValueError("Invalid file type.")
 
     def _read_bu_wig(self, handle, sequence_name):
         """Reads a 'wig' file .  Note that this is not the same as the wiggle
@@ -19,45 +116,636 @@ class GenomeCoverage(object):
         :param sequence_name: chromosome name
         :type sequence_name: string
         """
-        self.chromosomes[sequence_name] = () 
-        for line in handle:
-            position, total, reverse, forward = line.rstrip("\r\n").split()
-            self.coverage[(sequence_name, position)] = (int(reverse), int(forward))
+        lengths = {}
+        for block in parse_blocks(handle, _BU_WIG_FIELDS, separator=None):
+            self._add_block(sequence_name, block, lengths)
+
+        self._trim(lengths)
 
-    def _read_swig(self, swigfile_handle, on_disk = False):
+    def _read_swig(self, swigfile_handle):
         """Reads in a SWIG file.  This file consists of delimited lines
         consisting of
 
         sequence\tposition\treverse coverage\tforward coverage
         """
-        for line in swigfile_handle():
-            sequence, position, reverse, forward = line.rstrip("\r\n").split()
-            self._coverage[(sequence, position)] = (int(reverse), int(forward))
+        lengths = {}
+        for block in parse_blocks(swigfile_handle, _SWIG_FIELDS,
+                                  separator=None):
+            sequences, codes = encode_chromosomes(block["sequence"])
+            check_names(sequences)
+            if len(sequences) == 1:
+                self._add_block(sequences[0], block, lengths)
+                continue
+
+            order = np.argsort(codes, kind="mergesort")
+            bounds = np.searchsorted(codes[order],
+                                     np.arange(len(sequences) + 1))
+            for code, sequence in enumerate(sequences):
+                rows = order[bounds[code]:bounds[code + 1]]
+                self._add_block(sequence, block[rows], lengths)
+
+        self._trim(lengths)
+
+    def _add_block(self, sequence, block, lengths):
+        """
+        Copies a block of parsed records for one sequence into its coverage
+        array, growing the array as needed.
+
+        :param lengths: the number of positions used in each array that is
+                        being filled, which may be less than its capacity
+        :type lengths: dict
+        """
+        if len(block) == 0:
+            return
+
+        positions = block["position"]
+        needed = int(positions.max()) + 1
+        if positions.min() < 0:
+            raise ValueError("Positions cannot be less than zero.")
+
+        coverage = self._coverage.get(sequence)
+        if coverage is None:
+            coverage = np.zeros((2, needed), dtype=np.int32)
+        elif needed > coverage.shape[1]:
+            # Grow geometrically, so that files which are not sorted by
+            # position do not cause a copy for every block.
+            capacity = max(needed, 2 * coverage.shape[1])
+            grown = np.zeros((2, capacity), dtype=np.int32)
+            grown[:, :coverage.shape[1]] = coverage
+            coverage = grown
+
+        coverage[REVERSE, positions] = block["reverse"]
+        coverage[FORWARD, positions] = block["forward"]
+
+        self._coverage[sequence] = coverage
+        lengths[sequence] = max(lengths.get(sequence, 0), needed)
+
+    def _trim(self, lengths):
+        """
+        Trims any arrays grown while reading down to the positions used.
+        """
+        for sequence, length in lengths.items():
+            if self._coverage[sequence].shape[1] > length:
+                self._coverage[sequence] = \
+                    self._coverage[sequence][:, :length].copy()
+
+    def sequences(self):
+        """
+        Returns a sorted list of the sequences with coverage.
+        """
+        return sorted(self._coverage)
+
+    def get_length(self, sequence):
+        """
+        Returns the number of positions held for a sequence, i.e. one more
+        than the last position with coverage.
+
+        :param sequence: the sequence
+        :type sequence: string
+        """
+        return self._coverage[sequence].shape[1]
 
     def get_coverage(self, sequence, position):
         """
-        Get the coverage at a given position
+        Get the coverage at a given position.  Positions outside those held
+        for the sequence, including negative positions, have no coverage.
 
         :param sequence: the sequence
         :type sequence: string
         :param position: position on the sequence
         :type position: int
+        :return a tuple of the form (reverse coverage, forward coverage)
+        :rtype tuple
+        """
+        coverage = self._coverage[sequence]
+        if position < 0 or position >= coverage.shape[1]:
+            return (0, 0)
+
+        return (int(coverage[REVERSE, position]),
+                int(coverage[FORWARD, position]))
+
+    def get_coverage_as_array(self, sequence, strand=None):
+        """
+        Returns the coverage for a given chromosome as a numpy.array.  This
+        is a view of the stored coverage, not a copy, so should not be
+        modified.
+
+        :param sequence: the sequence
+        :type sequence: string
+        :param strand: '+' for the forward strand, '-' for the reverse
+                       strand, or None for an array of shape (2, length)
+                       holding both
+        :type strand: string
+        """
+        coverage = self._coverage[sequence]
+
+        if strand is None:
+            return coverage
+        elif strand == "+":
+            return coverage[FORWARD]
+        elif strand == "-":
+            return coverage[REVERSE]
+
+        raise ValueError("Strand must be one of '+', '-' or None.")
+
+    def get_range(self, sequence, start, stop, strand=None):
+        """
+        Returns the coverage over positions start to stop - 1 of a sequence.
+        Like get_coverage_as_array, this is a view rather than a copy.  The
+        range is clipped to the positions held for the sequence.
+
+        :param sequence: the sequence
+        :type sequence: string
+        :param start: the first position
+        :type start: int
+        :param stop: one past the last position
+        :type stop: int
+        :param strand: '+', '-' or None, as for get_coverage_as_array
+        :type strand: string
+        """
+        coverage = self.get_coverage_as_array(sequence, strand)
+        start = max(start, 0)
+
+        return coverage[..., start:stop]
+
+    def get_sum(self, sequence, start, stop, strand=None):
+        """
+        Returns the total coverage over positions start to stop - 1 of a
+        sequence, in constant time.  Positions with no coverage held count as
+        zero.
+
+        :param sequence: the sequence
+        :type sequence: string
+        :param start: the first position
+        :type start: int
+        :param stop: one past the last position
+        :type stop: int
+        :param strand: '+' or '-' for the coverage of one strand, or None for
+                       the coverage of both
+        :type strand: string
+        """
+        return int(self.get_sums(sequence, [start], [stop], strand)[0])
+
+    def get_mean(self, sequence, start, stop, strand=None):
+        """
+        Returns the mean coverage over positions start to stop - 1 of a
+        sequence, in constant time.  Arguments are as for get_sum.
         """
-        return self._coverage[(sequence, position)]
+        if stop <= start:
+            return 0.0
+
+        return float(self.get_sum(sequence, start, stop, strand)) / \
+               (stop - start)
 
-    def get_coverage_as_array(self, length):
+    def get_strand_sums(self, sequence, start, stop):
         """
-        Returns the coverage for a given chromosome as a numpy.array.
+        Returns the coverage of each strand over positions start to stop - 1
+        of a sequence, in constant time.
+
+        :return a tuple of the form (reverse coverage, forward coverage)
+        :rtype tuple
+        """
+        return (self.get_sum(sequence, start, stop, "-"),
+                self.get_sum(sequence, start, stop, "+"))
+
+    def get_sums(self, sequence, starts, stops, strand=None):
+        """
+        Returns the total coverage over many ranges of one sequence at once.
+        Each range covers positions start to stop - 1.
+
+        :param sequence: the sequence
+        :type sequence: string
+        :param starts: the first position of each range
+        :type starts: numpy.ndarray
+        :param stops: one past the last position of each range
+        :type stops: numpy.ndarray
+        :param strand: '+', '-' or None, as for get_sum
+        :type strand: string
+        :rtype: numpy.ndarray
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+
+        if strand is None:
+            rows = (REVERSE, FORWARD)
+        elif strand == "+":
+            rows = (FORWARD,)
+        elif strand == "-":
+            rows = (REVERSE,)
+        else:
+            raise ValueError("Strand must be one of '+', '-' or None.")
+
+        if sequence not in self._coverage:
+            return np.zeros(len(starts), dtype=np.int64)
+
+        length = self.get_length(sequence)
+        starts = np.clip(starts, 0, length)
+        stops = np.clip(stops, starts, length)
+
+        return self._cumulative(sequence, stops, rows) - \
+               self._cumulative(sequence, starts, rows)
+
+    def count_intervals(self, intervals, strand=None):
+        """
+        Returns the total coverage of each of a set of intervals, such as the
+        peaks of a PeakTable or the features from Genome.features().  Unlike
+        the other range queries, intervals include their end positions.
+
+        :param intervals: a PeakTable, or an iterable of Intervals
+        :param strand: '+', '-' or None, as for get_sum
+        :type strand: string
+        :return the coverage of each interval, in order
+        :rtype numpy.ndarray
         """
-        coverage = np.array(zeros(length))
-        for i in range(0,length):
-            coverage[i] = self.coverage(sequence, i)
+        if hasattr(intervals, "chromosome_codes"):
+            chromosomes = intervals.chromosomes
+            codes = intervals.chromosome_codes
+            starts = intervals.starts
+            ends = intervals.ends
+        else:
+            intervals = list(intervals)
+            chromosomes, codes = encode_chromosomes(
+                [i.chromosome for i in intervals])
+            starts = np.array([i.chrom_start for i in intervals],
+                              dtype=np.int64)
+            ends = np.array([i.chrom_end for i in intervals], dtype=np.int64)
 
-class DiskBasedGenomeCoverage(object):
+        counts = np.zeros(len(starts), dtype=np.int64)
+        for code, chromosome in enumerate(chromosomes):
+            rows = np.flatnonzero(codes == code)
+            counts[rows] = self.get_sums(chromosome, starts[rows],
+                                         ends[rows] + 1, strand)
+
+        return counts
+
+    def _cumulative(self, sequence, positions, rows):
+        """
+        Returns the coverage of positions 0 to p - 1 for each position p,
+        summed over the given strands.
+
+        :param positions: positions from 0 to the length of the sequence
+        :type positions: numpy.ndarray
+        :param rows: the strand rows to be summed
+        :type rows: tuple
+        :rtype: numpy.ndarray
+        """
+        sums = self._get_prefix_sums(sequence)
+        total = np.zeros(len(positions), dtype=np.int64)
+        for row in rows:
+            total += sums[row, positions]
+
+        return total
+
+    def _get_prefix_sums(self, sequence):
+        """
+        Returns the cumulative coverage of a sequence, as an int64 array of
+        shape (2, length + 1) whose entry i is the coverage of positions 0 to
+        i - 1 on each strand.  Built the first time a sequence is queried.
+        """
+        if sequence not in self._prefix_sums:
+            coverage = self._coverage[sequence]
+            sums = np.zeros((2, coverage.shape[1] + 1), dtype=np.int64)
+            np.cumsum(coverage, axis=1, out=sums[:, 1:])
+            self._prefix_sums[sequence] = sums
+
+        return self._prefix_sums[sequence]
+
+    def save(self, filename):
+        """
+        Writes the coverage to a file in the binary format described at the
+        top of this module, so it can be read by DiskBasedGenomeCoverage.
+
+        :param filename: the name of the file to be written
+        :type filename: string
+        """
+        sequences = self.sequences()
+        names = [s.encode("utf-8") for s in sequences]
+
+        header_size = len(_MAGIC) + 4 + \
+                      sum(2 + len(n) + 16 for n in names)
+        offset = _align(header_size)
+
+        with open(filename, "wb") as handle:
+            handle.write(_MAGIC)
+            handle.write(struct.pack("<I", len(sequences)))
+
+            offsets = []
+            for sequence, name in zip(sequences, names):
+                length = self.get_length(sequence)
+                handle.write(struct.pack("<H", len(name)))
+                handle.write(name)
+                handle.write(struct.pack("<QQ", length, offset))
+                offsets.append(offset)
+                offset = _align(offset + 8 * length)
+
+            for sequence, offset in zip(sequences, offsets):
+                handle.write(b"\0" * (offset - handle.tell()))
+                coverage = self.get_coverage_as_array(sequence)
+                np.ascontiguousarray(coverage, dtype="<i4").tofile(handle)
+
+class DiskBasedGenomeCoverage(GenomeCoverage):
     """
-    Disk-based Genome Coverage, using pytables.  Used to allow for the loading
-    of larger genomes without worrying about memory limitations.
+    Disk-based Genome Coverage, using a memory map of a file written by
+    GenomeCoverage.save().  Used to allow for the loading of larger genomes
+    without worrying about memory limitations: coverage is only read from
+    disk as it is used, and every query returns views of the mapped file.
+
+    Range sums do not build a prefix sum of every position, which would
+    take four times the memory of the mapped coverage.  Instead, the
+    cumulative coverage is kept at the start of each block of _BLOCK_SIZE
+    positions, and the rest of each range is summed from the blocks its
+    ends fall in.
     """
-    # TODO: Look into MemMaps and PyTables.
-    pass
+    def __init__(self, filename):
+        """
+        Opens a coverage file.
+
+        :param filename: the name of a file written by GenomeCoverage.save()
+        :type filename: string
+        """
+        self.filename = filename
+        self._coverage = {}
+        self._prefix_sums = {}
+
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+        if _read_bytes(data, 0, len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a coverage file." % filename)
+
+        position = len(_MAGIC)
+        (num_sequences,) = struct.unpack("<I", _read_bytes(data, position, 4))
+        position += 4
+
+        for i in range(num_sequences):
+            (name_length,) = struct.unpack("<H",
+                                           _read_bytes(data, position, 2))
+            position += 2
+            name = _read_bytes(data, position, name_length).decode("utf-8")
+            position += name_length
+            length, offset = struct.unpack("<QQ",
+                                           _read_bytes(data, position, 16))
+            position += 16
+
+            coverage = data[offset:offset + 8 * length].view("<i4")
+            self._coverage[str(name)] = coverage.reshape(2, length)
+
+    def _cumulative(self, sequence, positions, rows):
+        """
+        Returns the coverage of positions 0 to p - 1 for each position p,
+        summed over the given strands, from the cumulative coverage at the
+        start of p's block and the coverage between it and p.
+        """
+        coverage = self._coverage[sequence]
+        length = coverage.shape[1]
+        block_sums = self._get_prefix_sums(sequence)
+
+        blocks = positions // _BLOCK_SIZE
+        offsets = positions - blocks * _BLOCK_SIZE
+        total = np.zeros(len(positions), dtype=np.int64)
+        for row in rows:
+            total += block_sums[row, blocks]
+
+        # Read each block holding a position once, a batch of blocks at a
+        # time.  Every block but the last is read through a (blocks,
+        # _BLOCK_SIZE) view of each strand.
+        partial = np.flatnonzero(offsets)
+        unique_blocks, inverse = np.unique(blocks[partial],
+                                           return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="mergesort")
+        bounds = np.searchsorted(inverse[order],
+                                 np.arange(0, len(unique_blocks) +
+                                           _BLOCKS_PER_BATCH,
+                                           _BLOCKS_PER_BATCH))
+
+        full_blocks = length // _BLOCK_SIZE
+        views = [coverage[row, :full_blocks * _BLOCK_SIZE].reshape(
+                     full_blocks, _BLOCK_SIZE) for row in rows]
+
+        for batch in range(len(bounds) - 1):
+            first = batch * _BLOCKS_PER_BATCH
+            batch_blocks = unique_blocks[first:first + _BLOCKS_PER_BATCH]
+            inside = np.searchsorted(batch_blocks, full_blocks)
+
+            cumulative = np.zeros((len(batch_blocks), _BLOCK_SIZE),
+                                  dtype=np.int64)
+            for view in views:
+                cumulative[:inside] += view[batch_blocks[:inside]]
+            if inside < len(batch_blocks):
+                for row in rows:
+                    tail = coverage[row, full_blocks * _BLOCK_SIZE:]
+                    cumulative[inside, :len(tail)] += tail
+            np.cumsum(cumulative, axis=1, out=cumulative)
+
+            rows_in_batch = order[bounds[batch]:bounds[batch + 1]]
+            members = partial[rows_in_batch]
+            total[members] += cumulative[inverse[rows_in_batch] - first,
+                                         offsets[members] - 1]
+
+        return total
+
+    def _get_prefix_sums(self, sequence):
+        """
+        Returns the cumulative coverage of a sequence at the start of each
+        block, as an int64 array of shape (2, blocks + 1) whose entry i is
+        the coverage of positions 0 to i * _BLOCK_SIZE - 1 on each strand.
+        Built the first time a sequence is queried, reading the coverage a
+        few megabytes at a time.
+        """
+        if sequence not in self._prefix_sums:
+            coverage = self._coverage[sequence]
+            length = coverage.shape[1]
+            num_blocks = (length + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+            sums = np.zeros((2, num_blocks + 1), dtype=np.int64)
+
+            step = _BLOCK_SIZE * _BLOCKS_PER_BATCH
+            for start in range(0, length, step):
+                chunk = coverage[:, start:start + step]
+                full = chunk.shape[1] // _BLOCK_SIZE
+                first = start // _BLOCK_SIZE + 1
+                sums[:, first:first + full] = \
+                    chunk[:, :full * _BLOCK_SIZE].reshape(
+                        2, full, _BLOCK_SIZE).sum(axis=2, dtype=np.int64)
+                if chunk.shape[1] > full * _BLOCK_SIZE:
+                    sums[:, first + full] = \
+                        chunk[:, full * _BLOCK_SIZE:].sum(axis=1,
+                                                          dtype=np.int64)
+
+            np.cumsum(sums, axis=1, out=sums)
+            self._prefix_sums[sequence] = sums
+
+        return self._prefix_sums[sequence]
+
+def _read_bytes(data, start, size):
+    """Returns a range of a byte array as a string"""
+    return bytes(bytearray(data[start:start + size]))
+
+def _align(offset):
+    """Rounds an offset up to a multiple of 8 bytes"""
+    return (offset + 7) // 8 * 8
+
+class CoverageCache(object):
+    """
+    A directory of parsed coverage files, saved in the binary format read by
+    DiskBasedGenomeCoverage.  Each entry is keyed on the path, format and
+    sequence name of its source file, and is only used while the source
+    file's size, modification time and content hash are unchanged.  When the
+    total size of the entries grows beyond max_size, the least recently used
+    entries are removed.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE,
+                 full_hash=False):
+        """
+        Create a new CoverageCache.
+
+        :param directory: the cache directory.  Defaults to the
+                          TRANSNET_CACHE_DIR environment variable, or
+                          ~/.cache/transnet
+        :type directory: string
+        :param max_size: the maximum total size of the cache in bytes
+        :type max_size: int
+        :param full_hash: hash the whole of each source file, rather than
+                          a sample of blocks spread through it
+        :type full_hash: bool
+        """
+        if directory is None:
+            directory = os.environ.get("TRANSNET_CACHE_DIR",
+                                       os.path.join(os.path.expanduser("~"),
+                                                    ".cache", "transnet"))
+
+        self.directory = directory
+        self.max_size = max_size
+        self.full_hash = full_hash
+
+    def load(self, infile, format="swig", sequence_name=None):
+        """
+        Returns the coverage in a file, from the cache if there is a valid
+        entry, and otherwise by parsing the file and adding it to the cache.
+
+        :param infile: name of the file to be read
+        :type infile: string
+        :param format: the type of file, as for GenomeCoverage
+        :type format: string
+        :param sequence_name: chromosome name, for 'wig' files
+        :type sequence_name: string
+        :rtype: GenomeCoverage
+        """
+        source = os.path.abspath(infile)
+        key = "%s\0%s\0%s" % (source, format, sequence_name)
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        data_file = os.path.join(self.directory, name + ".cov")
+        info_file = os.path.join(self.directory, name + ".json")
+
+        # Describe the source before parsing it, so that an entry is never
+        # recorded against a file that changed while it was being read.
+        stat = os.stat(source)
+        digest = self._hash(source)
+        info = _read_info(info_file)
+
+        if info is not None and os.path.exists(data_file) and \
+           info["size"] == stat.st_size and info["mtime"] == stat.st_mtime and \
+           info["hash"] == digest:
+            # Mark the entry as recently used
+            os.utime(data_file, None)
+            return DiskBasedGenomeCoverage(data_file)
+
+        coverage = GenomeCoverage(infile, format, sequence_name)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write to temporary files first, so other processes never see a
+        # partly-written entry.
+        handle, temp_data = tempfile.mkstemp(dir=self.directory)
+        os.close(handle)
+        coverage.save(temp_data)
+        os.rename(temp_data, data_file)
+
+        handle, temp_info = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, "w") as info_handle:
+            json.dump({"source": source, "size": stat.st_size,
+                       "mtime": stat.st_mtime, "hash": digest},
+                      info_handle)
+        os.rename(temp_info, info_file)
+
+        self._evict(data_file)
+
+        return coverage
+
+    def size(self):
+        """
+        Returns the total size of the cached coverage in bytes.
+        """
+        return sum(os.path.getsize(f) for f in self._entries())
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        for data_file in self._entries():
+            _remove_entry(data_file)
+
+    def _entries(self):
+        """Returns the coverage files in the cache directory"""
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [os.path.join(self.directory, f)
+                for f in os.listdir(self.directory) if f.endswith(".cov")]
+
+    def _evict(self, keep):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than max_size.  The entry in keep is never removed.
+        """
+        entries = [(os.path.getmtime(f), os.path.getsize(f), f)
+                   for f in self._entries() if f != keep]
+        total = sum(size for (mtime, size, f) in entries) + \
+                os.path.getsize(keep)
+
+        for mtime, size, data_file in sorted(entries):
+            if total <= self.max_size:
+                break
+            _remove_entry(data_file)
+            total -= size
+
+    def _hash(self, filename):
+        """
+        Returns a hash of a file's contents.  Unless full_hash is set, only
+        the first and last megabyte and 16 blocks spread between them are
+        hashed, so that checking a multi-gigabyte file takes milliseconds.
+        """
+        digest = hashlib.sha1()
+        size = os.path.getsize(filename)
+        end_size = 2 ** 20
+        block_size = 2 ** 16
+
+        with open(filename, "rb") as handle:
+            if self.full_hash or size <= 2 * end_size + 16 * block_size:
+                for block in iter(lambda: handle.read(2 ** 20), b""):
+                    digest.update(block)
+            else:
+                digest.update(handle.read(end_size))
+                step = (size - 2 * end_size) // 17
+                for i in range(1, 17):
+                    handle.seek(end_size + i * step)
+                    digest.update(handle.read(block_size))
+                handle.seek(size - end_size)
+                digest.update(handle.read(end_size))
+
+        return digest.hexdigest()
+
+def _read_info(info_file):
+    """Reads the description of a cache entry, or returns None"""
+    try:
+        with open(info_file) as handle:
+            return json.load(handle)
+    except (IOError, OSError, ValueError):
+        return None
 
+def _remove_entry(data_file):
+    """Removes a cache entry, ignoring files that are already gone"""
+    for f in (data_file, os.path.splitext(data_file)[0] + ".json"):
+        try:
+            os.remove(f)
+        except OSError:
+            pass
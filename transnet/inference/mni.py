@@ -5,4 +5,295 @@ Reference:
 Gardner TS*, di Bernardo D*, Lorenz D, Collins JJ..
 Inferring genetic networks and identifying compound mode of action via
 expression profiling Science; 301:102-105,2003
+
+di Bernardo D, Thompson MJ, Gardner TS, et al.
+Chemogenomic profiling on a genomewide scale using reverse-engineered gene
+networks. Nature Biotechnology; 23:377-383, 2005
+
+At steady state, the expression of the genes in each condition satisfies
+A x + b u = 0, where A is the network and b u is the perturbation applied.
+MNI fits each gene as a linear function of a small number of regulators,
+x_i = sum w_ir x_r, over every condition in which the gene itself does not
+appear to be perturbed.  The residuals of the fit estimate the
+perturbations, and conditions with large residuals for a gene are left out
+of that gene's next fit.  This is repeated until the set of perturbed
+conditions stops changing.
+
+Missing measurements (NaN, as MicroarrayCompendium.add_condition fills in
+for genes a condition lacks) are left out of every regression that would
+use them.
 """
+import warnings
+import numpy as np
+from transnet import parallel
+
+__author__ = "Matthew Peterson"
+
+DEFAULT_REGULATORS = 10
+DEFAULT_ITERATIONS = 10
+DEFAULT_THRESHOLD = 3.0
+DEFAULT_RIDGE = 1e-3
+DEFAULT_BLOCK_SIZE = 256
+
+def infer(compendium, regulators=DEFAULT_REGULATORS, processes=None,
+          **kwargs):
+    """
+    Infers a network from an expression compendium.  See MNI for the
+    options.
+
+    :param compendium: the expression data; any object with an
+                       expression_matrix() method, such as a LOXExperiment
+                       or MicroarrayCompendium
+    :param regulators: the number of regulators of each gene
+    :type regulators: int
+    :param processes: the number of processes to fit genes in
+    :type processes: int
+    :rtype: MNI
+    """
+    mni = MNI(regulators, processes=processes, **kwargs)
+    mni.fit(compendium)
+
+    return mni
+
+class MNI(object):
+    """
+    The MNI algorithm.  Genes are fit in blocks: the regressions of every
+    gene in a block are solved together as a stack of small normal
+    equations, and blocks can be divided among a pool of processes.
+
+    Once fit, the network is held as regulators, the indexes of the
+    regulators of each gene, and weights, their weights.  perturbations
+    holds the estimated perturbation of each gene in each condition, as
+    robust z-scores of the residuals.  A gene is only fit on the conditions
+    in which it and all of its regulators were measured; its perturbations
+    in the other conditions are NaN.
+    """
+    def __init__(self, regulators=DEFAULT_REGULATORS,
+                 iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD,
+                 ridge=DEFAULT_RIDGE, processes=None,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Create a new MNI.
+
+        :param regulators: the number of regulators of each gene, chosen as
+                           the genes whose expression is most correlated
+        :type regulators: int
+        :param iterations: the largest number of refits
+        :type iterations: int
+        :param threshold: the z-score above which a gene is taken to be
+                          perturbed in a condition
+        :type threshold: float
+        :param ridge: the ridge penalty, relative to the variance of the
+                      regulators, that keeps collinear regulators solvable
+        :type ridge: float
+        :param processes: the number of processes to fit blocks in
+        :type processes: int
+        :param block_size: the number of genes fit together
+        :type block_size: int
+        """
+        self.num_regulators = regulators
+        self.iterations = iterations
+        self.threshold = threshold
+        self.ridge = ridge
+        self.processes = processes
+        self.block_size = block_size
+
+        self.genes = None
+        self.conditions = None
+        self.regulators = None
+        self.weights = None
+        self.perturbations = None
+
+    def fit(self, compendium):
+        """
+        Infers the network from an expression compendium.  Entries of the
+        expression matrix that are NaN or infinite are taken to be missing.
+
+        :param compendium: any object with an expression_matrix() method,
+                           returning a tuple of the form
+                           (genes, conditions, genes x conditions array)
+        """
+        genes, conditions, expression = compendium.expression_matrix()
+        expression = np.asarray(expression, dtype=np.float64)
+        if expression.shape != (len(genes), len(conditions)):
+            raise ValueError("The expression matrix must have one row per " +
+                             "gene and one column per condition.")
+        if len(genes) < 2:
+            raise ValueError("At least two genes are needed.")
+
+        self.genes = list(genes)
+        self.conditions = list(conditions)
+
+        # Each gene is fit on its changes from its mean measured expression,
+        # with missing entries at zero so they add nothing to correlations
+        observed = np.isfinite(expression)
+        counts = observed.sum(axis=1)
+        expression = np.where(observed, expression, 0.0)
+        means = expression.sum(axis=1) / np.maximum(counts, 1)
+        expression = np.where(observed, expression - means[:, None], 0.0)
+        settings = (min(self.num_regulators, len(genes) - 1),
+                    self.iterations, self.threshold, self.ridge)
+        blocks = [np.arange(start, min(start + self.block_size, len(genes)))
+                  for start in range(0, len(genes), self.block_size)]
+
+        processes = self.processes if len(blocks) > 1 else None
+        with parallel.pool(processes, _init_worker,
+                           (expression, observed, settings)) as workers:
+            results = workers.map(_fit_worker, blocks, chunksize=1)
+
+        self.regulators = np.concatenate([r[0] for r in results])
+        self.weights = np.concatenate([r[1] for r in results])
+        self.perturbations = np.concatenate([r[2] for r in results])
+
+    def interactions(self, min_weight=0.0):
+        """
+        Returns the edges of the network, strongest first.
+
+        :param min_weight: the smallest absolute weight to include
+        :type min_weight: float
+        :return a list of tuples of the form (regulator, target, weight)
+        :rtype list
+        """
+        targets, columns = np.nonzero(np.abs(self.weights) > min_weight)
+        regulators = self.regulators[targets, columns]
+        weights = self.weights[targets, columns]
+        order = np.argsort(-np.abs(weights), kind="mergesort")
+
+        return [(self.genes[regulators[i]], self.genes[targets[i]],
+                 float(weights[i])) for i in order]
+
+    def network(self):
+        """
+        Returns the network as a dense genes x genes array, whose entry
+        [i, j] is the weight of gene j as a regulator of gene i.
+        """
+        matrix = np.zeros((len(self.genes), len(self.genes)))
+        rows = np.repeat(np.arange(len(self.genes)), self.regulators.shape[1])
+        matrix[rows, self.regulators.ravel()] = self.weights.ravel()
+
+        return matrix
+
+    def predicted_targets(self, condition, count=10):
+        """
+        Returns the genes most likely to have been perturbed directly in a
+        condition, i.e. the mode of action of the treatment.
+
+        :param condition: the condition
+        :type condition: string
+        :param count: the number of genes to return
+        :type count: int
+        :return a list of tuples of the form (gene, z-score)
+        :rtype list
+        """
+        scores = self.perturbations[:, self.conditions.index(condition)]
+        order = np.argsort(-np.abs(scores), kind="mergesort")[:count]
+
+        return [(self.genes[i], float(scores[i])) for i in order]
+
+def _init_worker(expression, observed, settings):
+    """
+    Keeps the expression data and the mask of measured entries in each
+    worker process, with the rows of the data scaled to unit length for
+    finding correlated genes.
+    """
+    norms = np.sqrt((expression ** 2).sum(axis=1))
+    norms[norms == 0] = 1.0
+
+    parallel.state["expression"] = expression
+    parallel.state["observed"] = observed
+    parallel.state["normalized"] = expression / norms[:, None]
+    parallel.state["settings"] = settings
+
+def _fit_worker(block):
+    """Fits the genes in a block, in a worker process"""
+    expression = parallel.state["expression"]
+    num_regulators, iterations, threshold, ridge = \
+        parallel.state["settings"]
+
+    regulators = _choose_regulators(parallel.state["normalized"], block,
+                                    num_regulators)
+
+    return _fit_block(expression, parallel.state["observed"], block,
+                      regulators, iterations, threshold, ridge)
+
+def _choose_regulators(normalized, block, count):
+    """
+    Returns the count genes with the most strongly correlated expression to
+    each gene in a block, as an array of shape (block, count).
+    """
+    correlation = np.abs(np.dot(normalized[block], normalized.T))
+    # A gene cannot regulate itself
+    correlation[np.arange(len(block)), block] = -1.0
+
+    candidates = np.argpartition(-correlation, count - 1, axis=1)[:, :count]
+    # Order each gene's regulators by index, so results are reproducible
+    return np.sort(candidates, axis=1)
+
+def _fit_block(expression, observed, block, regulators, iterations,
+               threshold, ridge):
+    """
+    Fits every gene in a block against its regulators, refitting without
+    the conditions in which each gene appears to be perturbed.  Each gene
+    is only fit on the conditions in which it and its regulators were all
+    observed, and its z-scores in the others are NaN.
+
+    :return a tuple of the form (regulators, weights, perturbation z-scores)
+    :rtype tuple
+    """
+    targets = expression[block]
+    # Shape (block, regulators, conditions)
+    inputs = expression[regulators]
+    num_regulators = regulators.shape[1]
+
+    available = observed[block] & observed[regulators].all(axis=1)
+    included = available
+    identity = np.eye(num_regulators)
+
+    for i in range(max(iterations, 1)):
+        weighted = inputs * included[:, None, :]
+        gram = np.einsum("bke,ble->bkl", weighted, inputs)
+        # Scale the penalty to each gene's regulators
+        penalty = ridge * np.trace(gram, axis1=1, axis2=2) / num_regulators
+        gram += (penalty + 1e-12)[:, None, None] * identity
+        moments = np.einsum("bke,be->bk", weighted, targets)
+
+        weights = np.linalg.solve(gram, moments[:, :, None])[:, :, 0]
+        residuals = targets - np.einsum("bk,bke->be", weights, inputs)
+        scores = _robust_z(residuals, available)
+
+        with np.errstate(invalid="ignore"):
+            perturbed = np.abs(scores) > threshold
+        # Keep enough conditions for the regression to stay determined
+        perturbed[(available & ~perturbed).sum(axis=1) <=
+                  num_regulators] = False
+        if np.array_equal(available & ~perturbed, included):
+            break
+        included = available & ~perturbed
+
+    return regulators, weights, scores
+
+def _robust_z(residuals, available):
+    """
+    Returns the z-scores of each row of residuals, using the median absolute
+    deviation so that perturbed conditions do not hide each other.  Only the
+    available residuals are scored, and the rest are NaN.
+    """
+    if available.all():
+        median = np.median
+    else:
+        residuals = np.where(available, residuals, np.nan)
+        median = _nanmedian
+
+    center = median(residuals, axis=1)[:, None]
+    scale = 1.4826 * median(np.abs(residuals - center), axis=1)[:, None]
+    scale[(scale == 0) | np.isnan(scale)] = 1.0
+
+    return (residuals - center) / scale
+
+def _nanmedian(values, axis):
+    """Returns the median of the values that are not NaN, or NaN if none
+    are"""
+    with warnings.catch_warnings():
+        # Rows with no values at all warn
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(values, axis=axis)
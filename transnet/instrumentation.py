@@ -0,0 +1,358 @@
+"""
+Opt-in timing of the stages of TransNet's readers and annotators.
+
+Instrumentation is off by default, and while it is off an instrumented
+function costs one extra call and a flag check.  Once enabled, every stage
+that runs records its wall time, the number of records it handled and its
+peak memory.  The totals for each stage are available from report(), and
+each run of a stage is passed to any registered callbacks as a StageRecord:
+
+    from transnet import instrumentation
+
+    instrumentation.enable()
+    instrumentation.add_callback(lambda record: metrics.send(record))
+    peaks = sicer.read(handle)
+    print(instrumentation.report()["sicer.parse"]["seconds"])
+
+Peak memory is measured with tracemalloc where it is available, as the most
+memory allocated while the stage ran beyond what was allocated when it
+started (on Pythons before 3.9, the most since tracing began).  Otherwise
+it falls back to the peak resident size of the process from the resource
+module, which only ever grows.  It is None if neither is available.
+
+tracemalloc has a single peak for the whole process, so stages running at
+the same time in different threads (such as LOX p-value files read with
+threads) cannot be measured separately.  The peak is only reset when a
+stage starts while no stage is running in any other thread; otherwise each
+overlapping stage's figure also counts what the others allocated, and is
+an upper bound on its own use.
+
+Stages on generators, such as the parse() functions, time only the work
+done inside the generator, and count one record per item it yields.
+"""
+from collections import namedtuple
+import functools
+import sys
+import threading
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = "Matthew Peterson"
+
+# A single run of a stage, as passed to callbacks
+StageRecord = namedtuple("StageRecord", ["name", "seconds", "records",
+                                         "peak_memory"])
+
+_enabled = False
+_callbacks = []
+_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+# The number of stages running in every thread
+_running = 0
+# Whether enable() started tracemalloc, and so disable() should stop it
+_started_tracing = False
+
+def enable(trace_memory=True):
+    """
+    Turns on instrumentation.
+
+    :param trace_memory: measure peak memory with tracemalloc, starting it if
+                         necessary.  Tracing memory slows Python down
+                         noticeably; if False, the peak resident size of the
+                         process is recorded instead.
+    :type trace_memory: bool
+    """
+    global _enabled, _started_tracing
+
+    if trace_memory and tracemalloc is not None and \
+       not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+
+    _enabled = True
+
+def disable():
+    """
+    Turns off instrumentation.  The report is kept until reset() is called.
+    """
+    global _enabled, _started_tracing
+
+    _enabled = False
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+def is_enabled():
+    """Returns True if instrumentation is on"""
+    return _enabled
+
+def add_callback(callback):
+    """
+    Registers a function to be called with a StageRecord each time a stage
+    finishes.  Callbacks are called in the thread that ran the stage.
+
+    :param callback: a function taking a StageRecord
+    """
+    with _lock:
+        _callbacks.append(callback)
+
+def remove_callback(callback):
+    """
+    Unregisters a function registered with add_callback().
+    """
+    with _lock:
+        _callbacks.remove(callback)
+
+def report():
+    """
+    Returns the totals of every stage run since the last reset().
+
+    :return a dictionary keyed by stage name, each holding a dictionary of
+            calls, seconds, records and peak_memory (the largest of any
+            call, in bytes)
+    :rtype dict
+    """
+    with _lock:
+        return dict((name, dict(totals)) for name, totals in _totals.items())
+
+def reset():
+    """Clears the report"""
+    with _lock:
+        _totals.clear()
+
+def stage(name):
+    """
+    Returns a context manager that records a stage.  Records handled inside
+    it are counted with its add() method:
+
+        with instrumentation.stage("summary.format") as s:
+            for peak in peaks:
+                ...
+            s.add(len(peaks))
+
+    If instrumentation is off, the stage records nothing.
+
+    :param name: the name of the stage
+    :type name: string
+    """
+    if not _enabled:
+        return _NULL_STAGE
+
+    return Stage(name)
+
+def instrumented(name, count=None):
+    """
+    A decorator that records each call of a function as a stage.  Generator
+    functions are detected, and their iterators are timed as they are
+    consumed.
+
+    :param name: the name of the stage
+    :type name: string
+    :param count: a function returning the number of records in the result
+                  (or, for generators, in each item yielded).  By default,
+                  functions record none and generators one per item.
+    """
+    def decorator(function):
+        if _is_generator_function(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return function(*args, **kwargs)
+                return _instrument_iterator(name, count,
+                                            function(*args, **kwargs))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return function(*args, **kwargs)
+                with Stage(name) as s:
+                    result = function(*args, **kwargs)
+                    if count is not None:
+                        s.add(count(result))
+                return result
+
+        return wrapper
+
+    return decorator
+
+class Stage(object):
+    """
+    A stage being recorded.  Use stage() or instrumented() rather than
+    creating these directly.
+
+    A stage can be paused and resumed; its time is the sum of the time it
+    ran, and its peak memory the largest of any of its runs.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.records = 0
+        self.peak_memory = None
+        self._start = None
+        self._memory_start = 0
+        self._child_peak = 0
+
+    def add(self, records=1):
+        """
+        Counts records handled by the stage.
+
+        :param records: the number of records
+        :type records: int
+        """
+        self.records += records
+
+    def resume(self):
+        """Starts or restarts timing the stage"""
+        global _running
+
+        stack = _stack()
+        with _lock:
+            if _tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                parent = _current_stage()
+                if parent is not None:
+                    parent._child_peak = max(parent._child_peak, peak)
+                self._memory_start = current
+                self._child_peak = 0
+                # Resetting the peak would lose the peaks of stages running
+                # in other threads
+                if _running == len(stack):
+                    _reset_peak()
+            _running += 1
+
+        stack.append(self)
+        self._start = timeit.default_timer()
+
+    def pause(self):
+        """Stops timing the stage, until resume() is called"""
+        global _running
+
+        self.seconds += timeit.default_timer() - self._start
+
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        elif self in stack:
+            stack.remove(self)
+
+        with _lock:
+            _running -= 1
+
+        if _tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self._child_peak)
+            used = max(peak - self._memory_start, 0)
+            self.peak_memory = max(self.peak_memory or 0, used)
+            # Leave the peak for the enclosing stage to pick up
+            parent = _current_stage()
+            if parent is not None:
+                parent._child_peak = max(parent._child_peak, peak)
+        elif resource is not None:
+            self.peak_memory = _max_rss()
+
+    def finish(self):
+        """Records the stage in the report and passes it to the callbacks"""
+        record = StageRecord(self.name, self.seconds, self.records,
+                             self.peak_memory)
+
+        with _lock:
+            totals = _totals.get(self.name)
+            if totals is None:
+                totals = _totals[self.name] = {"calls": 0, "seconds": 0.0,
+                                               "records": 0,
+                                               "peak_memory": None}
+            totals["calls"] += 1
+            totals["seconds"] += record.seconds
+            totals["records"] += record.records
+            if record.peak_memory is not None:
+                totals["peak_memory"] = max(totals["peak_memory"] or 0,
+                                            record.peak_memory)
+            callbacks = list(_callbacks)
+
+        for callback in callbacks:
+            callback(record)
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pause()
+        self.finish()
+        return False
+
+class _NullStage(object):
+    """A stage that records nothing, used while instrumentation is off"""
+    def add(self, records=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def _instrument_iterator(name, count, iterator):
+    """
+    Wraps an iterator so that only the time spent producing each item is
+    recorded.  The stage is finished when the iterator is exhausted or
+    closed.
+    """
+    s = Stage(name)
+    try:
+        while True:
+            s.resume()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                s.pause()
+
+            s.add(1 if count is None else count(item))
+            yield item
+    finally:
+        s.finish()
+
+def _is_generator_function(function):
+    code = getattr(function, "__code__", None)
+    # CO_GENERATOR
+    return code is not None and bool(code.co_flags & 0x20)
+
+def _stack():
+    """Returns the stages running in this thread, innermost last"""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def _current_stage():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+def _tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+def _reset_peak():
+    """Resets tracemalloc's peak, on Pythons that support it (3.9+)"""
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+def _max_rss():
+    """Returns the peak resident size of the process, in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return usage
+    return usage * 1024
@@ -1,13 +1,62 @@
 """
 Class descrbing an interval on the genome.
+
+Intervals do not hold their chromosome names.  Every name is interned in a
+chromosome table shared by the whole process, and each interval holds the
+name's integer code in chrom_code, so that intervals are small and
+comparing chromosomes compares integers.  The chromosome property looks
+the name up again.
 """
+from operator import attrgetter
+import threading
+import numpy as np
+
 __author__ = 'Matthew Peterson'
 
+_chromosome_codes = {}
+_chromosome_names = []
+_chromosome_lock = threading.Lock()
+
+def chromosome_code(name):
+    """
+    Returns the integer code of a chromosome name, adding the name to the
+    chromosome table if it is not already there.
+
+    :param name: the name of the chromosome
+    :type name: string
+    :rtype: int
+    """
+    code = _chromosome_codes.get(name)
+    if code is None:
+        with _chromosome_lock:
+            code = _chromosome_codes.get(name)
+            if code is None:
+                code = len(_chromosome_names)
+                _chromosome_names.append(name)
+                _chromosome_codes[name] = code
+
+    return code
+
+def chromosome_name(code):
+    """
+    Returns the chromosome name with an integer code.
+
+    :param code: the code, as returned by chromosome_code()
+    :type code: int
+    :rtype: string
+    """
+    return _chromosome_names[code]
+
 class Interval(object):
     """
     An interval along the genome.  Superclass for any feature mapped to
     the Genome (ChIP peaks, genes, intergenic regions, etc.)
+
+    Intervals have fixed slots rather than a __dict__, so subclasses must
+    list the attributes they add in their own __slots__.
     """
+    __slots__ = ("chrom_code", "chrom_start", "chrom_end")
+
     def __init__(self, chromosome = "", start=1, stop = 1):
         """
         Create a new Interval.
@@ -15,15 +64,24 @@ class Interval(object):
         if start < 0:
             raise ValueError("Start index cannot be less than zero.")
 
-        self.chromosome = chromosome
+        self.chrom_code = chromosome_code(chromosome)
         self.chrom_start = start
         self.chrom_end = stop
 
+    @property
+    def chromosome(self):
+        """The name of the chromosome the interval is on"""
+        return _chromosome_names[self.chrom_code]
+
+    @chromosome.setter
+    def chromosome(self, chromosome):
+        self.chrom_code = chromosome_code(chromosome)
+
     def overlaps(self, other):
         """
         Tests whether or not this interval overlaps another.
         """
-        if self.chromosome != other.chromosome:
+        if self.chrom_code != other.chrom_code:
             return False
 
         if self.chrom_start <= other.chrom_end and self.chrom_end >= other.chrom_start:
@@ -31,17 +89,29 @@ class Interval(object):
 
         return False
 
-    def get_genome_features(self, genome, genic=True, intergenic=True):
+    def __getstate__(self):
         """
-        Get overlapping features and classifications
+        Returns the state of the interval for pickling.  Chromosome codes
+        differ between processes, so the chromosome is stored by name.
         """
-        hits = []
+        state = {}
+        for name in _slots(type(self)):
+            if name == "chrom_code":
+                state["chromosome"] = self.chromosome
+            elif hasattr(self, name):
+                state[name] = getattr(self, name)
 
-        for f in genome.features(True):
-            if self.overlaps(f):
-                hits.append(f)
+        return state
 
-        return hits
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def get_genome_features(self, genome, genic=True, intergenic=True):
+        """
+        Get overlapping features and classifications
+        """
+        return genome.overlapping_features(self, genic, intergenic)
 
     def _filter_hits(self):
         hits = set()
@@ -53,3 +123,155 @@ class Interval(object):
         """
         return "%s:%d-%d" % (self.chromosome, self.chrom_start, self.chrom_end)
 
+_class_slots = {}
+
+def _slots(cls):
+    """Returns the names of the slots of a class and its superclasses"""
+    slots = _class_slots.get(cls)
+    if slots is None:
+        slots = []
+        for c in reversed(cls.__mro__):
+            names = c.__dict__.get("__slots__", ())
+            if isinstance(names, str):
+                names = (names,)
+            slots.extend(n for n in names if n not in slots)
+        _class_slots[cls] = slots = tuple(slots)
+
+    return slots
+
+class IntervalIndex(object):
+    """
+    A static index over a set of intervals on a single chromosome.  Intervals
+    are kept sorted by start and end position, alongside arrays of their
+    starts, their ends and the running maximum of their ends, so that overlap
+    queries cost O(log N + hits) rather than a scan over every interval.
+
+    Queries only touch the arrays until they index the intervals of their
+    hits, so an index can be built over a sequence that creates each
+    interval when it is first needed (see from_sorted).
+    """
+    def __init__(self, intervals):
+        """
+        Create a new IntervalIndex.
+
+        :param intervals: the intervals to be indexed
+        :type intervals: iterable
+        """
+        self._intervals = sorted(intervals,
+                                 key=attrgetter('chrom_start', 'chrom_end'))
+        self.starts = np.array([i.chrom_start for i in self._intervals],
+                               dtype=np.int64)
+        self.ends = np.array([i.chrom_end for i in self._intervals],
+                             dtype=np.int64)
+        # The running maximum is non-decreasing, so it can be searched to
+        # find the first interval that could still reach a query start.
+        self.max_ends = np.maximum.accumulate(self.ends)
+
+    @classmethod
+    def from_sorted(cls, intervals, starts, ends, max_ends):
+        """
+        Create an IntervalIndex from intervals that are already sorted by
+        start and end position, and arrays of their starts, their ends and
+        the running maximum of their ends, e.g. as saved by Genome.save().
+        Nothing is sorted or recomputed, and the intervals are only indexed
+        for the hits of queries.
+
+        :param intervals: the sorted intervals
+        :type intervals: sequence
+        :param starts: the start positions
+        :type starts: numpy.ndarray
+        :param ends: the end positions
+        :type ends: numpy.ndarray
+        :param max_ends: the running maximum of the end positions
+        :type max_ends: numpy.ndarray
+        """
+        index = cls.__new__(cls)
+        index._intervals = intervals
+        index.starts = starts
+        index.ends = ends
+        index.max_ends = max_ends
+
+        return index
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self._intervals)
+
+    def __getitem__(self, i):
+        return self._intervals[i]
+
+    def first(self, position):
+        """
+        Returns the position in the index of the first interval that can
+        overlap position, or any position after it.  Every earlier interval
+        ends before position.
+
+        :param position: the position
+        :type position: int
+        :rtype: int
+        """
+        return int(self.max_ends.searchsorted(position, "left"))
+
+    def positions(self, start, stop):
+        """
+        Returns the positions in the index of the intervals overlapping the
+        closed range [start, stop], using the same convention as
+        Interval.overlaps.
+
+        :param start: start position of the query
+        :type start: int
+        :param stop: stop position of the query
+        :type stop: int
+        :rtype: numpy.ndarray
+        """
+        hi = int(self.starts.searchsorted(stop, "right"))
+        lo = min(self.first(start), hi)
+
+        return (self.ends[lo:hi] >= start).nonzero()[0] + lo
+
+    def overlapping_positions(self, starts, stops):
+        """
+        Returns the positions of the intervals overlapping each of a set of
+        closed ranges, as for positions().  Every range is searched for at
+        once.
+
+        :param starts: the start position of each query
+        :type starts: sequence
+        :param stops: the stop position of each query
+        :type stops: sequence
+        :return a list with a list of positions for each query
+        :rtype list
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        his = np.searchsorted(self.starts, stops, "right")
+        los = np.minimum(np.searchsorted(self.max_ends, starts, "left"), his)
+
+        # Every position from lo to hi of each query, then those that also
+        # end after the query starts
+        counts = his - los
+        queries = np.repeat(np.arange(len(starts)), counts)
+        positions = np.arange(counts.sum()) + \
+                    np.repeat(los - (np.cumsum(counts) - counts), counts)
+        hits = self.ends[positions] >= starts[queries]
+        positions = positions[hits].tolist()
+        bounds = np.searchsorted(queries[hits],
+                                 np.arange(len(starts) + 1)).tolist()
+
+        return [positions[first:stop]
+                for first, stop in zip(bounds[:-1], bounds[1:])]
+
+    def overlapping(self, start, stop):
+        """
+        Returns the indexed intervals overlapping the closed range
+        [start, stop], using the same convention as Interval.overlaps.
+
+        :param start: start position of the query
+        :type start: int
+        :param stop: stop position of the query
+        :type stop: int
+        :rtype: list
+        """
+        return [self._intervals[i]
+                for i in self.positions(start, stop).tolist()]
@@ -0,0 +1,88 @@
+"""
+Pools of worker processes that share their data through a state dict.
+
+Each worker is set up once by an initializer, which keeps what the tasks
+need (coverage files, a genome snapshot, an expression matrix) in state,
+so that only small tasks and results pass between processes:
+
+    from transnet import parallel
+
+    def _init_worker(filename):
+        parallel.state["coverage"] = DiskBasedGenomeCoverage(filename)
+
+    def _worker(sequence):
+        return parallel.state["coverage"].get_length(sequence)
+
+    with parallel.pool(4, _init_worker, (filename,)) as workers:
+        lengths = workers.map(_worker, sequences)
+
+Leaving the with block closes the pool and waits for its workers, or
+terminates them if the block raised.  If processes is None or 1, the
+initializer runs in this process instead, tasks run as they are submitted,
+and state is restored on leaving, so callers need only one code path.
+"""
+import contextlib
+import multiprocessing
+
+__author__ = "Matthew Peterson"
+
+# What the initializer kept for the tasks of this process
+state = {}
+
+@contextlib.contextmanager
+def pool(processes, initializer, initargs=()):
+    """
+    Starts a pool of worker processes, each set up by initializer.  Yields
+    an object with the map() and apply_async() methods of
+    multiprocessing.Pool.
+
+    :param processes: the number of worker processes.  If None or at most
+                      1, every task is run in this process.
+    :type processes: int
+    :param initializer: called with initargs in each worker, to fill state
+    :type initializer: function
+    :param initargs: the arguments of initializer
+    :type initargs: tuple
+    """
+    if processes is None or processes <= 1:
+        saved = dict(state)
+        state.clear()
+        try:
+            initializer(*initargs)
+            yield _SerialPool()
+        finally:
+            state.clear()
+            state.update(saved)
+        return
+
+    workers = multiprocessing.Pool(processes, _init_worker,
+                                   (initializer, initargs))
+    try:
+        yield workers
+        workers.close()
+    except BaseException:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+
+def _init_worker(initializer, initargs):
+    """Sets up the state of a worker process, dropping any it inherited"""
+    state.clear()
+    initializer(*initargs)
+
+class _SerialPool(object):
+    """Runs the tasks of a pool in this process, as they are submitted"""
+    def map(self, func, iterable, chunksize=None):
+        return [func(item) for item in iterable]
+
+    def apply_async(self, func, args=()):
+        return _Result(func(*args))
+
+class _Result(object):
+    """The result of a task that has already run"""
+    def __init__(self, value):
+        self._value = value
+
+    def get(self, timeout=None):
+        return self._value
@@ -0,0 +1,97 @@
+"""
+Helpers for reading large delimited text files
+"""
+from itertools import islice
+import numpy as np
+
+__author__ = "Matthew Peterson"
+
+DEFAULT_BATCH_SIZE = 100000
+
+# The width of the text fields that chromosome and sequence names are read
+# into by parse_blocks.  Longer names would be truncated, so check_names
+# rejects any name that fills the field.
+MAX_NAME_LENGTH = 128
+
+def encode_chromosomes(names):
+    """
+    Converts a sequence of chromosome names into a list of unique names and
+    an array of codes indexing into it.
+
+    :param names: the chromosome name of each record
+    :type names: sequence
+    :return a tuple of the form (chromosomes, codes)
+    :rtype tuple
+    """
+    names = np.asarray(names)
+    if len(names) == 0:
+        return [], np.zeros(0, dtype=np.int32)
+
+    # Files are usually grouped by chromosome, so only the first name in
+    # each run of identical names needs to be looked up.
+    run_starts = np.flatnonzero(np.concatenate(([True],
+                                                names[1:] != names[:-1])))
+    run_lengths = np.diff(np.append(run_starts, len(names)))
+
+    lookup = {}
+    run_codes = [lookup.setdefault(name, len(lookup))
+                 for name in names[run_starts].tolist()]
+
+    chromosomes = [None] * len(lookup)
+    for name, code in lookup.items():
+        chromosomes[code] = name
+
+    codes = np.repeat(np.array(run_codes, dtype=np.int32), run_lengths)
+    return chromosomes, codes
+
+def check_names(names):
+    """
+    Raises a ValueError if any name is too long to be read by parse_blocks.
+    Names are truncated to MAX_NAME_LENGTH characters, so a name that long
+    may have lost its end, and could have been merged with another name
+    sharing the same prefix.
+
+    :param names: the distinct names read, e.g. as returned by
+                  encode_chromosomes
+    :type names: list
+    """
+    for name in names:
+        if len(name) >= MAX_NAME_LENGTH:
+            raise ValueError("Names of %d or more characters are not "
+                             "supported: %s..." % (MAX_NAME_LENGTH,
+                                                   name[:32]))
+
+def parse_blocks(handle, dtype, batch_size = DEFAULT_BATCH_SIZE,
+                 separator = "\t"):
+    """
+    Reads a delimited file in blocks of lines, and returns an iterator of
+    structured numpy arrays, one per block, with the fields given by dtype.
+    The first len(dtype.names) fields of each line are read, and blank lines
+    are skipped.  Each block is converted by numpy.loadtxt, so whole columns
+    are converted at once rather than calling int() and float() for every
+    field.
+
+    :param handle: the handle to be read
+    :type handle: file
+    :param dtype: the name and type of each field
+    :type dtype: numpy.dtype
+    :param batch_size: the maximum number of lines in each block
+    :type batch_size: int
+    :param separator: the field separator, or None for any whitespace
+    :type separator: string
+    """
+    dtype = np.dtype(dtype)
+    columns = tuple(range(len(dtype.names)))
+    handle = iter(handle)
+
+    while True:
+        lines = list(islice(handle, batch_size))
+        if not lines:
+            break
+
+        lines = [l for l in lines if l.strip()]
+        if not lines:
+            continue
+
+        yield np.loadtxt(lines, dtype=dtype, delimiter=separator,
+                         usecols=columns, comments=None, ndmin=1)
@@ -0,0 +1,249 @@
+"""
+Vectorized statistical functions
+"""
+import math
+import numpy as np
+
+__author__ = "Matthew Peterson"
+
+_EPSILON = 1e-15
+_TINY = 1e-300
+_MAX_ITERATIONS = 100000
+
+def poisson_sf(k, mean):
+    """
+    Returns the probability of observing at least k events under a Poisson
+    distribution, i.e. P(X >= k).  Computed for whole arrays at once as the
+    regularized lower incomplete gamma function P(k, mean), using its series
+    expansion where mean < k + 1 and its continued fraction elsewhere.
+
+    :param k: the observed counts
+    :type k: numpy.ndarray
+    :param mean: the expected counts
+    :type mean: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    k, mean = np.broadcast_arrays(np.asarray(k, dtype=np.int64),
+                                  np.asarray(mean, dtype=np.float64))
+    shape = k.shape
+    k = k.ravel()
+    mean = mean.ravel()
+
+    p = np.ones(len(k))
+    positive = k > 0
+    p[positive & (mean <= 0)] = 0.0
+
+    use_series = positive & (mean > 0) & (mean < k + 1)
+    use_fraction = positive & (mean > 0) & (mean >= k + 1)
+
+    idx = np.flatnonzero(use_series)
+    if len(idx):
+        p[idx] = _gamma_series(k[idx], mean[idx])
+
+    idx = np.flatnonzero(use_fraction)
+    if len(idx):
+        p[idx] = 1.0 - _gamma_fraction(k[idx], mean[idx])
+
+    return np.clip(p, 0.0, 1.0).reshape(shape)
+
+def poisson_critical_count(mean, alpha):
+    """
+    Returns the smallest count k with P(X >= k) <= alpha under a Poisson
+    distribution, found for whole arrays of means at once by bisection.
+    Comparing counts against these is much cheaper than computing a p-value
+    for every count.
+
+    :param mean: the expected counts
+    :type mean: numpy.ndarray
+    :param alpha: the significance level
+    :type alpha: float
+    :rtype: numpy.ndarray
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    shape = mean.shape
+    mean = mean.ravel()
+
+    low = np.zeros(len(mean), dtype=np.int64)
+    high = np.ceil(mean + 10 * np.sqrt(mean) + 10).astype(np.int64)
+
+    # Make sure every upper bound is significant
+    too_low = np.flatnonzero(poisson_sf(high, mean) > alpha)
+    while len(too_low):
+        low[too_low] = high[too_low]
+        high[too_low] *= 2
+        too_low = too_low[poisson_sf(high[too_low], mean[too_low]) > alpha]
+
+    # P(X >= low) > alpha and P(X >= high) <= alpha, unless low is 0
+    while True:
+        active = np.flatnonzero(high - low > 1)
+        if not len(active):
+            break
+        middle = (low[active] + high[active]) // 2
+        significant = poisson_sf(middle, mean[active]) <= alpha
+        high[active[significant]] = middle[significant]
+        low[active[~significant]] = middle[~significant]
+
+    # Only a count of 0 can be significant when P(X >= 1) is too
+    high[poisson_sf(low, mean) <= alpha] = 0
+
+    return high.reshape(shape)
+
+def log_factorial(n):
+    """
+    Returns a table of log(i!) for i from 0 to n, so that log factorials of
+    many integers can be looked up at once.
+
+    :param n: the largest value in the table
+    :type n: int
+    :rtype: numpy.ndarray
+    """
+    table = np.zeros(n + 1)
+    if n > 0:
+        np.cumsum(np.log(np.arange(1, n + 1, dtype=np.float64)),
+                  out=table[1:])
+
+    return table
+
+def hypergeometric_sf(k, total, successes, draws, log_factorials=None):
+    """
+    Returns the probability of drawing at least k successes when drawing
+    without replacement, i.e. the upper tail of the hypergeometric
+    distribution, or a one-sided Fisher's exact test.  The tail is summed
+    for whole arrays at once, until its terms become negligible.
+
+    :param k: the observed successes
+    :type k: numpy.ndarray
+    :param total: the population size
+    :type total: numpy.ndarray
+    :param successes: the number of successes in the population
+    :type successes: numpy.ndarray
+    :param draws: the number of draws
+    :type draws: numpy.ndarray
+    :param log_factorials: a table from log_factorial() covering total, to
+                           avoid building one on each call
+    :type log_factorials: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    arrays = np.broadcast_arrays(*[np.asarray(a, dtype=np.int64) for a in
+                                   (k, total, successes, draws)])
+    shape = arrays[0].shape
+    k, total, successes, draws = [a.ravel() for a in arrays]
+    if log_factorials is None:
+        log_factorials = log_factorial(int(total.max()) if len(total) else 0)
+
+    lf = log_factorials
+    # The denominator, log(C(total, draws))
+    log_norm = lf[total] - lf[draws] - lf[total - draws]
+
+    first = np.maximum(k, np.maximum(0, draws - (total - successes)))
+    last = np.minimum(successes, draws)
+    mode = (draws + 1) * (successes + 1) // (total + 2)
+
+    p = np.zeros(len(k))
+    active = np.flatnonzero(first <= last)
+    i = first.copy()
+
+    while len(active):
+        x = i[active]
+        K = successes[active]
+        N = total[active]
+        n = draws[active]
+        log_pmf = lf[K] - lf[x] - lf[K - x] + lf[N - K] - lf[n - x] - \
+                  lf[N - K - n + x] - log_norm[active]
+        term = np.exp(log_pmf)
+        p[active] += term
+
+        i[active] += 1
+        done = (i[active] > last[active]) | \
+               ((x >= mode[active]) & (term <= p[active] * _EPSILON))
+        active = active[~done]
+
+    p[k <= 0] = 1.0
+
+    return np.clip(p, 0.0, 1.0).reshape(shape)
+
+def benjamini_hochberg(pvalues):
+    """
+    Returns the Benjamini-Hochberg adjusted p-values (q-values) for a set of
+    p-values, controlling the false discovery rate.
+
+    :param pvalues: the p-values
+    :type pvalues: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    n = len(pvalues)
+    if n == 0:
+        return pvalues.copy()
+
+    order = np.argsort(pvalues)
+    adjusted = pvalues[order] * n / np.arange(1, n + 1)
+    # Each q-value is the smallest adjusted p-value at or above its rank
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+
+    qvalues = np.empty(n)
+    qvalues[order] = np.minimum(adjusted, 1.0)
+
+    return qvalues
+
+def _log_factorials(k):
+    """
+    Returns log(k!) for an array of integers.  Counts are often repeated, so
+    math.lgamma is only called once for each distinct value.
+    """
+    values, inverse = np.unique(k, return_inverse=True)
+    logs = np.array([math.lgamma(v + 1) for v in values.tolist()])
+
+    return logs[inverse.ravel()]
+
+def _gamma_series(a, x):
+    """The regularized lower incomplete gamma function P(a, x), by series"""
+    # a is an integer, so log(gamma(a + 1)) = log(a!)
+    log_prefix = -x + a * np.log(x) - _log_factorials(a)
+
+    a = a.astype(np.float64)
+    total = np.ones(len(a))
+    term = np.ones(len(a))
+    active = np.arange(len(a))
+
+    n = 0
+    while len(active) and n < _MAX_ITERATIONS:
+        n += 1
+        term[active] *= x[active] / (a[active] + n)
+        total[active] += term[active]
+        active = active[term[active] > total[active] * _EPSILON]
+
+    return np.exp(log_prefix) * total
+
+def _gamma_fraction(a, x):
+    """The regularized upper incomplete gamma function Q(a, x), by Lentz's
+    method for its continued fraction"""
+    # a is an integer, so log(gamma(a)) = log((a - 1)!)
+    log_prefix = -x + a * np.log(x) - _log_factorials(a - 1)
+
+    a = a.astype(np.float64)
+    b = x + 1.0 - a
+    c = np.full(len(a), 1.0 / _TINY)
+    d = 1.0 / b
+    h = d.copy()
+    active = np.arange(len(a))
+
+    i = 0
+    while len(active) and i < _MAX_ITERATIONS:
+        i += 1
+        an = -i * (i - a[active])
+        b[active] += 2.0
+
+        d_active = an * d[active] + b[active]
+        d_active[np.abs(d_active) < _TINY] = _TINY
+        c_active = b[active] + an / c[active]
+        c_active[np.abs(c_active) < _TINY] = _TINY
+
+        d[active] = 1.0 / d_active
+        c[active] = c_active
+        delta = d[active] * c_active
+        h[active] *= delta
+
+        active = active[np.abs(delta - 1.0) > _EPSILON]
+
+    return np.exp(log_prefix) * h
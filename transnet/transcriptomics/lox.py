@@ -8,10 +8,25 @@ Bioinformatics 26: 1918-1919.
 """
 
 from os import path
-import math
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import tempfile
+import numpy as np
+from transnet import parallel
+from transnet.instrumentation import instrumented
 
-def read(lox_file, read_pvals = False):
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+LEVEL = 0
+LOWER = 1
+UPPER = 2
+
+@instrumented("lox.read", count=lambda experiment: len(experiment.loci))
+def read(lox_file, read_pvals = False, threads = None, cache = False):
     """Reads in a LOX output.
     
     :param lox_handle: A handle to the LOX output
@@ -19,10 +34,18 @@ def read(lox_file, read_pvals = False):
     :param read_pvals: Read the p-values for differential expression from the
                        directory the LOX output is in.  If True, will look for
                        the files in the directory, and read them into the
-                       pvals attribute
+                       pvals attribute.  Each file is only read when its
+                       p-values are first used, unless threads is given.
+    :param threads: if given, read every p-value file straight away, using
+                    this many threads
+    :type threads: int
+    :param cache: keep a binary copy of each p-value file beside it, which
+                  is memory-mapped instead of parsing the file again
+    :type cache: bool
     """
     with open(lox_file) as lox_handle:
         experiment = LOXExperiment(lox_handle)
+    experiment.pvalues.cache = cache
     
     results_dir = path.dirname(lox_file)
     if results_dir == "":
@@ -37,39 +60,382 @@ def read(lox_file, read_pvals = False):
             experiment.add_pvals(e, results_dir + "/" + filename + "." + e + 
                                  ".pvalue")
 
+        if threads is not None:
+            experiment.pvalues.load_all(threads)
+
     return experiment
 
-class LOXMeasurement(object):
+def _parse_pval_header(line):
+    """
+    Reads in the header from the LOX p-value file and makes sure the names
+    match what is expected in the file.
+    """
+    pairs = []
     
-    _scale_value = None
+    # RegEx pattern for matching each header.
+    pattern = re.compile('^P\((.+)>(.+)\)$')
     
-    def __init__(self, level, lower_confidence, upper_confidence):
-        self.expression_level = level
-        self.lower_confidence = lower_confidence
-        self.upper_confidence = upper_confidence
+    tokens = line.rstrip("\r\n").split("\t")
+    
+    for t in tokens[2:]:
+        pairs.append(pattern.match(t).groups())
     
+    return pairs
+
+_DIFF_FIELDS = np.dtype([("experiment_1", np.int32),
+                         ("experiment_2", np.int32), ("gene", np.int32),
+                         ("pvalue", np.float64), ("log_ratio", np.float64)])
+
+def _diff_expression(log_levels, first, second, pvalues, min_change,
+                     threshold):
+    """
+    Finds differentially expressed genes for a set of pairs of experiments.
+    See LOXExperiment.diff_expression.
+
+    :param log_levels: log2 expression levels, of shape (genes, experiments)
+    :param first: the first experiment of each pair
+    :param second: the second experiment of each pair
+    :param pvalues: p-values, of shape (pairs, genes)
+    """
+    ratios = (log_levels[:, first] - log_levels[:, second]).T
+    with np.errstate(invalid="ignore"):
+        significant = (pvalues <= threshold) | (1.0 - pvalues <= threshold)
+    pair, gene = np.nonzero(significant & (np.abs(ratios) > min_change))
+
+    results = np.empty(len(pair), dtype=_DIFF_FIELDS)
+    results["experiment_1"] = first[pair]
+    results["experiment_2"] = second[pair]
+    results["gene"] = gene
+    results["pvalue"] = pvalues[pair, gene]
+    results["log_ratio"] = ratios[pair, gene]
+
+    return results
+
+def _init_diff_worker(log_levels, min_change, threshold):
+    """Keeps the expression levels in each worker process"""
+    parallel.state["settings"] = (log_levels, min_change, threshold)
+
+def _diff_worker(task):
+    """Finds differentially expressed genes for a chunk of pairs"""
+    log_levels, min_change, threshold = parallel.state["settings"]
+    first, second, pvalues = task
+
+    return _diff_expression(log_levels, first, second, pvalues, min_change,
+                            threshold)
+
+class LOXPValues(Mapping):
+    """
+    The p-values for differential expression from a set of LOX p-value
+    files, as a mapping from (from_experiment, to_experiment, locus) to
+    p-value.
+
+    Each file is held as a dense array of shape (pairs, genes), with rows in
+    the order of the file's header and columns in the order of the
+    experiment's loci.  Only a file's header is read when it is added; the
+    rest is read the first time one of its p-values is used.  If cache is
+    True, the file's p-values are also saved beside it as <file>.npy, in
+    the order of the file's own rows and followed by their loci, so that
+    the cache does not depend on the LOX output it was read with.  The
+    cache also records the size and modification time of the file, and
+    later loads memory-map it while the file still has both, arranging it
+    by gene_index.
+    """
+    def __init__(self, gene_index, cache=False):
+        """
+        :param gene_index: a mapping from locus to column
+        :type gene_index: dict
+        :param cache: keep binary copies of the p-value files
+        :type cache: bool
+        """
+        self.gene_index = gene_index
+        self.cache = cache
+        self._files = []
+        self._arrays = {}
+        self._pairs = {}
+
+    def add(self, filename):
+        """
+        Adds a LOX .pvalue file.  Pairs that are already present are replaced
+        by those in the new file.
+
+        :param filename: the name of the file
+        :type filename: string
+        """
+        with open(filename) as handle:
+            pairs = _parse_pval_header(handle.readline())
+
+        self._files.append((filename, pairs))
+        for row, pair in enumerate(pairs):
+            self._pairs[pair] = (filename, row)
+
+    def pairs(self):
+        """
+        Returns a sorted list of the (from_experiment, to_experiment) pairs
+        with p-values.
+        """
+        return sorted(self._pairs)
+
+    def matrix(self, pairs):
+        """
+        Returns the p-values of every gene for a list of pairs, as an array
+        of shape (pairs, genes).  Missing p-values are NaN.
+
+        :param pairs: a list of (from_experiment, to_experiment) pairs
+        :type pairs: list
+        """
+        matrix = np.full((len(pairs), len(self.gene_index)), np.nan)
+
+        for i, pair in enumerate(pairs):
+            if pair in self._pairs:
+                filename, row = self._pairs[pair]
+                matrix[i] = self._load(filename)[row]
+
+        return matrix
+
+    def load_all(self, threads=None):
+        """
+        Reads every file that has not been read yet, several at a time.
+
+        :param threads: the number of threads to read files with
+        :type threads: int
+        """
+        filenames = [f for f, _ in self._files if f not in self._arrays]
+        if not filenames:
+            return
+
+        pool = ThreadPool(threads)
+        try:
+            arrays = pool.map(self._read, filenames)
+        finally:
+            pool.close()
+            pool.join()
+
+        for filename, array in zip(filenames, arrays):
+            self._arrays[filename] = array
+
+    def __getitem__(self, key):
+        from_exp, to_exp, locus = key
+        filename, row = self._pairs[(from_exp, to_exp)]
+        value = self._load(filename)[row, self.gene_index[locus]]
+
+        if np.isnan(value):
+            raise KeyError(key)
+
+        return float(value)
+
+    def __iter__(self):
+        for from_exp, to_exp in self.pairs():
+            filename, row = self._pairs[(from_exp, to_exp)]
+            values = self._load(filename)[row]
+            for locus, column in self.gene_index.items():
+                if not np.isnan(values[column]):
+                    yield (from_exp, to_exp, locus)
+
+    def __len__(self):
+        return sum(int(np.count_nonzero(~np.isnan(
+                       self._load(filename)[row])))
+                   for filename, row in self._pairs.values())
+
+    def _load(self, filename):
+        """Returns the array for a file, reading it if necessary"""
+        if filename not in self._arrays:
+            self._arrays[filename] = self._read(filename)
+
+        return self._arrays[filename]
+
+    @instrumented("lox.read_pvalues", count=lambda array: array.shape[1])
+    def _read(self, filename):
+        """Reads the array for a file, from its cache if possible"""
+        cache_file = filename + ".npy"
+        # Taken before parsing, so a file that changes while it is read is
+        # never recorded as unchanged
+        stat = os.stat(filename)
+        source = (stat.st_size, stat.st_mtime)
+
+        if self.cache and path.exists(cache_file):
+            try:
+                loci, values, cached_source = _read_cache(cache_file)
+            except (IOError, OSError, ValueError, EOFError):
+                pass
+            else:
+                if cached_source == source:
+                    return self._by_gene(loci, values)
+
+        loci, values = _parse_pval_file(filename)
+
+        if self.cache:
+            try:
+                handle, temp_file = tempfile.mkstemp(
+                    dir=path.dirname(path.abspath(filename)))
+                with os.fdopen(handle, "wb") as temp_handle:
+                    np.save(temp_handle, values)
+                    np.save(temp_handle, np.array(loci, dtype=str))
+                    np.save(temp_handle, np.array(source, dtype=np.float64))
+                os.rename(temp_file, cache_file)
+            except (IOError, OSError):
+                pass
+
+        return self._by_gene(loci, values)
+
+    def _by_gene(self, loci, values):
+        """
+        Rearranges the p-values of a file, of shape (pairs, rows) in the
+        order of the file's rows, into the columns of gene_index.  If the
+        file has exactly the experiment's loci in the same order, the values
+        are returned as they are.
+        """
+        columns = np.array([self.gene_index.get(l, -1) for l in loci],
+                           dtype=np.int64)
+        if len(columns) == len(self.gene_index) and \
+           (columns == np.arange(len(columns))).all():
+            return values
+
+        array = np.full((values.shape[0], len(self.gene_index)), np.nan)
+        found = columns >= 0
+        array[:, columns[found]] = values[:, found]
+
+        return array
+
+def _parse_pval_file(filename):
+    """
+    Parses a LOX p-value file.
+
+    :return a tuple of the form (loci, p-values), where the p-values are an
+            array of shape (pairs, rows) in the order of the file's rows
+    :rtype tuple
+    """
+    with open(filename) as handle:
+        pairs = _parse_pval_header(handle.readline())
+        loci = []
+        rows = []
+        for line in handle:
+            tokens = line.rstrip("\r\n").split("\t")
+            loci.append(tokens[0])
+            rows.append(tokens[2:2 + len(pairs)])
+
+    values = np.array(rows, dtype=np.float64).reshape(len(rows), len(pairs))
+
+    return loci, np.ascontiguousarray(values.T)
+
+def _read_cache(cache_file):
+    """
+    Reads a p-value cache written by LOXPValues, which holds the p-values
+    of a file in the order of its rows, followed by the loci of the rows
+    and the size and modification time of the file.  The p-values are
+    memory-mapped.
+
+    :return a tuple of the form (loci, p-values, (size, mtime)), with the
+            loci and p-values as for _parse_pval_file
+    :rtype tuple
+    """
+    values = np.load(cache_file, mmap_mode="r")
+    with open(cache_file, "rb") as handle:
+        handle.seek(values.offset + values.nbytes)
+        loci = np.load(handle).tolist()
+        source = np.load(handle)
+
+    if values.ndim != 2 or len(loci) != values.shape[1] or \
+       source.shape != (2,):
+        raise ValueError("%s is not a p-value cache." % cache_file)
+
+    return loci, values, (int(source[0]), float(source[1]))
+
+class LOXMeasurement(object):
+    """
+    The expression level of a gene in one experiment, with its confidence
+    interval.  Measurements taken from a LOXExperiment are views of the
+    experiment's values, so changes to them change the experiment.
+    """
+    def __init__(self, level, lower_confidence, upper_confidence):
+        self._values = np.array([level, lower_confidence, upper_confidence],
+                                dtype=np.float64)
+
+    @classmethod
+    def _view(cls, values):
+        """Creates a measurement backed by an existing array of length 3"""
+        measurement = cls.__new__(cls)
+        measurement._values = values
+        return measurement
+
+    @property
+    def expression_level(self):
+        return float(self._values[LEVEL])
+
+    @expression_level.setter
+    def expression_level(self, value):
+        self._values[LEVEL] = value
+
+    @property
+    def lower_confidence(self):
+        return float(self._values[LOWER])
+
+    @lower_confidence.setter
+    def lower_confidence(self, value):
+        self._values[LOWER] = value
+
+    @property
+    def upper_confidence(self):
+        return float(self._values[UPPER])
+
+    @upper_confidence.setter
+    def upper_confidence(self, value):
+        self._values[UPPER] = value
+
     def scale(self, multiplier):
         """
         Scales an experiment by an absolute expression level.  Can be useful
         for presenting values in terms of approximate absolute expression,
         rather than using relative expression
         """
-        self.expression_level = self.expression_level * multiplier
-        self.lower_confidence = self.lower_confidence * multiplier
-        self.upper_confidence = self.upper_confidence * multiplier
+        self._values *= multiplier
+
+class LOXMeasurements(Mapping):
+    """
+    The measurements of a single experiment, as a read-only mapping from
+    locus to LOXMeasurement.  Backed by the experiment's values array.
+    """
+    def __init__(self, experiment, index):
+        self._experiment = experiment
+        self._index = index
+
+    def __getitem__(self, locus):
+        row = self._experiment.gene_index[locus]
+        return LOXMeasurement._view(
+            self._experiment.values[row, self._index])
+
+    def __iter__(self):
+        return iter(self._experiment.loci)
+
+    def __len__(self):
+        return len(self._experiment.loci)
+
+    def __contains__(self, locus):
+        return locus in self._experiment.gene_index
+
+    @property
+    def levels(self):
+        """The expression level of every gene, in the order of loci"""
+        return self._experiment.values[:, self._index, LEVEL]
 
 class LOXExperiment(object):
     """
     Describes a LOX experiment.  That is, the results from a run of LOX.  This
     is dependent on the input set.
-    
+
+    The measurements are held in values, a float array of shape
+    (genes, experiments, 3) whose last axis holds the expression level and
+    the lower and upper confidence bounds (indexed by LEVEL, LOWER and
+    UPPER).  Rows are in the order of loci, and gene_index maps each locus
+    to its row.
     """
     def __init__(self, lox_handle):
-        self.measurements = []
         self.experiments = []
-        self.pvalues = {}
+        self.loci = []
+        self.gene_index = {}
+        self.values = None
         self._parse_first_line(lox_handle)
         self._read_lox_output(lox_handle)
+        self.pvalues = LOXPValues(self.gene_index)
     
     def _read_lox_output(self, handle):
         """
@@ -79,96 +445,197 @@ class LOXExperiment(object):
         param: handle: The file handle to read from
         type: handle: file 
         """
-        
+        num_experiments = len(self.experiments)
+        rows = []
+
         for line in handle:
             tokens = line.rstrip("\r\n").split("\t")
-            # Create a new measurement for each 
-            num_experiments = len(self.experiments)
-            for i in range(0, num_experiments):
-                value = float(tokens[2 + i])
-                lower_bound = float(tokens[2 + i + num_experiments])
-                upper_bound = float(tokens[2 + i + 2*num_experiments])
-                measurement = LOXMeasurement(value, lower_bound, upper_bound)
-                self.measurements[i][tokens[0]] = measurement
-    
-    def scale(self, rpkm_dict):
+            self.gene_index[tokens[0]] = len(self.loci)
+            self.loci.append(tokens[0])
+            rows.append([float(t) for t in
+                         tokens[2:2 + 3 * num_experiments]])
+
+        # Each row holds every level, then every lower and every upper bound
+        values = np.array(rows, dtype=np.float64).reshape(
+            len(rows), 3, num_experiments)
+        self.values = np.ascontiguousarray(values.transpose(0, 2, 1))
+
+    @property
+    def measurements(self):
+        """
+        The measurements of each experiment, in the order of experiments, as
+        mappings from locus to LOXMeasurement.
+        """
+        return [LOXMeasurements(self, i)
+                for i in range(len(self.experiments))]
+
+    def expression_matrix(self, log=True):
+        """
+        Returns the expression levels as a genes x experiments matrix, e.g.
+        for network inference.
+
+        :param log: return log2 expression levels, taking levels of zero to
+                    be 0.01
+        :type log: bool
+        :return a tuple of the form (loci, experiments, matrix)
+        :rtype tuple
+        """
+        levels = self.values[:, :, LEVEL]
+        if log:
+            levels = np.log2(np.where(levels == 0, 0.01, levels))
+
+        return list(self.loci), list(self.experiments), levels
+
+    def scale(self, rpkm_dict, experiment=None):
         """ 
         Scales the set of experiments in order to get some measure of
-        absolute expression.
+        absolute expression.  The multiplier is the median ratio of RPKM to
+        expression level, over the genes with both in the given experiment.
+        Every experiment is scaled by the same multiplier, so relative
+        expression between experiments is unchanged.
+
+        :param rpkm_dict: a dictionary of RPKM values, keyed by locus (e.g.
+                          from Genome.rpkm)
+        :type rpkm_dict: dict
+        :param experiment: the experiment the RPKM values were measured in.
+                           Defaults to the first experiment.
+        :type experiment: string
+        :return the multiplier
+        :rtype float
         """
-        pass
+        if experiment is None:
+            experiment = self.experiments[0]
+        idx = self.experiments.index(experiment)
+
+        rows = []
+        rpkms = []
+        for locus, rpkm in rpkm_dict.items():
+            if locus in self.gene_index:
+                rows.append(self.gene_index[locus])
+                rpkms.append(rpkm)
+
+        levels = self.values[rows, idx, LEVEL]
+        rpkms = np.array(rpkms, dtype=np.float64)
+        usable = (levels > 0) & (rpkms > 0)
+        if not usable.any():
+            raise ValueError("No genes with both an RPKM and an expression " +
+                             "level.")
+
+        multiplier = float(np.median(rpkms[usable] / levels[usable]))
+        self.values *= multiplier
+
+        return multiplier
     
     def add_pvals(self, experiment, filename):
         """
-        Adds a set of pvalues to the experiment.  Reads in the corresponding
-        .pvalues file from LOX, and adds them to the 
-        """
-        with open(filename) as filehandle:
-            pairs = self._parse_pval_header(filehandle.readline())
-            for line in filehandle:
-                tokens = line.rstrip("\r\n").split("\t")
-                locus = tokens[0]
-                for i, t in enumerate(tokens[2:]):
-                    value = float(t)
-                    (from_exp, to_exp) = pairs[i]
-                    self.pvalues[(from_exp, to_exp, locus)] = value
+        Adds a set of pvalues to the experiment.  Registers the corresponding
+        .pvalues file from LOX with pvalues, which reads it when it is first
+        used.
+        """
+        self.pvalues.add(filename)
     
     def get_diff_expressed(self, experiment_1, experiment_2, 
                            min_change, threshold):
         """
-        Finds differentially expressed genes between two experiments.
+        Finds differentially expressed genes between two experiments.  See
+        diff_expression() for comparing many pairs of experiments at once.
+        Raises a KeyError if any gene has no p-value for the pair.
+
+        :return a set of tuples of the form (locus, p-value, |log2 ratio|)
+        :rtype set
         """
-        diff_expressed = set()
-        
-        # Get the indices for experiments first, so we don't have to do the 
-        # key search each time
-        idx_1 = self.experiments.index(experiment_1)
-        idx_2 = self.experiments.index(experiment_2)
-        
-        genes = self.measurements[0].keys()
         if experiment_1 not in self.experiments or \
            experiment_2 not in self.experiments:
             raise KeyError("Experiment not in dataset.")
-        
-        for g in genes:
-            
-            # TODO: Let's put this in a get_ratio function
-            val_exp_1 = self.measurements[idx_1][g].expression_level
-            if val_exp_1 == 0:
-                val_exp_1 = 0.01
-            
-            val_exp_2 = self.measurements[idx_2][g].expression_level
-            if val_exp_2 == 0:
-                val_exp_2 = 0.01
-            
-            ratio = math.fabs(math.log(val_exp_1 / val_exp_2, 2))
-            
-            pval = self.pvalues[(experiment_1, experiment_2, g)]
-            if pval <= threshold or (1.0 - pval) <= threshold:
-                if ratio > min_change:
-                    diff_expressed.add((g, pval, ratio))
-        
-        return diff_expressed
-    
-    def get_pval(experiment_1, experiment_2, gene):
-        pass
+
+        pair = (experiment_1, experiment_2)
+        if pair not in self.pvalue_pairs():
+            raise KeyError("No p-values for %s and %s." % pair)
+
+        missing = np.flatnonzero(np.isnan(self._pvalue_matrix([pair])[0]))
+        if len(missing) > 0:
+            raise KeyError(pair + (self.loci[missing[0]],))
+
+        results = self.diff_expression([pair], min_change, threshold)
+
+        return set((self.loci[r["gene"]], float(r["pvalue"]),
+                    abs(float(r["log_ratio"]))) for r in results)
+
+    def diff_expression(self, pairs=None, min_change=0.0, threshold=1.0,
+                        processes=None):
+        """
+        Finds differentially expressed genes between many pairs of
+        experiments at once.  A gene is differentially expressed between two
+        experiments if its p-value (or one minus its p-value) is at most the
+        threshold, and the absolute log2 ratio of its expression levels is
+        greater than min_change.  Expression levels of zero are taken to be
+        0.01.  Genes with no p-value for a pair are skipped for that pair,
+        rather than raising a KeyError as get_diff_expressed() does.
+
+        The result is a structured array with one row per differentially
+        expressed gene and pair, ordered by pair and then gene, with the
+        fields:
+
+        * experiment_1, experiment_2 - indexes into experiments
+        * gene - an index into loci
+        * pvalue - the p-value for the pair
+        * log_ratio - log2(level in experiment_1 / level in experiment_2)
+
+        :param pairs: a list of (experiment_1, experiment_2) pairs.  Defaults
+                      to every pair with p-values.
+        :type pairs: list
+        :param min_change: the minimum absolute log2 ratio
+        :type min_change: float
+        :param threshold: the p-value threshold
+        :type threshold: float
+        :param processes: the number of processes to divide the pairs among
+        :type processes: int
+        :rtype: numpy.ndarray
+        """
+        if pairs is None:
+            pairs = self.pvalue_pairs()
+
+        first = np.array([self.experiments.index(e) for e, _ in pairs],
+                         dtype=np.int32)
+        second = np.array([self.experiments.index(e) for _, e in pairs],
+                          dtype=np.int32)
+        pvalues = self._pvalue_matrix(pairs)
+
+        log_levels = self.expression_matrix()[2]
+
+        if processes is None or processes <= 1 or len(pairs) <= 1:
+            return _diff_expression(log_levels, first, second, pvalues,
+                                    min_change, threshold)
+
+        chunks = np.array_split(np.arange(len(pairs)),
+                                min(processes, len(pairs)))
+        with parallel.pool(processes, _init_diff_worker,
+                           (log_levels, min_change, threshold)) as workers:
+            results = workers.map(_diff_worker,
+                                  [(first[c], second[c], pvalues[c])
+                                   for c in chunks])
+
+        return np.concatenate(results)
+
+    def pvalue_pairs(self):
+        """
+        Returns a sorted list of the (experiment_1, experiment_2) pairs with
+        p-values.
+        """
+        return self.pvalues.pairs()
+
+    def _pvalue_matrix(self, pairs):
+        """
+        Returns the p-values of every gene for a list of pairs, as an array
+        of shape (pairs, genes).  Missing p-values are NaN.
+        """
+        return self.pvalues.matrix(pairs)
     
-    def _parse_pval_header(self, line):
+    def get_pval(self, experiment_1, experiment_2, gene):
         """
-        Reads in the header from the LOX p-value file and makes sure the names
-        match what is expected in the file.
+        Returns the p-value for a gene between two experiments.
         """
-        pairs = []
-        
-        # RegEx pattern for matching each header.
-        pattern = re.compile('^P\((.+)>(.+)\)$')
-        
-        tokens = line.rstrip("\r\n").split("\t")
-        
-        for t in tokens[2:]:
-            pairs.append(pattern.match(t).groups())
-        
-        return pairs
+        return self.pvalues[(experiment_1, experiment_2, gene)]
     
     def _parse_first_line(self, handle):
         """
@@ -176,10 +643,9 @@ class LOXExperiment(object):
         the data, and initializes the measurements and indices 
         """
         tokens = handle.readline().rstrip("\r\n").split("\t")
-        num_experiments = len(tokens[2:]) / 3
+        num_experiments = len(tokens[2:]) // 3
         
         for i in range(2, 2 + num_experiments):
-            self.measurements.append({})
             self.experiments.append(tokens[i])
     
     def __getitem__(self, key):
@@ -190,4 +656,4 @@ class LOXExperiment(object):
         :type key: string
         """
         key_idx = self.experiments.index(key)
-        return self.measurements[key_idx]
+        return LOXMeasurements(self, key_idx)
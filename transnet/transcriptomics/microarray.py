@@ -1,15 +1,272 @@
 #!/usr/bin/env python
-""" Provides Classes for working with microarray data"""
+""" Provides Classes for working with microarray data
+
+A compendium is stored as a directory holding:
+
+* genes.txt: the probe or locus of each row, one per line
+* conditions.txt: the name of each condition, one per line
+* expression.f32: the expression values as little-endian float32, condition
+  by condition, i.e. an array of shape (conditions, genes) in C order
+
+Each condition is a contiguous block at the end of expression.f32, so
+conditions can be appended without rewriting the file.  The file is read
+through a memory map, so only the parts that are used are loaded.
+"""
+import os
+from os import path
+import numpy as np
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 __author__ = "Matthew Peterson"
 
-class MicroarrayExperiment(object):
+DEFAULT_CHUNK_SIZE = 1024
+
+_GENES_FILE = "genes.txt"
+_CONDITIONS_FILE = "conditions.txt"
+_EXPRESSION_FILE = "expression.f32"
+_DTYPE = np.dtype("<f4")
+
+def create(directory, genes):
+    """
+    Creates a new, empty compendium.
+
+    :param directory: the directory to store the compendium in.  Created if
+                      it does not exist.
+    :type directory: string
+    :param genes: the probe or locus of each row
+    :type genes: list
+    :rtype: MicroarrayCompendium
+    """
+    if not path.isdir(directory):
+        os.makedirs(directory)
+
+    if path.exists(path.join(directory, _EXPRESSION_FILE)):
+        raise ValueError("%s already holds a compendium." % directory)
+
+    _write_lines(path.join(directory, _GENES_FILE), genes, "w")
+    _write_lines(path.join(directory, _CONDITIONS_FILE), [], "w")
+    open(path.join(directory, _EXPRESSION_FILE), "wb").close()
+
+    return MicroarrayCompendium(directory)
+
+def read(directory):
+    """
+    Opens an existing compendium.
+
+    :param directory: the directory the compendium is stored in
+    :type directory: string
+    :rtype: MicroarrayCompendium
+    """
+    return MicroarrayCompendium(directory)
+
+def _read_lines(filename):
+    with open(filename) as handle:
+        return [line.rstrip("\r\n") for line in handle]
+
+def _write_lines(filename, lines, mode):
+    with open(filename, mode) as handle:
+        for line in lines:
+            if "\n" in line or "\r" in line:
+                raise ValueError("Names cannot contain line breaks.")
+            handle.write(line + "\n")
+
+class MicroarrayExperiment(Mapping):
+    """
+    A single condition of a compendium, as a read-only mapping from probe or
+    locus to expression level.  Backed by the compendium's memory map.
+    """
+    def __init__(self, description, compendium, index):
+        """
+        :param description: the name of the condition
+        :type description: string
+        :param compendium: the compendium the condition is in
+        :type compendium: MicroarrayCompendium
+        :param index: the column of the condition
+        :type index: int
+        """
+        self.description = description
+        self._compendium = compendium
+        self._index = index
+
+    @property
+    def values(self):
+        """The expression level of every gene, in the order of genes"""
+        return self._compendium.matrix[:, self._index]
+
+    def __getitem__(self, gene):
+        return float(self.values[self._compendium.gene_index[gene]])
+
+    def __iter__(self):
+        return iter(self._compendium.genes)
 
-    def __init__(self, description):
-        pass
+    def __len__(self):
+        return len(self._compendium.genes)
+
+    def __contains__(self, gene):
+        return gene in self._compendium.gene_index
 
 class MicroarrayCompendium(object):
     """
-    Insert documentation
+    A set of microarray experiments over the same genes, held as a genes x
+    conditions float32 matrix in a memory-mapped file (see the top of this
+    module for the layout).  Use create() to start a new compendium.
+
+    Columns (conditions) are contiguous in the file, so selecting conditions
+    is cheap, and rows (genes) are strided.  Iterate with iter_chunks() to
+    work through a compendium too large to load at once.
     """
-    pass
+    def __init__(self, directory):
+        """
+        Opens a compendium.
+
+        :param directory: the directory the compendium is stored in
+        :type directory: string
+        """
+        self.directory = directory
+        self.genes = _read_lines(path.join(directory, _GENES_FILE))
+        self.gene_index = dict((g, i) for i, g in enumerate(self.genes))
+        self.conditions = _read_lines(path.join(directory, _CONDITIONS_FILE))
+        self.condition_index = dict((c, i)
+                                    for i, c in enumerate(self.conditions))
+        self._matrix = None
+
+        size = path.getsize(self._expression_file())
+        if size != len(self.genes) * len(self.conditions) * _DTYPE.itemsize:
+            raise ValueError("%s does not match its gene and condition "
+                             "lists." % self._expression_file())
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __getitem__(self, condition):
+        """
+        Gets a condition as a MicroarrayExperiment.
+
+        :param condition: the name of the condition
+        :type condition: string
+        """
+        return MicroarrayExperiment(condition, self,
+                                    self.condition_index[condition])
+
+    @property
+    def matrix(self):
+        """
+        The expression values as a read-only genes x conditions array,
+        backed by the memory map.
+        """
+        if self._matrix is None:
+            if self.conditions:
+                data = np.memmap(self._expression_file(), dtype=_DTYPE,
+                                 mode="r",
+                                 shape=(len(self.conditions), len(self.genes)))
+            else:
+                data = np.zeros((0, len(self.genes)), dtype=_DTYPE)
+            self._matrix = data.T
+
+        return self._matrix
+
+    def add_condition(self, name, values):
+        """
+        Appends a condition to the end of the compendium.
+
+        :param name: the name of the condition
+        :type name: string
+        :param values: the expression levels, either as a sequence in the
+                       order of genes or as a dictionary keyed by gene.
+                       Genes missing from a dictionary are NaN.
+        """
+        if name in self.condition_index:
+            raise ValueError("Condition %s is already in the compendium." %
+                             name)
+
+        if isinstance(values, Mapping):
+            column = np.full(len(self.genes), np.nan, dtype=_DTYPE)
+            for gene, value in values.items():
+                column[self.gene_index[gene]] = value
+        else:
+            column = np.asarray(values, dtype=_DTYPE)
+            if column.shape != (len(self.genes),):
+                raise ValueError("There must be one value per gene.")
+
+        with open(self._expression_file(), "ab") as handle:
+            column.tofile(handle)
+        _write_lines(path.join(self.directory, _CONDITIONS_FILE), [name], "a")
+
+        self.condition_index[name] = len(self.conditions)
+        self.conditions.append(name)
+        self._matrix = None
+
+    def gene(self, gene):
+        """
+        Returns the expression of a gene in every condition.
+
+        :param gene: the probe or locus
+        :type gene: string
+        """
+        return self.matrix[self.gene_index[gene]]
+
+    def rows(self, genes):
+        """
+        Returns the expression of a list of genes in every condition, as a
+        genes x conditions array.
+
+        :param genes: the probes or loci
+        :type genes: list
+        """
+        return self.matrix[[self.gene_index[g] for g in genes]]
+
+    def columns(self, conditions):
+        """
+        Returns the expression of every gene in a list of conditions, as a
+        genes x conditions array.
+
+        :param conditions: the names of the conditions
+        :type conditions: list
+        """
+        return self.matrix[:, [self.condition_index[c] for c in conditions]]
+
+    def iter_chunks(self, size=DEFAULT_CHUNK_SIZE, axis=0):
+        """
+        Iterates over the compendium in blocks, so that it never has to be
+        loaded at once.
+
+        :param size: the number of genes or conditions in each block
+        :type size: int
+        :param axis: 0 to iterate over blocks of genes, or 1 to iterate over
+                     blocks of conditions
+        :type axis: int
+        :return an iterator of tuples of the form (names, block), where
+                block is a genes x conditions array holding the named genes
+                or conditions
+        """
+        if axis == 0:
+            names = self.genes
+        elif axis == 1:
+            names = self.conditions
+        else:
+            raise ValueError("Axis must be 0 or 1.")
+
+        for start in range(0, len(names), size):
+            stop = min(start + size, len(names))
+            if axis == 0:
+                block = np.array(self.matrix[start:stop])
+            else:
+                block = np.array(self.matrix[:, start:stop])
+            yield names[start:stop], block
+
+    def expression_matrix(self):
+        """
+        Returns the compendium as a genes x conditions matrix, e.g. for
+        network inference.
+
+        :return a tuple of the form (genes, conditions, matrix)
+        :rtype tuple
+        """
+        return list(self.genes), list(self.conditions), self.matrix
 
+    def _expression_file(self):
+        return path.join(self.directory, _EXPRESSION_FILE)